@@ -0,0 +1,111 @@
+"""
+Compare concurrent-turn capacity per worker: sync VoiceInputView vs AsyncVoiceInputView
+
+Both views run in-process against a local fake upstream with a fixed latency
+per provider call, so a text turn costs ~2x latency (LLM + TTS). A sync worker
+can only hold as many turns as it has threads; the async view holds them all
+on one event loop.
+
+Usage:
+    python benchmarks/concurrent_turns.py --latency 0.5 --concurrency 1 10 50 200
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.fake_upstream import start_fake_upstream  # noqa: E402
+
+
+def setup_django(base_url):
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["YARNGPT_API_URL"] = f"{base_url}/tts"
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mindvoice_project.settings")
+    # Keep the server's per-turn logging out of the results
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import django
+    from django.test.utils import setup_test_environment
+
+    django.setup()
+    setup_test_environment()
+
+
+def run_sync(concurrency, threads):
+    from django.test import Client
+
+    def turn():
+        start = time.perf_counter()
+        response = Client().post("/api/voice_input/", {"text": "hello"})
+        assert response.status_code == 200, response.status_code
+        if response.streaming:
+            # The turn isn't over (nor the TTS call released) until it is read
+            b"".join(response.streaming_content)
+        response.close()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(lambda _: turn(), range(concurrency)))
+
+
+def run_async(concurrency):
+    from django.test import AsyncClient
+
+    async def turn():
+        start = time.perf_counter()
+        response = await AsyncClient().post(
+            "/api/voice_input/async/", {"text": "hello"}
+        )
+        assert response.status_code == 200, response.status_code
+        if response.streaming:
+            [chunk async for chunk in response.streaming_content]
+        return time.perf_counter() - start
+
+    async def main():
+        return await asyncio.gather(*(turn() for _ in range(concurrency)))
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--threads", type=int, default=1, help="sync worker threads")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 200])
+    args = parser.parse_args()
+
+    server, base_url = start_fake_upstream(latency=args.latency)
+    setup_django(base_url)
+
+    print(
+        f"{'mode':<6} {'turns':>6} {'wall_s':>8} {'turns/s':>8} {'peak_upstream':>14}"
+    )
+    for concurrency in args.concurrency:
+        for mode in ("sync", "async"):
+            server.reset_stats()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if mode == "sync":
+                    run_sync(concurrency, args.threads)
+                else:
+                    run_async(concurrency)
+            wall = time.perf_counter() - start
+            print(
+                f"{mode:<6} {concurrency:>6} {wall:>8.2f} "
+                f"{concurrency / wall:>8.1f} {server.peak_in_flight:>14}"
+            )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
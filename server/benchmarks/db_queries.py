@@ -0,0 +1,282 @@
+"""
+Latency of the hot database queries on a large synthetic dataset
+
+Fills a throwaway database with generate_synthetic_data, then times what
+the API and the admin run against it: LoginView's lookup by full name, the
+history window a voice turn loads (context_store.history, cache cold),
+SessionHistoryView's first and a later cursor page, the admin changelists,
+and registering a user through the username allocator (rolled back after
+each sample). Reports the median and p95 time and the queries per call.
+
+Runs on SQLite by default (a temp file, so the page cache behaves like a
+real one). With DEBUG=False and DB_* set it runs on PostgreSQL, in the test
+database Django creates next to DB_NAME; --keepdb keeps it, and its data,
+for the next run. --output writes the results as JSON for comparing runs.
+
+Usage:
+    python benchmarks/db_queries.py --users 100000 --messages 5000000
+    DEBUG=False DB_NAME=mindvoice DB_USER=... python benchmarks/db_queries.py \\
+        --keepdb --output results/postgres.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def rolled_back():
+    """Undo whatever the block wrote"""
+    from django.db import transaction
+
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def measure(name, call, samples):
+    """
+    Time ``call(i)`` for each of ``samples`` and count its queries
+
+    Returns:
+        dict: name, median_ms, p95_ms and queries per call
+    """
+    from django.db import connection
+
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    call(0)  # Warm-up
+    timings = []
+    with connection.execute_wrapper(count):
+        queries = 0
+        for i in range(samples):
+            began = time.perf_counter()
+            call(i)
+            timings.append((time.perf_counter() - began) * 1000)
+    timings.sort()
+    result = {
+        "name": name,
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "queries": round(queries / samples, 1),
+    }
+    print(
+        f"{name:<36} {result['median_ms']:>10.2f} {result['p95_ms']:>10.2f} "
+        f"{result['queries']:>8.1f}",
+        flush=True,
+    )
+    return result
+
+
+def benchmarks(rng, samples):
+    """(name, call) per timed query, picked from the generated data"""
+    from django.db.models import Count
+    from django.test import Client
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    from companion.auth_views import LoginView
+    from companion.context import context_store
+    from companion.management.commands.generate_synthetic_data import NAMESAKE
+    from companion.models import Session, User
+    from companion.usernames import create_user_with_unique_username
+    from companion.views import SessionHistoryView
+
+    # Users with a single name each (not the namesakes), and the heaviest
+    # users, whose windows and history pages are the ones that matter
+    names = list(
+        User.objects.exclude(full_name=NAMESAKE)
+        .order_by("?")
+        .values_list("full_name", flat=True)[:samples]
+    )
+    heavy = list(
+        Session.objects.values("user")
+        .annotate(sessions=Count("pk"))
+        .order_by("-sessions")
+        .values_list("user", flat=True)[: max(10, samples // 10)]
+    )
+    heavy_users = {user.id: user for user in User.objects.filter(id__in=heavy)}
+    factory = APIRequestFactory()
+    history_view = SessionHistoryView.as_view()
+
+    def login(i):
+        request = factory.post("/api/auth/login/", {"full_name": names[i % len(names)]})
+        with rolled_back():  # Leave no tokens behind
+            assert LoginView.as_view()(request).status_code == 200
+
+    def history_window(i):
+        context_store.reset()  # A cache miss, as after a restart or eviction
+        context_store.history(heavy[i % len(heavy)])
+
+    def history_page(path):
+        def call(i):
+            request = factory.get(path)
+            force_authenticate(request, user=heavy_users[heavy[i % len(heavy)]])
+            response = history_view(request)
+            assert response.status_code == 200, response.status_code
+            response.render()
+            return response.data
+
+        return call
+
+    def later_page(i):
+        # Follow the cursor from the first page to the third
+        data = None
+        path = "/api/sessions/?page_size=20"
+        for _ in range(3):
+            data = history_page(path)(i)
+            if not data["next"]:
+                break
+            path = data["next"]
+
+    admin = User.objects.create_superuser("benchmark_admin", password="x")
+    client = Client()
+    client.force_login(admin)
+
+    def changelist(path):
+        def call(i):
+            response = client.get(path)
+            assert response.status_code == 200, response.status_code
+
+        return call
+
+    def register(full_name):
+        def call(i):
+            with rolled_back():
+                create_user_with_unique_username(full_name)
+
+        return call
+
+    fresh = names[rng.randrange(len(names))]
+    heavy_username = heavy_users[heavy[0]].username
+    return [
+        ("login by full name", login),
+        ("history window (cache cold)", history_window),
+        ("session history, first page", history_page("/api/sessions/")),
+        ("session history, third page", later_page),
+        ("admin user changelist", changelist("/admin/companion/user/")),
+        ("admin session changelist", changelist("/admin/companion/session/")),
+        ("admin message changelist", changelist("/admin/companion/message/")),
+        (
+            "admin messages of one user",
+            changelist(f"/admin/companion/message/?username={heavy_username}"),
+        ),
+        (f"register {NAMESAKE!r} (namesakes)", register(NAMESAKE)),
+        ("register a taken name (first time)", register(fresh)),
+    ]
+
+
+def database_version(connection):
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SHOW server_version")
+            return f"PostgreSQL {cursor.fetchone()[0]}"
+        cursor.execute("SELECT sqlite_version()")
+        return f"SQLite {cursor.fetchone()[0]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument(
+        "--keepdb",
+        action="store_true",
+        help="Reuse the test database and its data if it is already filled",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    setup_django("http://127.0.0.1:9")
+
+    import django
+    from django.core.management import call_command
+    from django.db import connection
+
+    from companion.models import Message, Session, User
+
+    if connection.vendor == "sqlite":
+        directory = tempfile.gettempdir() if args.keepdb else tempfile.mkdtemp()
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(
+            directory, "mindvoice_db_queries.sqlite3"
+        )
+    with contextlib.redirect_stdout(io.StringIO()):
+        connection.creation.create_test_db(verbosity=0, keepdb=args.keepdb)
+
+    generated = None
+    if not User.objects.exists():
+        began = time.perf_counter()
+        call_command(
+            "generate_synthetic_data",
+            users=args.users,
+            messages=args.messages,
+            months=args.months,
+            seed=args.seed,
+            verbosity=2,
+            stdout=sys.stderr,
+        )
+        generated = round(time.perf_counter() - began, 1)
+    User.objects.filter(username="benchmark_admin").delete()
+    counts = {
+        "users": User.objects.count(),
+        "sessions": Session.objects.count(),
+        "messages": Message.objects.count(),
+    }
+    version = database_version(connection)
+    print(
+        f"{version}: {counts['users']:,} users, {counts['sessions']:,} sessions, "
+        f"{counts['messages']:,} messages\n"
+    )
+
+    print(f"{'query':<36} {'median_ms':>10} {'p95_ms':>10} {'queries':>8}")
+    rng = random.Random(args.seed)
+    results = [
+        measure(name, call, args.samples)
+        for name, call in benchmarks(rng, args.samples)
+    ]
+
+    if args.output:
+        report = {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "database": version,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "rows": counts,
+            "generate_seconds": generated,
+            "samples": args.samples,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
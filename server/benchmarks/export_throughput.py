@@ -0,0 +1,127 @@
+"""
+Export throughput and peak memory: export_conversations vs the old script
+
+Grows a throwaway in-memory SQLite database to each size and exports it.
+The exporter reads keyset chunks, so its peak Python memory should stay
+flat as the table grows. scripts/check_messages.py (replaced by the
+command) iterated a select_related queryset without .iterator(), caching
+every row.
+
+Usage:
+    python benchmarks/export_throughput.py --sizes 25000 100000 400000
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+
+MESSAGES_PER_SESSION = 20
+SESSIONS_PER_USER = 5
+
+
+def grow(total):
+    """Add users, sessions and messages until there are ``total`` messages"""
+    from companion.models import Message, Session, User
+
+    existing = Message.objects.count()
+    while existing < total:
+        user = User.objects.create_user(f"user_{existing}", full_name="Ada Obi")
+        for _ in range(SESSIONS_PER_USER):
+            session = Session.objects.create(user=user)
+            Message.objects.bulk_create(
+                Message(
+                    session=session,
+                    user=user,
+                    user_full_name=user.full_name,
+                    role="user" if i % 2 == 0 else "assistant",
+                    text="I have been feeling anxious about work lately. " * 3,
+                )
+                for i in range(MESSAGES_PER_SESSION)
+            )
+            existing += MESSAGES_PER_SESSION
+
+
+def legacy_scan():
+    from companion.models import Message
+
+    for message in Message.objects.select_related("user", "session").order_by(
+        "timestamp"
+    ):
+        pass
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[25000, 100000, 400000])
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument(
+        "--legacy-max",
+        type=int,
+        default=100000,
+        help="Skip the old script's scan above this many messages",
+    )
+    args = parser.parse_args()
+
+    setup_django("http://127.0.0.1:9")
+
+    from django.db import connection
+
+    from companion.export import Exporter
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        connection.creation.create_test_db(verbosity=0)
+
+    print(
+        f"{'messages':>9} {'rows/s':>9} {'export_MB':>10} "
+        f"{'export_peak_MB':>15} {'script_peak_MB':>15}"
+    )
+    for size in args.sizes:
+        grow(size)
+        directory = tempfile.mkdtemp()
+        try:
+
+            def export():
+                return Exporter(directory, fmt=args.format, compress=args.gzip).run()
+
+            began = time.perf_counter()
+            stats = export()
+            elapsed = time.perf_counter() - began
+            rows = sum(table["rows"] for table in stats.values())
+            size_mb = sum(table["bytes"] for table in stats.values()) / 1e6
+            export_peak = peak_memory(export)
+        finally:
+            shutil.rmtree(directory)
+        legacy_peak = (
+            f"{peak_memory(legacy_scan):>15.1f}"
+            if size <= args.legacy_max
+            else f"{'-':>15}"
+        )
+        print(
+            f"{size:>9} {rows / elapsed:>9,.0f} {size_mb:>10.1f} "
+            f"{export_peak:>15.1f} {legacy_peak}",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
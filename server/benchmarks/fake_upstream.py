@@ -0,0 +1,280 @@
+"""
+Local stand-in for the OpenAI and YarnGPT endpoints used by the voice pipeline
+
+Serves Whisper transcription, chat completions (plain and streamed) and
+YarnGPT synthesis with configurable latency, faults and payload sizes. The
+benchmarks start it in-process; run it on its own to point a real server at
+it through OPENAI_BASE_URL=http://127.0.0.1:9000/v1 and
+YARNGPT_API_URL=http://127.0.0.1:9000/tts.
+
+Usage:
+    python benchmarks/fake_upstream.py --port 9000 --llm-latency 0.8 --spread 2
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+AUDIO_BLOCK = 64 * 1024
+SERVICES = ("stt", "llm", "tts")
+
+REPLY = (
+    "I hear you. That sounds like a lot to carry today. "
+    "What part of this hits you the hardest?"
+)
+
+
+class FakeUpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address,
+        latency=0.5,
+        audio_bytes=64 * 1024,
+        slow_fraction=0.0,
+        slow_latency=0.0,
+        error_fraction=0.0,
+        spread=1.0,
+        reply_words=None,
+        token_interval=0.0,
+        unique_replies=False,
+    ):
+        """
+        Args:
+            latency: Median seconds before a response starts, one for all
+                services or a dict by service ("stt", "llm", "tts")
+            audio_bytes: Size of each synthesized clip
+            slow_fraction, slow_latency: Share of requests that instead
+                take ``slow_latency`` seconds
+            error_fraction: Share of requests answered with a 503
+            spread: p95 latency as a multiple of the median (lognormal);
+                1 makes every request take the median
+            reply_words: Words per chat reply (REPLY repeated or cut)
+            token_interval: Seconds between the words of a streamed reply
+            unique_replies: End every reply with a serial number, so TTS
+                can't answer from its cache
+        """
+        super().__init__(address, FakeUpstreamHandler)
+        if not isinstance(latency, dict):
+            latency = dict.fromkeys(SERVICES, latency)
+        self.latency = latency
+        # Lognormal sigma putting the p95 at ``spread`` times the median
+        self.sigma = math.log(max(spread, 1.0)) / 1.645
+        self.audio_bytes = audio_bytes
+        words = REPLY.split(" ")
+        if reply_words:
+            words = (words * math.ceil(reply_words / len(words)))[:reply_words]
+        self.reply = " ".join(words)
+        self.token_interval = token_interval
+        self.unique_replies = unique_replies
+        # Fault injection: a share of requests stall or fail with a 503
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.error_fraction = error_fraction
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.requests = 0
+
+    def next_reply(self):
+        if not self.unique_replies:
+            return self.reply
+        with self.lock:
+            serial = self.requests
+        return f"{self.reply} Number {serial}."
+
+    def pick_fault(self, service="llm"):
+        """(latency, status) for the next request to ``service``"""
+        with self.lock:
+            roll = self.random.random()
+            latency = self.latency[service] * math.exp(
+                self.sigma * self.random.gauss(0, 1)
+            )
+        if roll < self.error_fraction:
+            return latency, 503
+        if roll < self.error_fraction + self.slow_fraction:
+            return self.slow_latency, 200
+        return latency, 200
+
+    def handle_error(self, request, client_address):
+        pass  # Clients that gave up on a call hang up mid-response
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.requests += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if self.path.endswith("/audio/transcriptions"):
+                service = "stt"
+                # Uploads can be large; drain them without holding them
+                self._drain(length)
+                body = b""
+            else:
+                service = "llm" if self.path.endswith("/chat/completions") else "tts"
+                body = self.rfile.read(length)
+            latency, status = server.pick_fault(service)
+            time.sleep(latency)
+            if status != 200:
+                self._send_json({"error": {"message": "injected fault"}}, status)
+            elif service == "stt":
+                self._send_json({"text": "I have been feeling stressed at work."})
+            elif service == "llm":
+                if json.loads(body or b"{}").get("stream"):
+                    self._send_chat_stream()
+                else:
+                    self._send_json(
+                        {
+                            "id": "chatcmpl-fake",
+                            "object": "chat.completion",
+                            "created": 0,
+                            "model": "gpt-4o",
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": server.next_reply(),
+                                    },
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                        }
+                    )
+            else:
+                self._send_audio()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _drain(self, length):
+        while length > 0:
+            length -= len(self.rfile.read(min(AUDIO_BLOCK, length)))
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_chat_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, word in enumerate(self.server.next_reply().split(" ")):
+            if i and self.server.token_interval:
+                time.sleep(self.server.token_interval)
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "gpt-4o",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word + " "},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _send_audio(self):
+        size = self.server.audio_bytes
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        # Written in fixed blocks so large payloads don't allocate here
+        block = b"\xff\xfb" + b"\x00" * (AUDIO_BLOCK - 2)
+        for start in range(0, size, AUDIO_BLOCK):
+            self.wfile.write(block[: min(AUDIO_BLOCK, size - start)])
+
+
+def start_fake_upstream(latency=0.5, audio_bytes=64 * 1024, port=0, **options):
+    """
+    Start the fake upstream in a background thread
+
+    Args:
+        options: Faults (slow_fraction, slow_latency, error_fraction) and
+            the rest of FakeUpstreamServer's options
+
+    Returns:
+        tuple: (server, base_url)
+    """
+    server = FakeUpstreamServer(("127.0.0.1", port), latency, audio_bytes, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.5, help="median seconds")
+    for service in SERVICES:
+        parser.add_argument(
+            f"--{service}-latency", type=float, help="overrides --latency"
+        )
+    parser.add_argument("--spread", type=float, default=1.0, help="p95 / median")
+    parser.add_argument("--audio-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--reply-words", type=int)
+    parser.add_argument("--token-interval", type=float, default=0.0)
+    parser.add_argument("--unique-replies", action="store_true")
+    parser.add_argument("--error-fraction", type=float, default=0.0)
+    parser.add_argument("--slow-fraction", type=float, default=0.0)
+    parser.add_argument("--slow-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    latency = {
+        service: getattr(args, f"{service}_latency") or args.latency
+        for service in SERVICES
+    }
+    server, base_url = start_fake_upstream(
+        latency,
+        args.audio_bytes,
+        args.port,
+        slow_fraction=args.slow_fraction,
+        slow_latency=args.slow_latency,
+        error_fraction=args.error_fraction,
+        spread=args.spread,
+        reply_words=args.reply_words,
+        token_interval=args.token_interval,
+        unique_replies=args.unique_replies,
+    )
+    print(f"OPENAI_BASE_URL={base_url}/v1")
+    print(f"YARNGPT_API_URL={base_url}/tts")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Tail latency with hedged requests, and calls during an outage with a breaker
+
+Drives TTSService against the local fake upstream from a pool of threads.
+First a slow tail is injected (a share of requests stall), comparing
+latency percentiles and requests sent with hedging off and on. Then the
+provider fails every call, comparing how long callers wait per call with
+the circuit breaker off and on.
+
+Usage:
+    python benchmarks/hedging.py --calls 400 --slow-fraction 0.03 --slow-latency 1
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+from benchmarks.fake_upstream import start_fake_upstream  # noqa: E402
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def drive(tts, calls, threads):
+    """Latencies (ms) of ``calls`` syntheses, failed or not"""
+
+    def call(i):
+        began = time.perf_counter()
+        with contextlib.suppress(Exception):
+            # Distinct texts, so no two calls share a cache entry
+            tts.synthesize(f"Hello number {i}", "Idera")
+        return (time.perf_counter() - began) * 1000
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return list(pool.map(call, range(calls)))
+
+
+def build(settings, hedge, breaker_on=True):
+    from audio_processing.registry import registry
+    from audio_processing.resilience import CircuitBreaker, Resilience
+    from audio_processing.tts_service import TTSService
+
+    breaker = CircuitBreaker(
+        "tts",
+        window=settings.BREAKER_WINDOW,
+        min_calls=settings.BREAKER_MIN_CALLS,
+        # Off: a failure rate that can never be reached
+        failure_rate=settings.BREAKER_FAILURE_RATE if breaker_on else 2,
+        slow_call=settings.SLOW_CALL_SECONDS["tts"],
+        open_seconds=settings.BREAKER_OPEN_SECONDS,
+    )
+    resilience = Resilience(
+        "tts",
+        breaker,
+        hedge=hedge,
+        hedge_quantile=settings.HEDGE_QUANTILE,
+        hedge_budget=settings.HEDGE_BUDGET,
+        hedge_min_samples=settings.HEDGE_MIN_SAMPLES,
+        hedge_threads=settings.HEDGE_THREADS,
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        return TTSService(session=registry.yarngpt_session(), resilience=resilience)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow-fraction", type=float, default=0.03)
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_upstream(
+        latency=args.latency,
+        audio_bytes=16 * 1024,
+        slow_fraction=args.slow_fraction,
+        slow_latency=args.slow_latency,
+    )
+    os.environ["TTS_CACHE_ENABLED"] = "False"
+    os.environ["ADMISSION_ENABLED"] = "False"
+    setup_django(base_url)
+
+    from django.conf import settings
+
+    print(
+        f"{args.calls} calls from {args.threads} threads; "
+        f"{args.latency * 1000:.0f} ms upstream, {args.slow_fraction:.0%} "
+        f"stalling {args.slow_latency * 1000:.0f} ms"
+    )
+    for hedge in [False, True]:
+        tts = build(settings, hedge)
+        # Warm-up calls give the hedging delay its latency samples
+        drive(tts, settings.HEDGE_MIN_SAMPLES, args.threads)
+        server.reset_stats()
+        latencies = drive(tts, args.calls, args.threads)
+        print(
+            f"  hedging {'on ' if hedge else 'off'}  p50 "
+            f"{percentile(latencies, 0.5):6.1f}  p95 "
+            f"{percentile(latencies, 0.95):6.1f}  p99 "
+            f"{percentile(latencies, 0.99):6.1f}  max {max(latencies):6.1f} ms; "
+            f"{server.requests / args.calls:.2f} requests per call"
+        )
+
+    server.error_fraction, server.slow_fraction = 1.0, 0.0
+    print(f"Provider failing every call ({args.calls} calls):")
+    for breaker_on in [False, True]:
+        tts = build(settings, hedge=False, breaker_on=breaker_on)
+        server.reset_stats()
+        latencies = drive(tts, args.calls, args.threads)
+        print(
+            f"  breaker {'on ' if breaker_on else 'off'}  mean "
+            f"{sum(latencies) / len(latencies):6.2f} ms per call, "
+            f"{server.requests} requests reached the provider"
+        )
+
+
+if __name__ == "__main__":
+    main()
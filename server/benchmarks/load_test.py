@@ -0,0 +1,401 @@
+"""
+Open-loop load test of the voice endpoint against the fake upstream
+
+Starts the fake upstream and a server in the chosen deployment mode (sync:
+gunicorn sync workers; threaded: gunicorn gthread workers; async: uvicorn
+serving /api/voice_input/async/), registers --users users, then starts text
+and audio turns at --rps for --duration seconds whether or not earlier ones
+have finished, as real traffic would. Reports throughput, end-to-end and
+per-stage p50/p95/p99 (the stages from the server's /metrics), and how many
+of the workers' request slots the turns kept busy.
+
+--url drives a server that is already running instead (--mode then picks
+the endpoint, and --workers/--threads should match it); point it at a fake
+upstream started on its own (python benchmarks/fake_upstream.py) and pass
+its METRICS_TOKEN for the stage breakdown. Give it --unique-replies, or TTS
+answers every turn from its cache.
+
+The server inherits this environment, so settings pass through (e.g.
+ADMISSION_ENABLED=False to lift the provider quotas, or DEBUG=False with
+DB_* for PostgreSQL). Turns are saved: use a throwaway database.
+
+Usage:
+    python benchmarks/load_test.py --mode threaded --workers 2 --threads 8 \\
+        --rps 10 --duration 30 --audio-fraction 0.3
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import math
+import os
+import random
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from benchmarks.fake_upstream import SERVICES, start_fake_upstream  # noqa: E402
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+QUANTILES = (0.5, 0.95, 0.99)
+STAGE_BUCKET = "mindvoice_stage_seconds_bucket{"
+
+
+def server_command(mode, port, workers, threads):
+    """Command line serving the app in ``mode``"""
+    if mode == "async":
+        return [
+            *(sys.executable, "-m", "uvicorn", "mindvoice_project.asgi:application"),
+            *("--port", str(port), "--workers", str(workers)),
+            *("--log-level", "warning"),
+        ]
+    command = [
+        *(sys.executable, "-m", "gunicorn", "mindvoice_project.wsgi:application"),
+        *("--bind", f"127.0.0.1:{port}", "--workers", str(workers)),
+    ]
+    if mode == "threaded":
+        command += ["--worker-class", "gthread", "--threads", str(threads)]
+    return command
+
+
+def start_server(args, upstream_url, metrics_token):
+    """Migrate the database, start the server and wait until it answers"""
+    server = "uvicorn" if args.mode == "async" else "gunicorn"
+    if importlib.util.find_spec(server) is None:
+        sys.exit(f"--mode {args.mode} needs {server}: pipenv install {server}")
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "load-test",
+        "OPENAI_BASE_URL": f"{upstream_url}/v1",
+        "YARNGPT_API_URL": f"{upstream_url}/tts",
+        "METRICS_TOKEN": metrics_token,
+        # A fresh directory, so only this run's workers are added up
+        "METRICS_DIR": tempfile.mkdtemp(prefix="load-test-metrics-"),
+    }
+    env.setdefault("LOG_LEVEL", "WARNING")
+    subprocess.run(
+        [sys.executable, "manage.py", "migrate", "--noinput", "--verbosity", "0"],
+        cwd=SRC,
+        env=env,
+        check=True,
+    )
+    process = subprocess.Popen(
+        server_command(args.mode, args.port, args.workers, args.threads),
+        cwd=SRC,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{args.port}"
+    for _ in range(300):
+        if process.poll() is not None:
+            sys.exit(f"{server} exited with status {process.returncode}")
+        try:
+            httpx.get(f"{url}/metrics", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    sys.exit(f"{server} did not start listening on port {args.port}")
+
+
+def recording(seconds=3.0, rate=16000):
+    """A WAV upload: a quiet tone, which the fake STT transcribes all the same"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(
+            b"".join(
+                int(3000 * math.sin(2 * math.pi * 220 * i / rate)).to_bytes(
+                    2, "little", signed=True
+                )
+                for i in range(int(seconds * rate))
+            )
+        )
+    return buffer.getvalue()
+
+
+async def register(client, url, count):
+    """Tokens of ``count`` new users"""
+    tokens = []
+    for i in range(count):
+        response = await client.post(
+            f"{url}/api/auth/register/", json={"full_name": f"Load Test {i}"}
+        )
+        response.raise_for_status()
+        tokens.append(response.json()["token"])
+    return tokens
+
+
+def stage_histograms(text):
+    """{stage: {upper bound: cumulative count}} of every worker, all labels added up"""
+    histograms = {}
+    for line in text.splitlines():
+        if not line.startswith(STAGE_BUCKET):
+            continue
+        labels, value = line.rsplit(" ", 1)
+        pairs = dict(re.findall(r'(\w+)="([^"]*)"', labels))
+        buckets = histograms.setdefault(pairs["stage"], {})
+        bound = float(pairs["le"])
+        buckets[bound] = buckets.get(bound, 0) + float(value)
+    return histograms
+
+
+def bucket_quantile(buckets, fraction):
+    """Quantile of a cumulative histogram, interpolated within its bucket"""
+    bounds = sorted(buckets)
+    rank = fraction * buckets[bounds[-1]]
+    lower, below = 0.0, 0.0
+    for bound in bounds:
+        if buckets[bound] >= rank and buckets[bound] > below:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (buckets[bound] - below)
+        lower, below = bound, buckets[bound]
+    return lower
+
+
+def quantiles(samples):
+    samples = sorted(samples)
+    return [samples[min(len(samples) - 1, int(len(samples) * q))] for q in QUANTILES]
+
+
+class Load:
+    """Open-loop turns at a fixed average rate, and what became of them"""
+
+    def __init__(self, client, url, tokens, args):
+        self.client = client
+        self.url = url
+        self.tokens = tokens
+        self.args = args
+        self.audio = recording()
+        self.random = random.Random(0)
+        self.results = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._busy = 0.0  # Integral of in_flight over time
+        self._changed = time.perf_counter()
+        self.max_lag = 0.0
+
+    def _track(self, delta):
+        now = time.perf_counter()
+        self._busy += self.in_flight * (now - self._changed)
+        self._changed = now
+        self.in_flight += delta
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def mean_in_flight(self, elapsed):
+        self._track(0)
+        return self._busy / elapsed
+
+    async def turn(self, index):
+        audio = self.random.random() < self.args.audio_fraction
+        path = "/api/voice_input/"
+        if self.args.mode == "async":
+            path += "async/"
+        headers = {}
+        if self.tokens:
+            headers["Authorization"] = f"Token {self.tokens[index % len(self.tokens)]}"
+        fields = {"voice_preference": "idera"}
+        if self.args.stream:
+            fields["stream"] = "true"
+        if audio:
+            # Multipart, as the app uploads recordings
+            body = {
+                "data": fields,
+                "files": {"audio": ("turn.wav", self.audio, "audio/wav")},
+            }
+        else:
+            fields["text"] = "I have been feeling stressed at work lately."
+            body = {"json": fields}
+
+        self._track(1)
+        began, first_byte = time.perf_counter(), None
+        try:
+            async with self.client.stream(
+                "POST", self.url + path, headers=headers, **body
+            ) as response:
+                async for _ in response.aiter_raw():
+                    if first_byte is None:
+                        first_byte = time.perf_counter()
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        finally:
+            self._track(-1)
+        ended = time.perf_counter()
+        self.results.append(
+            {
+                "status": status,
+                "audio": audio,
+                "first_byte": (first_byte or ended) - began,
+                "total": ended - began,
+            }
+        )
+
+    async def run(self):
+        """Start turns for ``duration`` seconds, then wait for all of them"""
+        tasks = []
+        began = time.perf_counter()
+        next_at = began
+        while next_at - began < self.args.duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.max_lag = max(self.max_lag, -delay)
+            tasks.append(asyncio.create_task(self.turn(len(tasks))))
+            next_at += self.random.expovariate(self.args.rps)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - began
+
+
+async def scrape(client, url, token):
+    if not token:
+        return {}
+    response = await client.get(
+        f"{url}/metrics", headers={"Authorization": f"Bearer {token}"}
+    )
+    if response.status_code != 200:
+        print(f"/metrics answered {response.status_code}; no stage breakdown")
+        return {}
+    return stage_histograms(response.text)
+
+
+def print_row(name, values):
+    print(f"  {name:<28}" + "".join(f"{v * 1000:>9.0f}" for v in values))
+
+
+def report(args, load, elapsed, stages_before, stages_after, upstream):
+    results = load.results
+    done = [r for r in results if r["status"] == "200"]
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    print(
+        f"{len(results)} turns started, {len(done)} answered 200 "
+        f"({len(done) / elapsed:.1f}/s over {elapsed:.1f}s); "
+        + ", ".join(f"{status}: {n}" for status, n in sorted(statuses.items()))
+    )
+    if load.max_lag > 0.05:
+        print(f"  (the generator fell up to {load.max_lag:.2f}s behind schedule)")
+
+    print(
+        f"  {'latency, ms':<28}" + "".join(f"{f'p{q * 100:g}':>9}" for q in QUANTILES)
+    )
+    for kind, label in ((False, "text"), (True, "audio")):
+        subset = [r for r in done if r["audio"] is kind]
+        if subset:
+            print_row(f"{label} first byte", quantiles(r["first_byte"] for r in subset))
+            print_row(f"{label} turn", quantiles(r["total"] for r in subset))
+    for stage in sorted(stages_after):
+        after, before = stages_after[stage], stages_before.get(stage, {})
+        buckets = {bound: n - before.get(bound, 0) for bound, n in after.items()}
+        if max(buckets.values()) > 0:
+            print_row(
+                f"stage {stage}",
+                [bucket_quantile(buckets, q) for q in QUANTILES],
+            )
+
+    mean = load.mean_in_flight(elapsed)
+    if args.mode != "async":
+        slots = args.workers * (args.threads if args.mode == "threaded" else 1)
+        print(
+            f"workers: {mean:.1f} turns in flight on average, peak "
+            f"{load.peak_in_flight}, for {slots} request slots "
+            f"({min(mean / slots, 1):.0%} busy)"
+        )
+    else:
+        print(f"turns in flight: {mean:.1f} on average, peak {load.peak_in_flight}")
+    if upstream is not None:
+        print(
+            f"upstream: {upstream.requests} calls, peak "
+            f"{upstream.peak_in_flight} in flight"
+        )
+
+
+async def drive(args, url, metrics_token, upstream):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        tokens = await register(client, url, args.users)
+        # Warm every worker's upstream clients before measuring
+        load = Load(client, url, tokens, args)
+        await asyncio.gather(*(load.turn(i) for i in range(args.workers * 2)))
+        load = Load(client, url, tokens, args)
+        if upstream is not None:
+            upstream.reset_stats()
+        before = await scrape(client, url, metrics_token)
+        elapsed = await load.run()
+        # Let every worker flush its counts (METRICS_FLUSH_SECONDS)
+        await asyncio.sleep(1.5)
+        after = await scrape(client, url, metrics_token)
+    report(args, load, elapsed, before, after, upstream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--mode", choices=["sync", "threaded", "async"], default="threaded"
+    )
+    parser.add_argument("--url", help="drive this running server instead")
+    parser.add_argument("--metrics-token", help="the --url server's METRICS_TOKEN")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8, help="threaded mode")
+    parser.add_argument("--rps", type=float, default=5.0)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--audio-fraction", type=float, default=0.3)
+    parser.add_argument("--stream", action="store_true", help="NDJSON turns")
+    parser.add_argument("--users", type=int, default=20, help="0: guest turns")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--latency", type=float, default=0.3, help="upstream median")
+    for service in SERVICES:
+        parser.add_argument(f"--{service}-latency", type=float)
+    parser.add_argument("--spread", type=float, default=2.0, help="p95 / median")
+    parser.add_argument("--audio-bytes", type=int, default=32 * 1024)
+    parser.add_argument("--error-fraction", type=float, default=0.0)
+    args = parser.parse_args()
+
+    shape = f"{args.workers} workers"
+    if args.mode == "threaded":
+        shape += f" x {args.threads} threads"
+    if args.url:
+        print(
+            f"{args.url}, {args.mode} ({shape}): {args.rps:g} turns/s for "
+            f"{args.duration:g}s"
+        )
+        asyncio.run(drive(args, args.url.rstrip("/"), args.metrics_token, None))
+        return
+
+    upstream, upstream_url = start_fake_upstream(
+        {
+            service: getattr(args, f"{service}_latency") or args.latency
+            for service in SERVICES
+        },
+        args.audio_bytes,
+        error_fraction=args.error_fraction,
+        spread=args.spread,
+        unique_replies=True,
+    )
+    metrics_token = secrets.token_hex(16)
+    process, url = start_server(args, upstream_url, metrics_token)
+    print(f"{args.mode} ({shape}): {args.rps:g} turns/s for {args.duration:g}s")
+    try:
+        asyncio.run(drive(args, url, metrics_token, upstream))
+    finally:
+        process.terminate()
+        process.wait()
+        upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
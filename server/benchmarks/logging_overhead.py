@@ -0,0 +1,109 @@
+"""
+Per-turn cost of the server's own logging, to a fast and to a stalled stdout
+
+Runs sequential authenticated text turns through VoiceInputView against the
+local fake upstream (no latency), with stdout swapped for a sink that
+discards writes, then for one that stalls ``--stall-ms`` on every write like
+a backed-up log pipe. Reports the mean and p99 time per turn, and the bytes
+of log written per turn.
+
+Logs at LOG_LEVEL=INFO unless told otherwise; set LOG_LEVEL=DEBUG and
+LOG_DEBUG_SAMPLE_RATE=1 to log every step of every turn.
+
+Usage:
+    python benchmarks/logging_overhead.py --turns 200 --stall-ms 5
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+from benchmarks.fake_upstream import start_fake_upstream  # noqa: E402
+
+
+class Sink(io.TextIOBase):
+    """Stdout that discards what it is sent, after ``stall`` seconds per write"""
+
+    def __init__(self):
+        self.stall = 0.0
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if self.stall:
+            time.sleep(self.stall)
+        self.written += len(text.encode())
+        return len(text)
+
+
+def run(client, turns):
+    latencies = []
+    for _ in range(turns):
+        began = time.perf_counter()
+        response = client.post(
+            "/api/voice_input/", {"text": "How do I stay calm before exams?"}
+        )
+        assert response.status_code == 200, response.status_code
+        if response.streaming:
+            b"".join(response.streaming_content)  # The audio, and the save
+        response.close()
+        latencies.append(time.perf_counter() - began)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--stall-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    report = sys.stdout
+    sink = Sink()
+    server, base_url = start_fake_upstream(latency=0, audio_bytes=16 * 1024)
+    os.environ["TTS_CACHE_ENABLED"] = "False"
+    # YarnGPT's rate limit would pace the turns at 5 a second
+    os.environ["ADMISSION_ENABLED"] = "False"
+    # Background summaries would contend with the turns for the database
+    os.environ["SESSION_SUMMARY_ENABLED"] = "False"
+    os.environ.setdefault("LOG_LEVEL", "INFO")
+    # Before Django configures logging, so its handlers write to the sink too
+    sys.stdout = sink
+    setup_django(base_url)
+
+    from django.db import connection
+    from django.test import Client
+    from rest_framework.authtoken.models import Token
+
+    from companion.models import User
+
+    connection.creation.create_test_db(verbosity=0)
+    user = User.objects.create_user("bench", password="x", full_name="Bench")
+    token = Token.objects.create(user=user)
+    client = Client(HTTP_AUTHORIZATION=f"Token {token.key}")
+    run(client, 20)  # Warm-up
+
+    print(f"{args.turns} turns per run", file=report)
+    for label, stall in [("fast stdout", 0.0), ("stalled stdout", args.stall_ms)]:
+        sink.stall, sink.written = stall / 1000, 0
+        latencies = run(client, args.turns)
+        # Give a background writer time to drain before counting its bytes
+        time.sleep(0.5)
+        print(
+            f"  {label:<15} ({stall:g} ms/write)  mean "
+            f"{sum(latencies) / len(latencies) * 1000:6.2f}  p99 "
+            f"{latencies[int(len(latencies) * 0.99)] * 1000:6.2f} ms/turn; "
+            f"{sink.written / args.turns:7.0f} log bytes/turn",
+            file=report,
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Message search latency: full-text index vs the admin's old ILIKE scan
+
+Fills a throwaway SQLite database (a temp file, so the page cache behaves
+like a real one) with synthetic conversations, then times a user's own
+search through /api/search/'s search_messages, the admin's unscoped
+matching(), and the previous admin search, a substring match on the text.
+
+Usage:
+    python benchmarks/message_search.py --messages 2000000 --users 20000
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+
+COMMON = (
+    "i you the a to and of it is was that my me feel feeling have been "
+    "just like so not but really today about work what do don't know think "
+    "want talk can time day night sleep tired people always never again"
+).split()
+TOPICS = (
+    "anxious anxiety exams stress panic lonely family friends mother father "
+    "job boss school money breathing meditation journal therapy crying angry "
+    "grateful calm hopeful overwhelmed deadline presentation relationship"
+).split()
+RARE = [f"rareword{i}" for i in range(2000)]
+
+QUERIES = [
+    ("common word", "sleep"),
+    ("topic word", "anxious"),
+    ("two words", "exams stress"),
+    ("phrase", '"panic attack"'),
+    ("rare word", "rareword7"),
+]
+
+
+def sentence(rng):
+    words = rng.choices(COMMON, k=rng.randint(6, 14))
+    words += rng.sample(TOPICS, k=rng.randint(1, 3))
+    if rng.random() < 0.05:
+        words += ["panic", "attack"]
+    if rng.random() < 0.01:
+        words.append(rng.choice(RARE))
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+def fill(total, users, seed=7):
+    from companion.models import Message, Session, User
+
+    rng = random.Random(seed)
+    User.objects.bulk_create(User(username=f"user_{i}") for i in range(users))
+    user_ids = list(User.objects.values_list("id", flat=True))
+    sessions = Session.objects.bulk_create(
+        Session(user_id=user_id) for user_id in user_ids
+    )
+    written = 0
+    while written < total:
+        batch = []
+        for _ in range(min(10000, total - written)):
+            session = rng.choice(sessions)
+            batch.append(
+                Message(
+                    session_id=session.id,
+                    user_id=session.user_id,
+                    role=rng.choice(["user", "assistant"]),
+                    text=sentence(rng),
+                )
+            )
+        Message.objects.bulk_create(batch)
+        written += len(batch)
+        print(f"  {written:,} messages", end="\r", file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+    return user_ids
+
+
+def median_ms(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        began = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - began) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django("http://127.0.0.1:9")
+
+    from django.db import connection
+
+    from companion.models import Message
+    from companion.search import matching, search_messages
+
+    directory = tempfile.mkdtemp()
+    connection.settings_dict["TEST"]["NAME"] = os.path.join(
+        directory, "search.sqlite3"
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        connection.creation.create_test_db(verbosity=0)
+
+    began = time.perf_counter()
+    user_ids = fill(args.messages, args.users)
+    print(
+        f"Filled {args.messages:,} messages for {args.users:,} users "
+        f"in {time.perf_counter() - began:.0f}s (FTS kept by triggers)\n"
+    )
+    user_id = random.Random(1).choice(user_ids)
+
+    def legacy(query):
+        # The previous MessageAdmin search: ILIKE over the text for each word
+        queryset = Message.objects.all()
+        for word in query.strip('"').split():
+            queryset = queryset.filter(text__icontains=word)
+        return list(queryset.order_by("-timestamp")[:20])
+
+    print(
+        f"{'query':<12} {'matches':>9} {'user_search_ms':>15} "
+        f"{'admin_fts_ms':>13} {'admin_ilike_ms':>15}"
+    )
+    for label, query in QUERIES:
+        matches = matching(Message.objects.all(), query).count()
+        user_ms = median_ms(
+            lambda: search_messages(query, user_id, limit=20), args.repeats
+        )
+        admin_ms = median_ms(
+            lambda: list(
+                matching(Message.objects.all(), query).order_by("-timestamp")[:20]
+            ),
+            args.repeats,
+        )
+        legacy_ms = median_ms(lambda: legacy(query), args.repeats)
+        print(
+            f"{label:<12} {matches:>9,} {user_ms:>15.2f} "
+            f"{admin_ms:>13.2f} {legacy_ms:>15.2f}",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Register many users with the same full name: sequence allocator vs probe loop
+
+Runs RegisterView against a throwaway in-memory SQLite database. The old
+allocator probed username, username_1, username_2, ... one query at a time,
+so each registration cost grew with the number of namesakes; the sequence
+allocator should stay flat.
+
+Usage:
+    python benchmarks/register_users.py --users 10000 --legacy-users 500
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+
+
+def legacy_register(full_name):
+    """The previous RegisterView allocation: probe until a name is free"""
+    from companion.models import User
+
+    base_username = full_name.lower().replace(" ", "_")
+    username = base_username
+    counter = 1
+    while User.objects.filter(username=username).exists():
+        username = f"{base_username}_{counter}"
+        counter += 1
+    user = User.objects.create_user(username=username, full_name=full_name)
+    user.set_unusable_password()
+    user.save()
+
+
+def run(label, register, total, report_every):
+    from django.db import connection
+
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    print(f"\n{label}")
+    print(f"{'users':>7} {'ms_per_user':>12} {'queries_per_user':>17}")
+    with connection.execute_wrapper(count):
+        for start in range(0, total, report_every):
+            batch = min(report_every, total - start)
+            queries = 0
+            began = time.perf_counter()
+            for _ in range(batch):
+                register()
+            elapsed = time.perf_counter() - began
+            print(
+                f"{start + batch:>7} {elapsed / batch * 1000:>12.2f} "
+                f"{queries / batch:>17.1f}",
+                flush=True,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--legacy-users", type=int, default=500)
+    parser.add_argument("--report-every", type=int, default=1000)
+    args = parser.parse_args()
+
+    setup_django("http://127.0.0.1:9")
+
+    from django.db import connection
+    from rest_framework.test import APIRequestFactory
+
+    from companion.auth_views import RegisterView
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        connection.creation.create_test_db(verbosity=0)
+    factory = APIRequestFactory()
+    view = RegisterView.as_view()
+
+    def register():
+        request = factory.post("/api/auth/register/", {"full_name": "John Doe"})
+        response = view(request)
+        assert response.status_code == 201, response.data
+
+    run("RegisterView (sequence)", register, args.users, args.report_every)
+    if args.legacy_users:
+        run(
+            "Probe loop (previous RegisterView, without the token)",
+            lambda: legacy_register("Jane Doe"),
+            args.legacy_users,
+            min(args.report_every, args.legacy_users),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Peak Python memory per TTS response: buffered synthesize() vs streaming tee()
+
+Runs against the local fake upstream with growing audio sizes. The tee path
+streams chunks to a sink (standing in for the client) while spooling a copy
+that is then stored, so its peak should stay flat as the audio grows.
+
+Usage:
+    python benchmarks/tts_memory.py --sizes 1 4 16
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+from benchmarks.fake_upstream import start_fake_upstream  # noqa: E402
+
+
+def measure(fn):
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    server, base_url = start_fake_upstream(latency=0)
+    os.environ["TTS_CACHE_ENABLED"] = "False"
+    setup_django(base_url)
+
+    from django.core.files.storage import FileSystemStorage
+
+    from audio_processing.registry import registry
+
+    storage = FileSystemStorage(location=tempfile.mkdtemp())
+    tts = registry.tts()
+
+    def buffered():
+        audio_data = tts.synthesize("Hello there, how are you today?")
+        storage.save("buffered.mp3", io.BytesIO(audio_data))
+
+    def streamed():
+        audio_stream, spool = tts.tee("Hello there, how are you today?", "Idera")
+        with spool:
+            for _ in audio_stream:
+                pass
+            storage.save("streamed.mp3", spool.as_file("streamed.mp3"))
+
+    print(f"{'audio_mb':>8} {'buffered_peak_mb':>17} {'tee_peak_mb':>12}")
+    for size in args.sizes:
+        server.audio_bytes = int(size * 1024 * 1024)
+        print(
+            f"{size:>8.1f} {measure(buffered) / 1024**2:>17.2f} "
+            f"{measure(streamed) / 1024**2:>12.2f}"
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
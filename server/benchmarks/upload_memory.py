@@ -0,0 +1,95 @@
+"""
+Peak Python memory per voice upload: buffered bytes vs streamed file handle
+
+Each recording is parsed from a multipart request, sent to the fake Whisper
+endpoint and saved to storage. The buffered path reads the upload into bytes
+for STT and again into a ContentFile for storage (the previous behaviour);
+the streamed path passes the spooled upload handle to both, so its peak
+should stay near the spool threshold as recordings grow.
+
+Usage:
+    python benchmarks/upload_memory.py --sizes 1 5 10 25
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+from benchmarks.fake_upstream import start_fake_upstream  # noqa: E402
+
+
+def measure(fn, request):
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn(request)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        for upload in request.FILES.values():
+            upload.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 5, 10, 25])
+    args = parser.parse_args()
+
+    server, base_url = start_fake_upstream(latency=0)
+    setup_django(base_url)
+
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import FileSystemStorage
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import RequestFactory
+
+    from audio_processing.registry import registry
+    from audio_processing.uploads import AudioUploadLimitHandler, check_audio_upload
+
+    storage = FileSystemStorage(location=tempfile.mkdtemp())
+    stt = registry.stt()
+
+    def build_request(size):
+        audio = SimpleUploadedFile(
+            "recording.webm", b"\x1a" * int(size * 1024**2), "audio/webm"
+        )
+        request = RequestFactory().post("/api/voice_input/", {"audio": audio})
+        request.upload_handlers.insert(0, AudioUploadLimitHandler(request))
+        return request
+
+    def buffered(request):
+        audio_file = request.FILES["audio"]
+        data = audio_file.read()
+        stt.client.audio.transcriptions.create(
+            model="whisper-1", file=(audio_file.name, data, audio_file.content_type)
+        )
+        audio_file.seek(0)
+        storage.save("buffered.webm", ContentFile(audio_file.read()))
+
+    def streamed(request):
+        audio_file = request.FILES["audio"]
+        check_audio_upload(request, audio_file)
+        stt.transcribe(audio_file)
+        storage.save("streamed.webm", audio_file)
+
+    print(f"{'upload_mb':>9} {'buffered_peak_mb':>17} {'streamed_peak_mb':>17}")
+    for size in args.sizes:
+        buffered_peak = measure(buffered, build_request(size))
+        streamed_peak = measure(streamed, build_request(size))
+        print(
+            f"{size:>9.1f} {buffered_peak / 1024**2:>17.2f} "
+            f"{streamed_peak / 1024**2:>17.2f}"
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
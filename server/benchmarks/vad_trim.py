@@ -0,0 +1,75 @@
+"""
+Silence trimmed before STT: seconds and bytes removed vs time spent
+
+Synthesizes Opus recordings with speech-like bursts surrounded by growing
+amounts of background-noise silence and runs them through SpeechTrimmer.
+Needs NumPy and ffmpeg.
+
+Usage:
+    python benchmarks/vad_trim.py --silence 0 2 5 10
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmarks.concurrent_turns import setup_django  # noqa: E402
+
+
+def recording(np, leading, trailing, pause=2.0, sample_rate=16000):
+    rng = np.random.default_rng(0)
+
+    def silence(seconds):
+        return rng.normal(0, 0.002, int(seconds * sample_rate))
+
+    def speech(seconds):
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)
+        voiced = 0.3 * np.sin(2 * np.pi * 180 * t) + 0.1 * np.sin(2 * np.pi * 900 * t)
+        return envelope * voiced + rng.normal(0, 0.02, len(t))
+
+    parts = [silence(leading), speech(2), silence(pause), speech(2), silence(trailing)]
+    return (np.clip(np.concatenate(parts), -1, 1) * 32767).astype(np.int16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--silence", type=float, nargs="+", default=[0, 2, 5, 10])
+    args = parser.parse_args()
+
+    setup_django("http://127.0.0.1:9")
+
+    import numpy as np
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    from audio_processing.vad import SpeechTrimmer, encode_opus, vad_available
+
+    if not vad_available():
+        sys.exit("NumPy and ffmpeg are required")
+
+    trimmer = SpeechTrimmer()
+    print(
+        f"{'silence_s':>9} {'audio_s':>8} {'trimmed_s':>10} "
+        f"{'bytes_in':>9} {'bytes_saved':>12} {'vad_ms':>7}"
+    )
+    for silence in args.silence:
+        data = encode_opus(recording(np, silence, silence))
+        upload = SimpleUploadedFile("recording.ogg", data, "audio/ogg")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, stats = trimmer.process(upload)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(
+            f"{silence * 2:>9.1f} {stats['seconds_in']:>8.1f} "
+            f"{stats['seconds_trimmed']:>10.1f} {stats['bytes_in']:>9} "
+            f"{stats['bytes_saved']:>12} {elapsed:>7.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import itertools
+import json
+import math
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: the gate only coordinates threads of one process
+    fcntl = None
+
+# Upper bounds (seconds) of the queue wait histogram
+WAIT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Waiters re-check the gate with exponential backoff between these; a
+# release in the same process wakes its threads at once
+MIN_POLL = 0.005
+MAX_POLL = 0.05
+# A lease still held after this long is assumed leaked and reclaimed
+LEASE_EXPIRY = 900
+
+_tickets = itertools.count()
+_local_lock = threading.Lock()
+
+
+def _step(waits):
+    """Advance ``AdmissionGate._waits``: (delay, None), or (None, ticket)"""
+    try:
+        return next(waits), None
+    except StopIteration as admitted:
+        # Returned, not raised: StopIteration can't pass through a Future
+        return None, admitted.value
+
+
+class Overloaded(Exception):
+    """A provider's admission queue is full, or a queued call waited too long"""
+
+    def __init__(self, provider, retry_after, queue_full=False):
+        super().__init__(
+            f"{provider} is at capacity, retry in {math.ceil(retry_after)}s"
+        )
+        self.provider = provider
+        self.retry_after = retry_after
+        # False when the call queued but couldn't start within its wait
+        self.queue_full = queue_full
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AdmissionGate:
+    """
+    Concurrency limit, token bucket and bounded FIFO queue for one provider
+
+    The state lives in a small JSON file locked with flock, so every worker
+    process on the host shares one limit: at most ``concurrency`` calls in
+    flight and ``requests_per_minute`` started (bursts of up to ``burst``).
+    Calls that can't start at once queue, first come first served across
+    workers, for up to ``max_wait`` seconds; once ``queue_size`` are waiting,
+    or when the wait can't fit in ``max_wait``, calls fail fast with
+    Overloaded. Leases of processes that died are reclaimed.
+
+    Usage::
+
+        with gate.admit():
+            client.chat.completions.create(...)
+    """
+
+    def __init__(
+        self,
+        name,
+        directory,
+        concurrency,
+        requests_per_minute,
+        queue_size,
+        max_wait,
+        burst=None,
+        clock=time.time,
+    ):
+        """
+        Args:
+            name: Provider name, used for the state file and in errors
+            directory: Directory for state files, shared by the workers
+            concurrency: Most calls in flight at once
+            requests_per_minute: Sustained rate of calls started
+            queue_size: Most calls waiting at once
+            max_wait: Longest a call waits to start, in seconds
+            burst: Token bucket size (defaults to ``concurrency``)
+        """
+        self.name = name
+        self.path = Path(directory) / f"{name}.json"
+        self.concurrency = concurrency
+        self.rate = requests_per_minute / 60
+        self.burst = burst or concurrency
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._released = threading.Condition()
+        self.counters = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected": 0,
+            "timed_out": 0,
+            "wait_seconds": 0.0,
+        }
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Lock the shared state and yield it; changes are written back"""
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        except FileNotFoundError:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with _local_lock if fcntl is None else contextlib.nullcontext():
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = os.pread(fd, 1 << 20, 0)
+                try:
+                    state = json.loads(raw)
+                except ValueError:
+                    state = {}
+                state.setdefault("tokens", self.burst)
+                state.setdefault("updated", self.clock())
+                state.setdefault("leases", {})
+                state.setdefault("queue", [])
+                try:
+                    yield state
+                finally:
+                    # Saved even when raising Overloaded, which may have left
+                    # the queue
+                    data = json.dumps(state, separators=(",", ":")).encode()
+                    os.pwrite(fd, data, 0)
+                    os.ftruncate(fd, len(data))
+            finally:
+                os.close(fd)  # Also releases the flock
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state["updated"])
+        state["tokens"] = min(self.burst, state["tokens"] + elapsed * self.rate)
+        state["updated"] = now
+
+    def _reap(self, state, now):
+        """Drop leases and queue entries of dead processes, or long expired"""
+        state["leases"] = {
+            ticket: lease
+            for ticket, lease in state["leases"].items()
+            if now - lease[1] < LEASE_EXPIRY and _pid_alive(lease[0])
+        }
+        state["queue"] = [
+            entry
+            for entry in state["queue"]
+            if entry[2] > now - 1 and _pid_alive(entry[1])
+        ]
+
+    def _attempt(self, ticket, deadline):
+        """
+        Try to start, joining the queue if that isn't possible yet
+
+        Returns:
+            float: 0 once admitted, else how long to wait before trying again
+
+        Raises:
+            Overloaded: The queue is full, or the wait can't fit the deadline
+        """
+        with self._state() as state:
+            # Read under the lock, so the bucket's clock only moves forward
+            now = self.clock()
+            self._refill(state, now)
+            for reaped in [False, True]:
+                queue = state["queue"]
+                position = next(
+                    (i for i, entry in enumerate(queue) if entry[0] == ticket), None
+                )
+                ahead = len(queue) if position is None else position
+                free = self.concurrency - len(state["leases"])
+                if ahead < free and state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    state["leases"][ticket] = [os.getpid(), now]
+                    if position is not None:
+                        del queue[position]
+                    return 0
+                # Blocked: check for slots held by dead workers, at most once
+                # a second
+                if reaped or now - state.get("reaped", 0) < 1:
+                    break
+                state["reaped"] = now
+                self._reap(state, now)
+
+            # Time until there are tokens for everyone ahead of us, and us
+            wait = max(0.0, (ahead + 1 - state["tokens"]) / self.rate)
+            if position is None:
+                if len(queue) >= self.queue_size:
+                    raise Overloaded(self.name, max(wait, 1), queue_full=True)
+                if now + wait > deadline:
+                    raise Overloaded(self.name, max(wait, 1))
+                queue.append([ticket, os.getpid(), deadline])
+            elif now + wait > deadline:
+                del queue[position]
+                raise Overloaded(self.name, max(wait, 1))
+            return max(wait, MIN_POLL)
+
+    def _release(self, ticket):
+        with self._state() as state:
+            freed = state["leases"].pop(ticket, None) is not None
+            state["queue"] = [e for e in state["queue"] if e[0] != ticket]
+        if freed:
+            with self._released:
+                self._released.notify_all()
+
+    def _record(self, outcome, waited=0.0):
+        with self._lock:
+            self.counters[outcome] += 1
+            if outcome in ("admitted", "timed_out"):
+                self.counters["wait_seconds"] += waited
+                self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS, waited)] += 1
+
+    def _waits(self, max_wait=None):
+        """
+        Drive one admission: yields how long to sleep between attempts, and
+        returns the ticket to release once admitted
+        """
+        ticket = f"{os.getpid()}-{next(_tickets)}"
+        began = self.clock()
+        if max_wait is None or max_wait > self.max_wait:
+            max_wait = self.max_wait
+        deadline = began + max_wait
+        delay = MIN_POLL
+        queued = False
+        try:
+            while True:
+                wait = self._attempt(ticket, deadline)
+                if not wait:
+                    break
+                if not queued:
+                    queued = True
+                    self._record("queued")
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    raise Overloaded(self.name, max(wait, 1))
+                yield min(max(wait, delay), remaining)
+                delay = min(delay * 2, MAX_POLL)
+        except Overloaded:
+            self._release(ticket)
+            if queued:
+                self._record("timed_out", self.clock() - began)
+            else:
+                self._record("rejected")
+            raise
+        except BaseException:
+            self._release(ticket)
+            raise
+        self._record("admitted", self.clock() - began)
+        return ticket
+
+    @contextlib.contextmanager
+    def admit(self, max_wait=None):
+        """
+        Hold one of the provider's slots for the duration of the block
+
+        Args:
+            max_wait: Wait at most this long to start, if shorter than the
+                gate's own ``max_wait`` (to fit a request's deadline)
+        """
+        with contextlib.closing(self._waits(max_wait)) as waits:
+            try:
+                while True:
+                    delay = next(waits)
+                    with self._released:
+                        self._released.wait(delay)
+            except StopIteration as admitted:
+                ticket = admitted.value
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    async def _await_turn(self, max_wait=None):
+        """
+        Async variant of the wait in ``admit``. Each attempt takes the file
+        lock, which another worker may hold, so it runs in a thread
+
+        Returns:
+            str: The ticket to release
+        """
+        waits = self._waits(max_wait)
+        try:
+            while True:
+                step = asyncio.ensure_future(asyncio.to_thread(_step, waits))
+                try:
+                    delay, ticket = await asyncio.shield(step)
+                except asyncio.CancelledError:
+                    # The attempt carries on in its thread: let it finish
+                    # before the generator is closed, and hand back a slot
+                    # it took
+                    with contextlib.suppress(Overloaded):
+                        _, ticket = await step
+                        if ticket is not None:
+                            await asyncio.to_thread(self._release, ticket)
+                    raise
+                if delay is None:
+                    return ticket
+                await asyncio.sleep(delay)
+        finally:
+            if waits.gi_frame is not None:
+                # Cancelled while queued: give up the place in the queue
+                await asyncio.to_thread(waits.close)
+
+    @contextlib.asynccontextmanager
+    async def aadmit(self, max_wait=None):
+        """Async variant of ``admit``; the event loop never waits on the lock"""
+        ticket = await self._await_turn(max_wait)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._release, ticket)
+
+    def stats(self):
+        """Shared queue depth and slots in use, plus this worker's counters"""
+        with self._state() as state:
+            self._refill(state, self.clock())
+            shared = {
+                "in_flight": len(state["leases"]),
+                "queue_depth": len(state["queue"]),
+                "tokens": round(state["tokens"], 2),
+            }
+        with self._lock:
+            counters = dict(self.counters)
+            buckets = list(self.wait_buckets)
+        return {
+            **shared,
+            "concurrency": self.concurrency,
+            "requests_per_minute": round(self.rate * 60),
+            "queue_size": self.queue_size,
+            "pid": os.getpid(),
+            **counters,
+            "wait_histogram": dict(
+                zip([str(bound) for bound in WAIT_BUCKETS] + ["+Inf"], buckets)
+            ),
+        }
+
+    def counts(self):
+        """This worker's counters and wait histogram (bucket counts), copied"""
+        with self._lock:
+            return dict(self.counters), list(self.wait_buckets)
+
+
+class _Finished:
+    """End of a read-ahead stream, with the error that ended it if any"""
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def read_ahead(chunks):
+    """
+    Iterate the generator ``chunks`` in a worker thread, buffering whatever
+    the caller has not taken yet
+
+    A stream read under ``admit`` then finishes, and frees its slot, at the
+    provider's pace rather than the caller's: a turn speaking each sentence
+    as it arrives, or a client downloading slowly, doesn't keep the slot.
+    Errors are raised to the caller in order; if the caller stops early, the
+    worker closes ``chunks`` after the next chunk arrives.
+    """
+    buffered = queue.SimpleQueue()
+    stopped = threading.Event()
+
+    def pump():
+        error = None
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    break
+                buffered.put(chunk)
+        except BaseException as e:
+            error = e
+        finally:
+            chunks.close()
+            buffered.put(_Finished(error))
+
+    # In the caller's context, so its records keep the request ID
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(pump,), daemon=True).start()
+    try:
+        while True:
+            chunk = buffered.get()
+            if isinstance(chunk, _Finished):
+                if chunk.error is not None:
+                    raise chunk.error
+                return
+            yield chunk
+    finally:
+        stopped.set()
+
+
+async def aread_ahead(chunks):
+    """Async variant of ``read_ahead``, pumping in a task on the same loop"""
+    buffered = asyncio.Queue()
+
+    async def pump():
+        error = None
+        try:
+            async for chunk in chunks:
+                buffered.put_nowait(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            await chunks.aclose()
+        buffered.put_nowait(_Finished(error))
+
+    task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            chunk = await buffered.get()
+            if isinstance(chunk, _Finished):
+                if chunk.error is not None:
+                    raise chunk.error
+                return
+            yield chunk
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+
+class Unlimited:
+    """Stand-in gate for services built without admission control"""
+
+    name = "unlimited"
+
+    def admit(self, max_wait=None):
+        return contextlib.nullcontext()
+
+    def aadmit(self, max_wait=None):
+        return contextlib.nullcontext()
+
+
+UNLIMITED = Unlimited()
@@ -0,0 +1,48 @@
+import tempfile
+
+from django.core.files import File
+
+
+class AudioSpool:
+    """
+    Bounded buffer for audio that is streamed to a client and also stored
+
+    ``tee`` passes chunks straight through while appending them to a
+    SpooledTemporaryFile, which stays in memory up to ``max_memory`` bytes and
+    spills to a temp file beyond that. Storage backends then read the spool
+    in chunks, so no step holds the whole response in one bytes object.
+    """
+
+    def __init__(self, max_memory=1024 * 1024):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self.size = 0
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def tee(self, chunks):
+        """Yield ``chunks`` unchanged, keeping a copy in the spool"""
+        for chunk in chunks:
+            self.write(chunk)
+            yield chunk
+
+    async def atee(self, chunks):
+        """Async variant of tee for an async iterable of chunks"""
+        async for chunk in chunks:
+            self.write(chunk)
+            yield chunk
+
+    def as_file(self, name):
+        """Rewind and wrap the spool for ``FieldFile.save``"""
+        self.file.seek(0)
+        return File(self.file, name=name)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
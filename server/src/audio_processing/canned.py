@@ -0,0 +1,101 @@
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from .sentences import iter_sentences
+from .tts_cache import cache_key
+
+# Fixed lines from the system prompt, spoken verbatim by the LLM
+WELCOME = (
+    "I'm here with you. This space is for calm reflection. "
+    "I'm not a therapist, but I can support you. Shall we begin?"
+)
+CRISIS = (
+    "I'm really sorry you're feeling like this. I'm here with you. "
+    "If you feel unsafe, please consider reaching out to a mental-health "
+    "professional or emergency services in Nigeria right now."
+)
+CRISIS_ENDING = (
+    "I care about your safety. You deserve real support. "
+    "Please reach out to someone who can help you immediately."
+)
+
+# Replies used when the LLM provider fails
+FALLBACK_TIMEOUT = (
+    "I'm having trouble connecting right now. "
+    "Could you please try again in a moment?"
+)
+FALLBACK_RATE_LIMIT = "I need a moment to catch my breath. Please try again shortly."
+FALLBACK_ERROR = (
+    "I'm having a small technical difficulty. Could you please repeat that?"
+)
+
+CANNED_UTTERANCES = {
+    "welcome": WELCOME,
+    "crisis": CRISIS,
+    "crisis_ending": CRISIS_ENDING,
+    "fallback_timeout": FALLBACK_TIMEOUT,
+    "fallback_rate_limit": FALLBACK_RATE_LIMIT,
+    "fallback_error": FALLBACK_ERROR,
+}
+
+
+def canned_texts():
+    """
+    Every text worth pre-rendering: each utterance whole, plus each of its
+    sentences so the sentence-chunked streaming path hits the store too
+    """
+    texts = []
+    for text in CANNED_UTTERANCES.values():
+        for candidate in [text, *iter_sentences([text])]:
+            if candidate not in texts:
+                texts.append(candidate)
+    return texts
+
+
+class CannedAudioStore:
+    """
+    Read-mostly store of pre-rendered audio, one directory per voice
+
+    Files are named by the same content hash as the TTS cache, so any
+    synthesis whose text matches a canned utterance is served from here
+    without touching YarnGPT. Files are loaded into memory on first use.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._audio = None
+
+    def _load(self):
+        audio = {}
+        if self.directory.is_dir():
+            for path in self.directory.glob("*/*.mp3"):
+                audio[path.stem] = path.read_bytes()
+        return audio
+
+    def get(self, voice, text):
+        if self._audio is None:
+            with self._lock:
+                if self._audio is None:
+                    self._audio = self._load()
+        return self._audio.get(cache_key(voice, text))
+
+    def path(self, voice, text):
+        return self.directory / voice.capitalize() / f"{cache_key(voice, text)}.mp3"
+
+    def save(self, voice, text, data):
+        path = self.path(voice, text)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            if self._audio is not None:
+                self._audio[path.stem] = data
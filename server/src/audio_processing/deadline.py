@@ -0,0 +1,207 @@
+import contextlib
+import math
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+
+from .admission import Overloaded
+
+# Client-chosen turn deadline, in seconds
+DEADLINE_HEADER = "X-Request-Timeout"
+
+
+class DeadlineExceeded(Exception):
+    """Too little of the turn's time is left for a stage to run at all"""
+
+    def __init__(self, stage, remaining):
+        super().__init__(
+            f"{stage} skipped: deadline exceeded ({max(remaining, 0):.1f}s left)"
+        )
+        self.stage = stage
+        self.remaining = remaining
+
+
+class Deadline:
+    """
+    The time left for one voice turn, passed down to every stage
+
+    Stages ask for a ``budget``: a timeout (and retry count) that fits the
+    time remaining, less what later stages need. A stage that can't get its
+    minimum raises DeadlineExceeded, and the turn degrades instead: TTS is
+    skipped first, then the LLM gives way to a canned reply.
+    """
+
+    def __init__(self, seconds, clock=time.monotonic):
+        self.seconds = seconds
+        self.clock = clock
+        self.expires = clock() + seconds
+
+    @classmethod
+    def for_request(cls, request):
+        """
+        The deadline from the ``X-Request-Timeout`` header, clamped to
+        DEADLINE_MIN_SECONDS..DEADLINE_MAX_SECONDS, or DEADLINE_SLO_SECONDS
+        without a finite number there
+        """
+        seconds = settings.DEADLINE_SLO_SECONDS
+        try:
+            requested = float(request.headers.get(DEADLINE_HEADER) or seconds)
+        except ValueError:
+            requested = seconds
+        # nan would slip through the clamp below (it compares False)
+        if math.isfinite(requested):
+            seconds = requested
+        return cls(
+            min(
+                max(seconds, settings.DEADLINE_MIN_SECONDS),
+                settings.DEADLINE_MAX_SECONDS,
+            )
+        )
+
+    def remaining(self):
+        return max(0.0, self.expires - self.clock())
+
+    def budget(
+        self, stage, timeout, retries=0, reserve=0.0, minimum=1.0, expected=None
+    ):
+        """
+        Timeout and retries for one stage
+
+        Args:
+            stage: Stage name, for DeadlineExceeded
+            timeout: The stage's configured timeout per attempt
+            retries: The stage's configured retries
+            reserve: Seconds to leave for the stages after this one
+            minimum: Fewest seconds worth starting the stage with
+            expected: How long an attempt usually takes (e.g. the recent
+                p95), if known; retries are only kept while that many
+                attempts fit
+
+        Returns:
+            tuple: (timeout, retries), sized so that every attempt timing
+            out still ends within the time available
+
+        Raises:
+            DeadlineExceeded: Less than ``minimum`` seconds are left
+        """
+        available = self.remaining() - reserve
+        if available < minimum:
+            raise DeadlineExceeded(stage, available)
+        expected = min(expected or timeout, timeout)
+        retries = max(0, min(retries, int(available / expected) - 1))
+        return min(timeout, available / (retries + 1)), retries
+
+    def _set_statement_timeout(self, seconds):
+        if connection.vendor != "postgresql":
+            return
+        with connection.cursor() as cursor:
+            if seconds is None:
+                cursor.execute("RESET statement_timeout")
+            else:
+                # SET takes no bind parameters; this is always an int
+                cursor.execute(f"SET statement_timeout = {int(seconds * 1000)}")
+
+    @contextlib.contextmanager
+    def database(self):
+        """
+        Cut off the block's queries once the deadline passes (PostgreSQL
+        only). At least DEADLINE_DB_SECONDS are allowed, since a turn's
+        messages are saved even when it ran late
+        """
+        self._set_statement_timeout(max(self.remaining(), settings.DEADLINE_DB_SECONDS))
+        try:
+            yield
+        finally:
+            self._set_statement_timeout(None)
+
+    @contextlib.asynccontextmanager
+    async def adatabase(self):
+        """Async variant of ``database``, for the connection async ORM calls use"""
+        await sync_to_async(self._set_statement_timeout)(
+            max(self.remaining(), settings.DEADLINE_DB_SECONDS)
+        )
+        try:
+            yield
+        finally:
+            await sync_to_async(self._set_statement_timeout)(None)
+
+
+def max_wait(deadline, reserve=0.0, minimum=1.0):
+    """
+    Longest a stage may queue for admission and still get ``minimum``
+    seconds (None, the gate's own limit, without a deadline)
+    """
+    if deadline is None:
+        return None
+    return max(0.0, deadline.remaining() - reserve - minimum)
+
+
+def _cut_short_by(deadline, gate, wait, error):
+    """Whether ``deadline``, not ``gate``, kept an admission from waiting"""
+    if deadline is None:
+        return False
+    return not wait or (not error.queue_full and wait < gate.max_wait)
+
+
+@contextlib.contextmanager
+def admit(gate, deadline, stage, reserve=0.0, minimum=1.0):
+    """
+    Hold one of ``gate``'s slots for the block, queueing only as long as
+    ``deadline`` still leaves ``stage`` its ``minimum`` seconds
+
+    Raises:
+        Overloaded: The gate's queue is full, or its own wait ran out
+        DeadlineExceeded: The gate is busy and the deadline leaves no time
+            to wait, so the turn degrades as for any stage out of time
+    """
+    wait = max_wait(deadline, reserve, minimum)
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(gate.admit(wait))
+        except Overloaded as e:
+            if not _cut_short_by(deadline, gate, wait, e):
+                raise
+            raise DeadlineExceeded(stage, deadline.remaining() - reserve) from e
+        yield
+
+
+@contextlib.asynccontextmanager
+async def aadmit(gate, deadline, stage, reserve=0.0, minimum=1.0):
+    """Async variant of ``admit``"""
+    wait = max_wait(deadline, reserve, minimum)
+    async with contextlib.AsyncExitStack() as stack:
+        try:
+            await stack.enter_async_context(gate.aadmit(wait))
+        except Overloaded as e:
+            if not _cut_short_by(deadline, gate, wait, e):
+                raise
+            raise DeadlineExceeded(stage, deadline.remaining() - reserve) from e
+        yield
+
+
+def openai_options(deadline, stage, reserve=0.0, expected=None):
+    """
+    Timeout and retries for one OpenAI call under ``deadline``
+
+    Returns:
+        tuple: (``with_options`` keyword arguments, {} without a deadline;
+        whether the timeout was cut below OPENAI_TIMEOUT to fit)
+    """
+    if deadline is None:
+        return {}, False
+    timeout, retries = deadline.budget(
+        stage,
+        settings.OPENAI_TIMEOUT,
+        settings.OPENAI_MAX_RETRIES,
+        reserve=reserve,
+        expected=expected,
+    )
+    connect = min(timeout, settings.UPSTREAM_CONNECT_TIMEOUT)
+    options = {
+        "timeout": httpx.Timeout(timeout, connect=connect),
+        "max_retries": retries,
+    }
+    return options, timeout < settings.OPENAI_TIMEOUT
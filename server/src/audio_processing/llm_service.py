@@ -1,18 +1,20 @@
+import logging
 import os
 
-from openai import OpenAI
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
 
+from .admission import UNLIMITED, Overloaded, aread_ahead, read_ahead
+from .canned import FALLBACK_ERROR, FALLBACK_RATE_LIMIT, FALLBACK_TIMEOUT
+from .deadline import DeadlineExceeded, aadmit, admit, openai_options
+from .metrics import metrics
+from .prompt import PromptBuilder
+from .resilience import DIRECT, BreakerOpen
 
-class LLMService:
-    """LLM service using OpenAI GPT-4"""
+logger = logging.getLogger(__name__)
 
-    def __init__(self):
-        self.client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            timeout=1800,  # 1800 second timeout
-            max_retries=2,  # Retry failed requests up to 2 times
-        )
-        self.system_prompt = """You are SafeHaven Companion, a voice-first wellbeing and reflection partner with a calm, warm presence and a touch of Nigerian relatability.
+SYSTEM_PROMPT = """You are SafeHaven Companion, a voice-first wellbeing and reflection partner with a calm, warm presence and a touch of Nigerian relatability.
 
 Your role is to support emotional wellbeing, help the user reflect, provide comfort, and gently guide them toward small, healthy next steps.
 You are NOT a therapist, doctor, legal advisor, or emergency service.
@@ -278,38 +280,359 @@ If user keeps escalating:
 Stop all normal flow.
 """
 
-    def get_response(self, user_input, conversation_history=None):
+SUMMARY_PROMPT = """You keep a running summary of a conversation between a user and SafeHaven Companion, a wellbeing companion.
+
+Update the existing summary with the new messages. Keep what matters for continuing the conversation: the user's name and situation, feelings they named, topics explored, suggestions made and how they landed, and any safety concerns. Write plain prose in the third person, under 120 words. Reply with the summary only."""
+
+
+def openai_timeout():
+    """Per-read timeout for OpenAI calls; a stalled provider fails fast"""
+    return httpx.Timeout(
+        settings.OPENAI_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT
+    )
+
+
+class LLMService:
+    """LLM service using OpenAI GPT-4"""
+
+    def __init__(
+        self,
+        client=None,
+        prompt_builder=None,
+        summary_model="gpt-4o-mini",
+        gate=UNLIMITED,
+        resilience=DIRECT,
+    ):
+        self.client = client or OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=openai_timeout(),
+            max_retries=settings.OPENAI_MAX_RETRIES,
+        )
+        self.system_prompt = SYSTEM_PROMPT
+        self.prompt_builder = prompt_builder or PromptBuilder(SYSTEM_PROMPT)
+        self.summary_model = summary_model
+        # AdmissionGate for OpenAI; rejected calls never reach the provider
+        self.gate = gate
+        # Circuit breaker and hedging for chat completions
+        self.resilience = resilience
+
+    def _build_messages(self, user_input, conversation_history=None, summary=""):
+        messages, stats = self.prompt_builder.build(
+            user_input, conversation_history, summary
+        )
+        logger.debug(
+            "Prompt: %d tokens, %d history messages (%d dropped)%s",
+            stats["prompt_tokens"],
+            stats["history_messages"],
+            stats["dropped_messages"],
+            ", with summary" if summary else "",
+        )
+        return messages
+
+    def _log_usage(self, usage):
+        """Report the provider's token counts, including prompt cache hits"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        metrics.inc("llm_tokens_total", usage.prompt_tokens, kind="prompt")
+        metrics.inc("llm_tokens_total", cached, kind="cached")
+        metrics.inc("llm_tokens_total", usage.completion_tokens, kind="completion")
+        logger.debug(
+            "LLM usage: %d prompt tokens (%d cached), %d completion tokens",
+            usage.prompt_tokens,
+            cached,
+            usage.completion_tokens,
+        )
+
+    def _summary_messages(self, summary, messages):
+        transcript = "\n".join(
+            f"{message['role'].capitalize()}: {message['content']}"
+            for message in messages
+        )
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"Existing summary:\n{summary or '(none)'}\n\n"
+                f"New messages:\n{transcript}",
+            },
+        ]
+
+    def _fallback_response(self, error):
+        """Map an upstream failure to a graceful spoken reply"""
+        error_msg = str(error)
+        logger.warning("LLM error: %s", error_msg)
+
+        # These replies are pre-rendered per voice (see canned.py), so they
+        # are spoken instantly even while the providers are degraded
+        if isinstance(error, BreakerOpen):
+            return FALLBACK_TIMEOUT
+        if isinstance(error, Overloaded):
+            # Only streamed replies get here; get_response raises to a 503
+            return FALLBACK_RATE_LIMIT
+        if isinstance(error, DeadlineExceeded):
+            return FALLBACK_TIMEOUT
+        if "timed out" in error_msg.lower() or "timeout" in error_msg.lower():
+            return FALLBACK_TIMEOUT
+        elif "rate limit" in error_msg.lower():
+            return FALLBACK_RATE_LIMIT
+        else:
+            return FALLBACK_ERROR
+
+    def _client(self, deadline):
+        """
+        The client with a timeout and retries that leave time to save the
+        turn, and whether they were cut short to fit
+
+        Raises:
+            DeadlineExceeded: Too little time is left; the canned reply is used
+        """
+        options, cut_short = openai_options(
+            deadline,
+            "llm",
+            settings.DEADLINE_DB_SECONDS,
+            self.resilience.expected_latency(),
+        )
+        return self.client.with_options(**options), cut_short
+
+    def _admit(self, deadline):
+        return admit(self.gate, deadline, "llm", settings.DEADLINE_DB_SECONDS)
+
+    def _aadmit(self, deadline):
+        return aadmit(self.gate, deadline, "llm", settings.DEADLINE_DB_SECONDS)
+
+    def get_response(
+        self, user_input, conversation_history=None, summary="", deadline=None
+    ):
         """
         Get LLM response for user input
 
         Args:
             user_input: User's message
             conversation_history: List of previous messages (optional)
+            summary: Rolling summary of older turns (optional)
+            deadline: The turn's Deadline (optional); when it runs out the
+                canned "trouble connecting" reply is returned
 
         Returns:
-            str: LLM response text
+            str: LLM response text (the canned "trouble connecting" reply
+            while the LLM circuit is open)
+
+        Raises:
+            Overloaded: OpenAI's admission queue is full (nothing was sent)
         """
         try:
-            messages = [{"role": "system", "content": self.system_prompt}]
+            messages = self._build_messages(user_input, conversation_history, summary)
+
+            with self._admit(deadline):
+                client, cut_short = self._client(deadline)
+                response = self.resilience.call(
+                    lambda: client.chat.completions.create(
+                        model="gpt-4o",
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=200,
+                    ),
+                    blame_timeouts=not cut_short,
+                )
+            self._log_usage(response.usage)
 
-            if conversation_history:
-                messages.extend(conversation_history)
+            return response.choices[0].message.content
+        except BreakerOpen as e:
+            # Nothing was sent; the canned reply is spoken at once
+            return self._fallback_response(e)
+        except Overloaded:
+            raise
+        except Exception as e:
+            # Return a graceful fallback message instead of crashing
+            return self._fallback_response(e)
 
-            messages.append({"role": "user", "content": user_input})
+    def stream_response(
+        self, user_input, conversation_history=None, summary="", deadline=None
+    ):
+        """
+        Stream LLM response text as it is generated
 
+        Args:
+            user_input: User's message
+            conversation_history: List of previous messages (optional)
+            summary: Rolling summary of older turns (optional)
+            deadline: The turn's Deadline (optional); the reply is cut off
+                where it stands once it passes
+
+        Yields:
+            str: Response text deltas, in order (the canned "trouble
+            connecting" reply while the LLM circuit is open, and the "busy"
+            one if OpenAI's admission queue is full, since headers are
+            already sent)
+        """
+        emitted = False
+        try:
+            messages = self._build_messages(user_input, conversation_history, summary)
+
+            # Read ahead, so the slot is freed when OpenAI finishes rather
+            # than when the caller, speaking each sentence, gets to the end
+            for delta in read_ahead(self._stream_deltas(messages, deadline)):
+                emitted = True
+                yield delta
+        except Exception as e:
+            # Only fall back if the user has not heard anything yet; a reply
+            # cut off mid-way is better left as-is than patched with an apology
+            if not emitted:
+                yield self._fallback_response(e)
+            else:
+                logger.warning("LLM stream interrupted: %s", e)
+
+    def _stream_deltas(self, messages, deadline):
+        """Text deltas from OpenAI, holding an admission slot throughout"""
+        # The breaker (and any hedge) covers opening the stream, up to the
+        # response headers
+        with self._admit(deadline):
+            client, cut_short = self._client(deadline)
+            stream = self.resilience.call(
+                lambda: client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=200,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                ),
+                discard=lambda stream: stream.close(),
+                blame_timeouts=not cut_short,
+            )
+
+            for chunk in stream:
+                if deadline is not None and not deadline.remaining():
+                    stream.close()
+                    raise DeadlineExceeded("llm", 0)
+                if not chunk.choices:
+                    self._log_usage(getattr(chunk, "usage", None))
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+    def summarize(self, summary, messages):
+        """
+        Fold messages into a session's rolling summary
+
+        Args:
+            summary: The current summary ("" if none)
+            messages: Messages to add, oldest first, as role/content dicts
+
+        Returns:
+            str: The updated summary
+
+        Raises:
+            Exception: On provider errors (there is no spoken fallback here)
+        """
+        with self.gate.admit():
             response = self.client.chat.completions.create(
-                model="gpt-4o", messages=messages, temperature=0.7, max_tokens=200
+                model=self.summary_model,
+                messages=self._summary_messages(summary, messages),
+                temperature=0.3,
+                max_tokens=200,
             )
+        return response.choices[0].message.content.strip()
+
+
+class AsyncLLMService(LLMService):
+    """LLM service using OpenAI GPT-4 (asyncio)"""
+
+    def __init__(
+        self,
+        client=None,
+        prompt_builder=None,
+        summary_model="gpt-4o-mini",
+        gate=UNLIMITED,
+        resilience=DIRECT,
+    ):
+        self.client = client or AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=openai_timeout(),
+            max_retries=settings.OPENAI_MAX_RETRIES,
+        )
+        self.system_prompt = SYSTEM_PROMPT
+        self.prompt_builder = prompt_builder or PromptBuilder(SYSTEM_PROMPT)
+        self.summary_model = summary_model
+        self.gate = gate
+        self.resilience = resilience
+
+    async def aclose(self):
+        """Close the underlying HTTP client before the event loop goes away"""
+        await self.client.close()
+
+    async def get_response(
+        self, user_input, conversation_history=None, summary="", deadline=None
+    ):
+        """Async variant of LLMService.get_response"""
+        try:
+            messages = self._build_messages(user_input, conversation_history, summary)
+
+            async with self._aadmit(deadline):
+                client, cut_short = self._client(deadline)
+                response = await self.resilience.acall(
+                    lambda: client.chat.completions.create(
+                        model="gpt-4o",
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=200,
+                    ),
+                    blame_timeouts=not cut_short,
+                )
+            self._log_usage(response.usage)
 
             return response.choices[0].message.content
+        except BreakerOpen as e:
+            return self._fallback_response(e)
+        except Overloaded:
+            raise
         except Exception as e:
-            error_msg = str(e)
-            print(f"LLM Error: {error_msg}")
-            
-            # Return a graceful fallback message instead of crashing
-            if "timed out" in error_msg.lower() or "timeout" in error_msg.lower():
-                return "I'm having trouble connecting right now. Could you please try again in a moment?"
-            elif "rate limit" in error_msg.lower():
-                return "I need a moment to catch my breath. Please try again shortly."
+            return self._fallback_response(e)
+
+    async def stream_response(
+        self, user_input, conversation_history=None, summary="", deadline=None
+    ):
+        """Async variant of LLMService.stream_response"""
+        emitted = False
+        try:
+            messages = self._build_messages(user_input, conversation_history, summary)
+
+            async for delta in aread_ahead(self._stream_deltas(messages, deadline)):
+                emitted = True
+                yield delta
+        except Exception as e:
+            if not emitted:
+                yield self._fallback_response(e)
             else:
-                return "I'm having a small technical difficulty. Could you please repeat that?"
+                logger.warning("LLM stream interrupted: %s", e)
+
+    async def _stream_deltas(self, messages, deadline):
+        """Async variant of LLMService._stream_deltas"""
+        async with self._aadmit(deadline):
+            client, cut_short = self._client(deadline)
+            stream = await self.resilience.acall(
+                lambda: client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=200,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                ),
+                discard=lambda stream: stream.close(),
+                blame_timeouts=not cut_short,
+            )
+
+            async for chunk in stream:
+                if deadline is not None and not deadline.remaining():
+                    await stream.close()
+                    raise DeadlineExceeded("llm", 0)
+                if not chunk.choices:
+                    self._log_usage(getattr(chunk, "usage", None))
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from audio_processing.canned import canned_texts
+from audio_processing.registry import registry
+from audio_processing.tts_service import TTSService
+from companion.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Pre-render the welcome, crisis and fallback utterances for every voice "
+        "so the voice pipeline can serve them without calling YarnGPT"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--voice",
+            action="append",
+            dest="voices",
+            help="Only render this voice (repeatable). Defaults to all voices.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-render utterances that already exist in the store",
+        )
+
+    def handle(self, *args, voices=None, force=False, **options):
+        all_voices = [voice for voice, _ in User.VOICE_CHOICES]
+        voices = voices or all_voices
+        unknown = set(voices) - set(all_voices)
+        if unknown:
+            raise CommandError(f"Unknown voice(s): {', '.join(sorted(unknown))}")
+
+        store = registry.canned_audio()
+        # Bypass the canned store and cache so every render hits YarnGPT
+        tts = TTSService(session=registry.yarngpt_session())
+        texts = canned_texts()
+
+        rendered = skipped = failed = 0
+        for voice in voices:
+            for text in texts:
+                if not force and store.path(voice, text).exists():
+                    skipped += 1
+                    continue
+                try:
+                    store.save(voice, text, tts.synthesize(text, voice))
+                    rendered += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"{voice}: {text[:40]}... failed: {e}")
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rendered {rendered}, skipped {skipped}, failed {failed} "
+                f"({len(texts)} utterances x {len(voices)} voices) "
+                f"into {store.directory}"
+            )
+        )
@@ -0,0 +1,300 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from .admission import _pid_alive
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the stage latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PREFIX = "mindvoice"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HELP = {
+    "stage_seconds": "Time spent in each stage of a voice turn",
+    "upstream_bytes_total": "Audio bytes sent to STT and received from TTS",
+    "llm_tokens_total": "OpenAI chat tokens used (cached is part of prompt)",
+    "admission_events_total": "Calls admitted, queued, rejected or timed out",
+    "admission_wait_seconds": "Time calls queued at a provider's admission gate",
+    "upstream_events_total": "Calls, failures, refusals and hedges per service",
+    "circuit_opened_total": "Times a service's circuit breaker opened",
+    "circuit_open": "Workers with the service's circuit open",
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample(name, labels, value):
+    if labels:
+        pairs = ",".join(f'{key}="{_escape(val)}"' for key, val in labels)
+        name = f"{name}{{{pairs}}}"
+    if float(value).is_integer():
+        value = int(value)
+    return f"{name} {value}"
+
+
+class Metrics:
+    """
+    Counters and histograms of this worker, added up across workers on scrape
+
+    Recording only updates a dict under a lock. Every ``flush_interval``
+    seconds a background thread writes the worker's totals to
+    ``<directory>/<pid>.json`` (replaced atomically), and ``render`` adds up
+    the files of every worker on the host, so a scrape sees all of gunicorn
+    whichever worker answers it. Files of exited workers are kept so
+    counters never go backwards; only their gauges are dropped. Clear the
+    directory when the server starts (gunicorn.conf.py does).
+
+    Usage::
+
+        with metrics.span("llm", voice="Idera", input="audio"):
+            reply = llm_service.get_response(...)
+    """
+
+    def __init__(self, directory=None, flush_interval=None):
+        """
+        Args:
+            directory: Directory shared by the workers (METRICS_DIR)
+            flush_interval: Seconds between writes of this worker's file
+                (METRICS_FLUSH_SECONDS)
+        """
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._counters = {}
+        self._histograms = {}
+        self._flusher = None
+
+    @property
+    def directory(self):
+        return Path(self._directory or settings.METRICS_DIR)
+
+    def _record(self):
+        """The lock, after making sure this process' state and flusher exist"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Forked: the parent's totals are already in its file
+                    self._reset()
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flush_forever, name="metrics", daemon=True
+                    )
+                    self._flusher.start()
+        return self._lock
+
+    def _flush_forever(self):
+        interval = self._flush_interval or settings.METRICS_FLUSH_SECONDS
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def register(self, collector):
+        """
+        Add samples read at flush time from counters kept elsewhere
+
+        Args:
+            collector: Returns an iterable of (kind, name, labels, value);
+                kind is "counter" or "gauge", or "histogram" with value
+                (bounds, counts per bucket, sum)
+        """
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        if not settings.METRICS_ENABLED:
+            return
+        key = _key(name, labels)
+        with self._record():
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not settings.METRICS_ENABLED:
+            return
+        key = _key(name, labels)
+        with self._record():
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [
+                    buckets,
+                    [0] * (len(buckets) + 1),
+                    0.0,
+                ]
+            histogram[1][bisect.bisect_left(buckets, value)] += 1
+            histogram[2] += value
+
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        """Time the block into ``stage_seconds``, whether or not it raises"""
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe_since(began, stage, labels)
+
+    def first(self, items, stage, **labels):
+        """
+        Pass ``items`` through, timing into ``stage_seconds`` how long the
+        first one took (time to first audio of a stream, say)
+        """
+        began = time.perf_counter()
+        try:
+            for item in items:
+                if began is not None:
+                    self._observe_since(began, stage, labels)
+                    began = None
+                yield item
+        finally:
+            # Pass on an early close, e.g. to abandon the upstream request
+            if hasattr(items, "close"):
+                items.close()
+
+    async def afirst(self, items, stage, **labels):
+        """Async variant of ``first``"""
+        began = time.perf_counter()
+        try:
+            async for item in items:
+                if began is not None:
+                    self._observe_since(began, stage, labels)
+                    began = None
+                yield item
+        finally:
+            if hasattr(items, "aclose"):
+                await items.aclose()
+
+    def _observe_since(self, began, stage, labels):
+        self.observe(
+            "stage_seconds", time.perf_counter() - began, stage=stage, **labels
+        )
+
+    def snapshot(self):
+        """This worker's totals, as written to its file"""
+        with self._lock:
+            counters = [
+                [name, dict(labels), value]
+                for (name, labels), value in self._counters.items()
+            ]
+            histograms = [
+                [name, dict(labels), list(bounds), list(counts), total]
+                for (name, labels), (bounds, counts, total) in self._histograms.items()
+            ]
+        gauges = []
+        for collector in self._collectors:
+            try:
+                for kind, name, labels, value in collector():
+                    if kind == "histogram":
+                        histograms.append([name, labels, *value])
+                    elif kind == "gauge":
+                        gauges.append([name, labels, value])
+                    else:
+                        counters.append([name, labels, value])
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+        return {
+            "pid": os.getpid(),
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+    def flush(self):
+        """Write this worker's totals for the other workers to read"""
+        path = self.directory / f"{os.getpid()}.json"
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp = path.with_suffix(".tmp")
+            temp.write_text(json.dumps(self.snapshot(), separators=(",", ":")))
+            os.replace(temp, path)
+        except OSError as e:
+            logger.warning("Could not write metrics: %s", e)
+
+    def collect(self):
+        """
+        Totals of every worker on the host
+
+        Returns:
+            dict: {"counter"/"gauge": {(name, labels): value}, "histogram":
+            {(name, labels): [bounds, counts, sum]}}
+        """
+        snapshots = [self.snapshot()]
+        for path in self.directory.glob("*.json"):
+            if path.stem == str(os.getpid()):
+                continue
+            try:
+                snapshot = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            if not _pid_alive(snapshot["pid"]):
+                snapshot["gauges"] = []
+            snapshots.append(snapshot)
+
+        merged = {"counter": {}, "gauge": {}, "histogram": {}}
+        for snapshot in snapshots:
+            for kind, samples in (
+                ("counter", snapshot["counters"]),
+                ("gauge", snapshot["gauges"]),
+            ):
+                for name, labels, value in samples:
+                    key = _key(name, labels)
+                    merged[kind][key] = merged[kind].get(key, 0) + value
+            for name, labels, bounds, counts, total in snapshot["histograms"]:
+                key = _key(name, labels)
+                if key not in merged["histogram"]:
+                    merged["histogram"][key] = [bounds, [0] * len(counts), 0.0]
+                histogram = merged["histogram"][key]
+                histogram[1] = [a + b for a, b in zip(histogram[1], counts)]
+                histogram[2] += total
+        return merged
+
+    def render(self):
+        """Every worker's metrics in the Prometheus text format"""
+        merged = self.collect()
+        families = {}
+        for kind, samples in merged.items():
+            for name, labels in samples:
+                families.setdefault(name, (kind, []))[1].append(labels)
+
+        lines = []
+        for name in sorted(families):
+            kind, label_sets = families[name]
+            full = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {full} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels in sorted(label_sets):
+                value = merged[kind][(name, labels)]
+                if kind != "histogram":
+                    lines.append(_sample(full, labels, value))
+                    continue
+                bounds, counts, total = value
+                cumulative = 0
+                for bound, count in zip([*bounds, "+Inf"], counts):
+                    cumulative += count
+                    lines.append(
+                        _sample(f"{full}_bucket", (*labels, ("le", bound)), cumulative)
+                    )
+                lines.append(_sample(f"{full}_sum", labels, total))
+                lines.append(_sample(f"{full}_count", labels, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
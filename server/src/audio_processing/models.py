@@ -1 +1,13 @@
-# Create your models here.
+from django.db import models
+
+
+class AudioBlob(models.Model):
+    """A content-addressed audio file and how many messages use it (storage.py)"""
+
+    name = models.CharField(max_length=255, primary_key=True)
+    size = models.BigIntegerField()
+    refs = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refs} refs)"
@@ -0,0 +1,110 @@
+import re
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to an estimate
+    tiktoken = None
+
+# Chat format overhead per message (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_WORD_PIECES = re.compile(r"\w+|[^\w\s]")
+_encoding = None
+
+
+def count_tokens(text):
+    """
+    Tokens in ``text`` for gpt-4o, counted locally
+
+    Uses tiktoken's o200k_base encoding when it is installed, otherwise an
+    estimate from word pieces (about 4 characters per token, 1 per symbol)
+    that errs on the high side for English.
+    """
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    return sum(-(-len(piece) // 4) for piece in _WORD_PIECES.findall(text))
+
+
+def count_message_tokens(messages):
+    return sum(
+        count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    )
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Shorten ``text`` to roughly ``max_tokens``, keeping its beginning"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(" ".join(words[:middle])) < max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low]) + " …"
+
+
+class PromptBuilder:
+    """
+    Assemble chat messages within a token budget
+
+    The system prompt is always sent first and byte-for-byte unchanged, so
+    the provider's prompt cache can reuse it across turns and users. It is
+    followed by the session's rolling summary (if any), then as many recent
+    messages as fit in ``history_budget``, newest kept first, each capped at
+    ``message_limit`` tokens. The current user input is always included.
+    """
+
+    def __init__(self, system_prompt, history_budget=1500, message_limit=400):
+        self.system_prompt = system_prompt
+        self.history_budget = history_budget
+        self.message_limit = message_limit
+        self.system_tokens = count_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+
+    def build(self, user_input, conversation_history=None, summary=""):
+        """
+        Args:
+            user_input: The user's current message
+            conversation_history: Previous messages, oldest first (optional)
+            summary: Rolling summary of turns older than the history (optional)
+
+        Returns:
+            tuple: (messages, stats) where stats has ``prompt_tokens``,
+            ``history_messages`` and ``dropped_messages``
+        """
+        messages = [{"role": "system", "content": self.system_prompt}]
+        budget = self.history_budget
+
+        if summary:
+            summary_message = {
+                "role": "system",
+                "content": f"Summary of the conversation so far: {summary}",
+            }
+            messages.append(summary_message)
+            budget -= count_message_tokens([summary_message])
+
+        history = []
+        for message in reversed(conversation_history or []):
+            content = truncate_to_tokens(message["content"], self.message_limit)
+            cost = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            if cost > budget:
+                break
+            budget -= cost
+            history.append({"role": message["role"], "content": content})
+        history.reverse()
+        messages.extend(history)
+
+        messages.append({"role": "user", "content": user_input})
+
+        stats = {
+            "prompt_tokens": self.system_tokens + count_message_tokens(messages[1:]),
+            "history_messages": len(history),
+            "dropped_messages": len(conversation_history or []) - len(history),
+        }
+        return messages, stats
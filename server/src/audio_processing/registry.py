@@ -0,0 +1,387 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
+from requests.adapters import HTTPAdapter
+
+from .admission import UNLIMITED, WAIT_BUCKETS, AdmissionGate
+from .canned import CannedAudioStore
+from .llm_service import SYSTEM_PROMPT, AsyncLLMService, LLMService, openai_timeout
+from .metrics import metrics
+from .prompt import PromptBuilder
+from .resilience import OPEN, CircuitBreaker, Resilience
+from .stt_service import AsyncSTTService, STTService
+from .tts_cache import TTSCache
+from .tts_service import AsyncTTSService, TTSService, yarngpt_timeout
+from .vad import SpeechTrimmer, vad_available
+
+logger = logging.getLogger(__name__)
+
+
+def _httpx_limits(pool_size):
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _httpx_pool_stats(client):
+    pool = client._transport._pool
+    connections = list(pool.connections)
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "max_connections": pool._max_connections,
+        "connections": len(connections),
+        "idle": idle,
+        "active": len(connections) - idle,
+    }
+
+
+def _requests_pool_stats(session):
+    adapter = session.get_adapter("https://")
+    hosts = {}
+    for key in list(adapter.poolmanager.pools.keys()):
+        pool = adapter.poolmanager.pools.get(key)
+        if pool is None:
+            continue
+        hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+            "connections_created": pool.num_connections,
+            "requests": pool.num_requests,
+            # urllib3 pre-fills the queue with None placeholders
+            "idle": (
+                sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                if pool.pool
+                else 0
+            ),
+        }
+    return {"max_connections": adapter._pool_maxsize, "hosts": hosts}
+
+
+class ServiceRegistry:
+    """
+    Long-lived upstream clients and services, built once per worker process
+
+    STT and LLM share one OpenAI client (and so one keep-alive connection
+    pool); TTS gets a pooled requests.Session for YarnGPT. The clients are
+    thread-safe, so gthread workers share them too. Async services are kept
+    per event loop, since httpx async connections cannot cross loops.
+    Everything is rebuilt if the process forks after first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+        metrics.register(self.metric_samples)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._services = {}
+        self._async_services = weakref.WeakKeyDictionary()
+
+    def _get(self, name, factory):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+        if name not in self._services:
+            with self._lock:
+                if name not in self._services:
+                    self._services[name] = factory()
+        return self._services[name]
+
+    def openai_client(self):
+        return self._get(
+            "openai",
+            lambda: OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=openai_timeout(),
+                max_retries=settings.OPENAI_MAX_RETRIES,
+                http_client=httpx.Client(
+                    limits=_httpx_limits(settings.OPENAI_POOL_SIZE)
+                ),
+            ),
+        )
+
+    def yarngpt_session(self):
+        def build():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=settings.YARNGPT_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            return session
+
+        return self._get("yarngpt", build)
+
+    def gate(self, provider):
+        """
+        Admission gate for "openai" or "yarngpt", shared with the other
+        workers on this host (UNLIMITED when ADMISSION_ENABLED is off)
+        """
+
+        def build():
+            if not settings.ADMISSION_ENABLED:
+                return UNLIMITED
+            limits = settings.UPSTREAM_ADMISSION[provider]
+            return AdmissionGate(
+                provider,
+                settings.ADMISSION_DIR,
+                concurrency=limits["concurrency"],
+                requests_per_minute=limits["requests_per_minute"],
+                queue_size=limits["queue_size"],
+                max_wait=settings.ADMISSION_MAX_WAIT,
+            )
+
+        return self._get(f"gate:{provider}", build)
+
+    def resilience(self, service):
+        """
+        Circuit breaker and hedging for "stt", "llm" or "tts", shared by
+        this worker's sync and async services
+        """
+
+        def build():
+            breaker = CircuitBreaker(
+                service,
+                window=settings.BREAKER_WINDOW,
+                min_calls=settings.BREAKER_MIN_CALLS,
+                failure_rate=settings.BREAKER_FAILURE_RATE,
+                slow_call=settings.SLOW_CALL_SECONDS[service],
+                open_seconds=settings.BREAKER_OPEN_SECONDS,
+            )
+            return Resilience(
+                service,
+                breaker,
+                # Both attempts would read the same upload handle
+                hedge=service in settings.HEDGE_SERVICES and service != "stt",
+                hedge_quantile=settings.HEDGE_QUANTILE,
+                hedge_budget=settings.HEDGE_BUDGET,
+                hedge_min_samples=settings.HEDGE_MIN_SAMPLES,
+                hedge_threads=settings.HEDGE_THREADS,
+            )
+
+        return self._get(f"resilience:{service}", build)
+
+    def tts_cache(self):
+        """Process-wide TTS audio cache, or None when disabled"""
+
+        def build():
+            if not settings.TTS_CACHE_ENABLED:
+                return None
+            return TTSCache(
+                memory_bytes=settings.TTS_CACHE_MEMORY_BYTES,
+                disk_dir=settings.TTS_CACHE_DIR,
+                disk_bytes=settings.TTS_CACHE_DISK_BYTES,
+                max_entry_bytes=settings.TTS_CACHE_MAX_ENTRY_BYTES,
+            )
+
+        return self._get("tts_cache", build)
+
+    def canned_audio(self):
+        """Pre-rendered fixed utterances (see the prerender_audio command)"""
+        return self._get("canned", lambda: CannedAudioStore(settings.CANNED_AUDIO_DIR))
+
+    def vad(self):
+        """Pre-STT silence trimmer, or None when disabled or unavailable"""
+
+        def build():
+            if not settings.STT_VAD_ENABLED:
+                return None
+            if not vad_available():
+                logger.warning("STT_VAD_ENABLED is set but NumPy or ffmpeg is missing")
+                return None
+            return SpeechTrimmer(
+                max_pause=settings.STT_VAD_MAX_PAUSE,
+                padding=settings.STT_VAD_PADDING,
+                min_trim=settings.STT_VAD_MIN_TRIM,
+            )
+
+        return self._get("vad", build)
+
+    def stt(self):
+        return self._get(
+            "stt",
+            lambda: STTService(
+                client=self.openai_client(),
+                gate=self.gate("openai"),
+                resilience=self.resilience("stt"),
+            ),
+        )
+
+    def prompt_builder(self):
+        return self._get(
+            "prompt_builder",
+            lambda: PromptBuilder(
+                SYSTEM_PROMPT,
+                history_budget=settings.LLM_HISTORY_TOKEN_BUDGET,
+                message_limit=settings.LLM_MESSAGE_TOKEN_LIMIT,
+            ),
+        )
+
+    def llm(self):
+        return self._get(
+            "llm",
+            lambda: LLMService(
+                client=self.openai_client(),
+                prompt_builder=self.prompt_builder(),
+                summary_model=settings.SESSION_SUMMARY_MODEL,
+                gate=self.gate("openai"),
+                resilience=self.resilience("llm"),
+            ),
+        )
+
+    def tts(self):
+        return self._get(
+            "tts",
+            lambda: TTSService(
+                session=self.yarngpt_session(),
+                cache=self.tts_cache(),
+                canned=self.canned_audio(),
+                gate=self.gate("yarngpt"),
+                resilience=self.resilience("tts"),
+            ),
+        )
+
+    def _loop_services(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            services = self._async_services.get(loop)
+            if services is None:
+                connect, read = yarngpt_timeout()
+                client = AsyncOpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    timeout=openai_timeout(),
+                    max_retries=settings.OPENAI_MAX_RETRIES,
+                    http_client=httpx.AsyncClient(
+                        limits=_httpx_limits(settings.OPENAI_POOL_SIZE)
+                    ),
+                )
+                services = self._async_services[loop] = {
+                    "stt": AsyncSTTService(
+                        client=client,
+                        gate=self.gate("openai"),
+                        resilience=self.resilience("stt"),
+                    ),
+                    "llm": AsyncLLMService(
+                        client=client,
+                        prompt_builder=self.prompt_builder(),
+                        summary_model=settings.SESSION_SUMMARY_MODEL,
+                        gate=self.gate("openai"),
+                        resilience=self.resilience("llm"),
+                    ),
+                    "tts": AsyncTTSService(
+                        client=httpx.AsyncClient(
+                            timeout=httpx.Timeout(read, connect=connect),
+                            limits=_httpx_limits(settings.YARNGPT_POOL_SIZE),
+                        ),
+                        cache=self.tts_cache(),
+                        canned=self.canned_audio(),
+                        gate=self.gate("yarngpt"),
+                        resilience=self.resilience("tts"),
+                    ),
+                }
+        return services
+
+    def async_stt(self):
+        """Async STT service for the running event loop"""
+        return self._loop_services()["stt"]
+
+    def async_llm(self):
+        """Async LLM service for the running event loop"""
+        return self._loop_services()["llm"]
+
+    def async_tts(self):
+        """Async TTS service for the running event loop"""
+        return self._loop_services()["tts"]
+
+    def warm_up(self):
+        """
+        Build the sync clients and open one keep-alive connection per provider
+
+        Meant for worker boot, so the first real turn skips the TCP and TLS
+        handshakes. Any HTTP response counts; errors are reported and ignored.
+        """
+        openai_client = self.openai_client()
+        tts = self.tts()
+        self.stt()
+        self.llm()
+
+        targets = [
+            (openai_client._client, str(openai_client.base_url)),
+            (tts.session, tts.api_url),
+        ]
+        for client, url in targets:
+            parts = urlsplit(url)
+            try:
+                client.head(f"{parts.scheme}://{parts.netloc}/", timeout=5)
+            except Exception as e:
+                logger.warning("Upstream warm-up failed for %s: %s", parts.netloc, e)
+
+    def pool_stats(self):
+        """Connection pool usage of the sync clients built so far"""
+        stats = {"pid": os.getpid()}
+        if "openai" in self._services:
+            stats["openai"] = _httpx_pool_stats(self._services["openai"]._client)
+        if "yarngpt" in self._services:
+            stats["yarngpt"] = _requests_pool_stats(self._services["yarngpt"])
+        return stats
+
+    def admission_stats(self):
+        """Queue depth, waits and rejections of each provider's gate"""
+        if not settings.ADMISSION_ENABLED:
+            return {"enabled": False}
+        return {
+            provider: self.gate(provider).stats()
+            for provider in settings.UPSTREAM_ADMISSION
+        }
+
+    def resilience_stats(self):
+        """Circuit state and hedging counters of each service in this worker"""
+        return {
+            "pid": os.getpid(),
+            **{
+                service: self.resilience(service).stats()
+                for service in settings.SLOW_CALL_SECONDS
+            },
+        }
+
+    def metric_samples(self):
+        """
+        Admission and circuit breaker counters of the gates and services
+        this worker has built, for /metrics
+        """
+        if self._pid != os.getpid():
+            return
+        for name, service in list(self._services.items()):
+            kind, _, key = name.partition(":")
+            if kind == "gate" and isinstance(service, AdmissionGate):
+                counters, buckets = service.counts()
+                for event in ("admitted", "queued", "rejected", "timed_out"):
+                    labels = {"provider": key, "event": event}
+                    yield "counter", "admission_events_total", labels, counters[event]
+                yield "histogram", "admission_wait_seconds", {"provider": key}, (
+                    WAIT_BUCKETS,
+                    buckets,
+                    counters["wait_seconds"],
+                )
+            elif kind == "resilience":
+                stats = service.stats()
+                for event in ("calls", "failed", "refused", "hedged", "hedges_won"):
+                    labels = {"service": key, "event": event}
+                    yield "counter", "upstream_events_total", labels, stats[event]
+                labels = {"service": key}
+                yield "counter", "circuit_opened_total", labels, stats["times_opened"]
+                yield "gauge", "circuit_open", labels, int(stats["state"] == OPEN)
+
+
+registry = ServiceRegistry()
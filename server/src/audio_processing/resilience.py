@@ -0,0 +1,454 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import inspect
+import logging
+import math
+import threading
+import time
+
+from .admission import Overloaded
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Latencies kept per service for its hedging delay
+LATENCY_SAMPLES = 200
+# Unspent hedges a service can save up while calls are fast
+HEDGE_BURST = 10
+
+logger = logging.getLogger(__name__)
+
+
+class BreakerOpen(Overloaded):
+    """A service's circuit is open: calls fail at once rather than wait on it"""
+
+    def __init__(self, service, retry_after):
+        Exception.__init__(
+            self,
+            f"{service} is unavailable (circuit open), retry in "
+            f"{math.ceil(retry_after)}s",
+        )
+        self.provider = service
+        self.retry_after = retry_after
+
+
+def is_provider_fault(error):
+    """
+    Whether a failed call counts against the provider's circuit: errors,
+    timeouts, 5xx, 408 and 429 do; our own rejections, other 4xx and calls
+    given up on (cancelled, or the worker interrupted) don't
+    """
+    if isinstance(error, Overloaded) or not isinstance(error, Exception):
+        return False
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return not (status and 400 <= status < 500 and status not in (408, 429))
+
+
+def is_timeout(error):
+    """Whether a call failed by timing out (httpx, requests, OpenAI or builtin)"""
+    return any("Timeout" in cls.__name__ for cls in type(error).__mro__)
+
+
+def _discard(discard, result):
+    """Release the result of an attempt that lost (an open stream, say)"""
+    try:
+        closed = discard(result)
+        if inspect.isawaitable(closed):
+            asyncio.ensure_future(closed)
+    except Exception as e:
+        logger.warning("Discarding a hedged call's result failed: %s", e)
+
+
+class CircuitBreaker:
+    """
+    Closed, open and half-open states for calls to one service
+
+    Closed, the outcomes of the last ``window`` calls are kept, and a call
+    slower than ``slow_call`` seconds counts as failed even if it succeeded.
+    Once at least ``min_calls`` are in and ``failure_rate`` of them failed,
+    the circuit opens and calls are refused for ``open_seconds``. Then one
+    trial call is let through (half-open): its success closes the circuit,
+    its failure opens it again.
+    """
+
+    def __init__(
+        self,
+        name,
+        window=20,
+        min_calls=10,
+        failure_rate=0.5,
+        slow_call=10.0,
+        open_seconds=30.0,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._remaining() <= 0:
+                return HALF_OPEN
+            return self._state
+
+    def _remaining(self):
+        return self._opened_at + self.open_seconds - self.clock()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        self.opened += 1
+        logger.warning("Circuit opened for %s", self.name)
+
+    def before_call(self):
+        """
+        Raises:
+            BreakerOpen: The circuit is open, or its trial call is under way
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN:
+                remaining = self._remaining()
+                if remaining > 0:
+                    raise BreakerOpen(self.name, remaining)
+                self._state = HALF_OPEN
+            if self._trial:
+                raise BreakerOpen(self.name, 1)
+            self._trial = True
+
+    def record(self, failed, seconds=0.0):
+        """
+        Record a call's outcome
+
+        Args:
+            failed: True or False, or None for calls that say nothing about
+                the provider (rejected by us, or a client error)
+            seconds: How long the call took
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._trial:
+                self._trial = False
+                if failed is None:
+                    return
+                if failed or seconds > self.slow_call:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    logger.info("Circuit closed for %s", self.name)
+                return
+            if self._state != CLOSED or failed is None:
+                return
+            self._outcomes.append(failed or seconds > self.slow_call)
+            calls, failures = len(self._outcomes), sum(self._outcomes)
+            if calls >= self.min_calls and failures >= self.failure_rate * calls:
+                self._open()
+
+
+class LatencyWindow:
+    """The latencies of a service's recent calls"""
+
+    def __init__(self, size=LATENCY_SAMPLES):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=size)
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, fraction, min_samples=1):
+        """The ``fraction`` quantile, or None with fewer than ``min_samples``"""
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Resilience:
+    """
+    Circuit breaker, and optionally hedged requests, for one service
+
+    With hedging on, a call still unanswered after the service's recent
+    ``hedge_quantile`` latency is sent a second time; whichever attempt
+    answers first wins and the other is cancelled (async) or abandoned and
+    its result discarded (sync: a blocking HTTP call can't be interrupted).
+    Hedges are budgeted at ``hedge_budget`` per call made, so a provider
+    that slows down across the board isn't sent twice the traffic.
+
+    Only pass idempotent calls: both attempts may reach the provider.
+
+    Usage::
+
+        response = resilience.call(lambda: session.post(...), discard=close)
+    """
+
+    def __init__(
+        self,
+        name,
+        breaker,
+        hedge=False,
+        hedge_quantile=0.95,
+        hedge_budget=0.1,
+        hedge_min_samples=20,
+        hedge_threads=16,
+        clock=time.monotonic,
+    ):
+        """
+        Args:
+            name: Service name, used in errors and stats
+            breaker: The service's CircuitBreaker
+            hedge: Whether to hedge calls
+            hedge_quantile: Latency quantile after which a call is hedged
+            hedge_budget: Hedges allowed per call made
+            hedge_min_samples: Calls to see before hedging at all
+            hedge_threads: Threads running hedged sync calls; calls beyond
+                them are made directly, unhedged
+        """
+        self.name = name
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_threads = hedge_threads
+        self.clock = clock
+        self.latencies = LatencyWindow()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._running = 0
+        self._hedge_tokens = 0.0
+        self.counters = {
+            "calls": 0,
+            "failed": 0,
+            "refused": 0,
+            "hedged": 0,
+            "hedges_won": 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _begin(self):
+        try:
+            self.breaker.before_call()
+        except BreakerOpen:
+            self._count("refused")
+            raise
+        with self._lock:
+            self.counters["calls"] += 1
+            self._hedge_tokens = min(
+                HEDGE_BURST, self._hedge_tokens + self.hedge_budget
+            )
+        return self.clock()
+
+    def _settle(self, began, error=None, blame_timeouts=True):
+        seconds = self.clock() - began
+        if error is None:
+            self.latencies.add(seconds)
+            self.breaker.record(False, seconds)
+        elif is_provider_fault(error) and (blame_timeouts or not is_timeout(error)):
+            self._count("failed")
+            self.breaker.record(True, seconds)
+        else:
+            self.breaker.record(None)
+
+    def _hedge_delay(self):
+        """Seconds to wait before hedging this call, or None not to"""
+        if not self.hedge or self.breaker.state != CLOSED:
+            return None
+        return self.expected_latency()
+
+    def _take_hedge(self):
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            self.counters["hedged"] += 1
+            return True
+
+    def _reserve_threads(self, count):
+        with self._lock:
+            if self._running + count > self.hedge_threads:
+                return False
+            self._running += count
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.hedge_threads, thread_name_prefix=f"hedge-{self.name}"
+                )
+            return True
+
+    def _run(self, fn):
+        try:
+            return fn()
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def expected_latency(self):
+        """The service's recent p95 (``hedge_quantile``) latency, if known"""
+        return self.latencies.quantile(self.hedge_quantile, self.hedge_min_samples)
+
+    def call(self, fn, discard=None, blame_timeouts=True):
+        """
+        Make a call through the breaker, hedging it if it runs long
+
+        Args:
+            fn: Makes the call and returns its result
+            discard: Releases the result of an attempt that lost the race
+            blame_timeouts: False when the call's timeout was cut short (to
+                fit a deadline), so timing out says little about the provider
+
+        Returns:
+            The first successful attempt's result
+
+        Raises:
+            BreakerOpen: The circuit is open; nothing was sent
+        """
+        began = self._begin()
+        try:
+            delay = self._hedge_delay()
+            if delay is None or not self._reserve_threads(1):
+                result = fn()
+            else:
+                result = self._hedged(fn, delay, discard)
+        except BaseException as e:
+            # Whatever ends the call, so a half-open trial can't stay open
+            self._settle(began, e, blame_timeouts)
+            raise
+        self._settle(began)
+        return result
+
+    def _submit(self, fn):
+        # In the caller's context, so its records keep the request ID
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, self._run, fn)
+
+    def _hedged(self, fn, delay, discard):
+        attempts = [self._submit(fn)]
+        done, _ = concurrent.futures.wait(attempts, timeout=delay)
+        if not done and self._reserve_threads(1):
+            if self._take_hedge():
+                attempts.append(self._submit(fn))
+            else:
+                with self._lock:
+                    self._running -= 1
+
+        error = None
+        for attempt in concurrent.futures.as_completed(attempts):
+            if attempt.exception() is not None:
+                error = attempt.exception()
+                continue
+            for other in attempts:
+                if other is not attempt and not other.cancel() and discard:
+                    other.add_done_callback(
+                        lambda f: f.exception() or _discard(discard, f.result())
+                    )
+            if attempt is not attempts[0]:
+                self._count("hedges_won")
+            return attempt.result()
+        raise error
+
+    async def acall(self, fn, discard=None, blame_timeouts=True):
+        """
+        Async variant of ``call``
+
+        Args:
+            fn: Returns a coroutine making the call
+            discard: Releases the result of an attempt that lost the race
+                (may return an awaitable)
+        """
+        began = self._begin()
+        try:
+            delay = self._hedge_delay()
+            if delay is None:
+                result = await fn()
+            else:
+                result = await self._ahedged(fn, delay, discard)
+        except BaseException as e:
+            # Including CancelledError, e.g. the client went away
+            self._settle(began, e, blame_timeouts)
+            raise
+        self._settle(began)
+        return result
+
+    async def _ahedged(self, fn, delay, discard):
+        attempts = [asyncio.ensure_future(fn())]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done and self._take_hedge():
+                attempts.append(asyncio.ensure_future(fn()))
+
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for attempt in done:
+                    if attempt.exception() is None:
+                        winner = attempt
+                        break
+                    error = attempt.exception()
+                if winner is not None:
+                    if winner is not attempts[0]:
+                        self._count("hedges_won")
+                    return winner.result()
+            raise error
+        finally:
+            for attempt in attempts:
+                if attempt is winner:
+                    continue
+                if not attempt.done():
+                    attempt.cancel()
+                elif discard and not attempt.exception():
+                    _discard(discard, attempt.result())
+
+    def stats(self):
+        quantile = self.latencies.quantile(self.hedge_quantile)
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "state": self.breaker.state,
+            "times_opened": self.breaker.opened,
+            "hedging": self.hedge,
+            f"p{round(self.hedge_quantile * 100)}_seconds": (
+                None if quantile is None else round(quantile, 3)
+            ),
+            **counters,
+        }
+
+
+class Direct:
+    """Stand-in for services built without a breaker: calls go straight through"""
+
+    name = "direct"
+
+    def expected_latency(self):
+        return None
+
+    def call(self, fn, discard=None, blame_timeouts=True):
+        return fn()
+
+    async def acall(self, fn, discard=None, blame_timeouts=True):
+        return await fn()
+
+
+DIRECT = Direct()
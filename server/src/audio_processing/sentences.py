@@ -0,0 +1,65 @@
+import re
+
+# A sentence ends at terminal punctuation (optionally followed by closing
+# quotes/brackets) and whitespace, or at a line break
+SENTENCE_END = re.compile(r"""(?<=[.!?…])["'”’)\]]*\s+|\n+""")
+
+
+class SentenceBuffer:
+    """
+    Regroup a stream of text deltas into complete sentences
+
+    Sentences shorter than ``min_chars`` are merged with the following one so
+    that fragments like "Okay." do not each cost a separate TTS round trip.
+    """
+
+    def __init__(self, min_chars=12):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, delta):
+        """Add a text fragment and return the sentences it completed"""
+        self.buffer += delta
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            candidate = self.buffer[start : match.end()].strip()
+            if len(candidate) < self.min_chars:
+                continue
+            sentences.append(candidate)
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """Return whatever text is left once the stream has ended"""
+        tail = self.buffer.strip()
+        self.buffer = ""
+        return [tail] if tail else []
+
+
+def iter_sentences(deltas, min_chars=12):
+    """
+    Regroup an iterable of text deltas into complete sentences
+
+    Args:
+        deltas: Iterable of text fragments, e.g. streamed LLM tokens
+        min_chars: Minimum length of an emitted sentence (except the last)
+
+    Yields:
+        str: Stripped sentences, in order
+    """
+    buffer = SentenceBuffer(min_chars)
+    for delta in deltas:
+        yield from buffer.feed(delta)
+    yield from buffer.flush()
+
+
+async def aiter_sentences(deltas, min_chars=12):
+    """Async variant of iter_sentences for an async iterable of deltas"""
+    buffer = SentenceBuffer(min_chars)
+    async for delta in deltas:
+        for sentence in buffer.feed(delta):
+            yield sentence
+    for sentence in buffer.flush():
+        yield sentence
@@ -0,0 +1,266 @@
+import hashlib
+import mimetypes
+import os
+import posixpath
+import tempfile
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+try:
+    import boto3
+except ImportError:  # optional: only for AUDIO_STORAGE_BACKEND=s3
+    boto3 = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ContentAddressedMixin:
+    """
+    Store each file under the SHA-256 of its content, once
+
+    ``save("audio/user_1_2.webm", content)`` hashes the content while
+    spooling it and returns ``audio/ab/cd/abcd...ef.webm``: the upload_to
+    directory, two levels of shards from the hash (65,536 directories, so
+    no directory grows past a few hundred files per 10M blobs) and the
+    original extension. Saving identical content again stores nothing new;
+    it adds a reference to the AudioBlob row, and ``delete`` only removes
+    the blob when the last reference goes.
+
+    Files saved before content addressing keep their names and have no
+    AudioBlob row; they are deleted outright.
+
+    Subclasses provide ``_spool_directory()``, ``_put_blob(name, path)``
+    (which must make the blob appear atomically) and ``_remove_blob(name)``.
+    Uploads Django already spooled to a temp file are moved, not copied,
+    into the spool directory when ``adopt_temporary_files`` is set and it is
+    on the same filesystem.
+    """
+
+    adopt_temporary_files = False
+
+    def get_available_name(self, name, max_length=None):
+        # The final name comes from the content in _save, and never collides
+        return name
+
+    def blob_name(self, name, digest):
+        directory = posixpath.dirname(name)
+        extension = posixpath.splitext(name)[1].lower()
+        return posixpath.join(directory, digest[:2], digest[2:4], digest + extension)
+
+    def _spool(self, content, spool_directory):
+        """
+        Copy ``content`` into the spool directory, hashing it on the way
+
+        Returns:
+            tuple: (spool path, hex digest, size)
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(
+            dir=spool_directory, suffix=".part", delete=False
+        ) as spool:
+            try:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    digest.update(chunk)
+                    spool.write(chunk)
+                    size += len(chunk)
+                spool.flush()
+                os.fsync(spool.fileno())
+            except BaseException:
+                os.remove(spool.name)
+                raise
+        return spool.name, digest.hexdigest(), size
+
+    def _adopt(self, content, spool_directory):
+        """
+        Hash an upload Django spooled to a temp file and move that file into
+        the spool directory, saving a copy of the recording
+
+        Returns:
+            tuple or None: As ``_spool``; None when the upload has to be
+            copied instead (kept in memory, or on another filesystem)
+        """
+        if not self.adopt_temporary_files or not hasattr(
+            content, "temporary_file_path"
+        ):
+            return None
+        source = content.temporary_file_path()
+        if os.stat(source).st_dev != os.stat(spool_directory).st_dev:
+            return None
+        digest = hashlib.sha256()
+        size = 0
+        with open(source, "rb") as upload:
+            while chunk := upload.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+            os.fsync(upload.fileno())
+        with tempfile.NamedTemporaryFile(
+            dir=spool_directory, suffix=".part", delete=False
+        ) as spool:
+            pass
+        # Django's temp file is gone afterwards; closing the upload allows that
+        os.replace(source, spool.name)
+        return spool.name, digest.hexdigest(), size
+
+    def _save(self, name, content):
+        from .models import AudioBlob
+
+        spool_directory = self._spool_directory()
+        os.makedirs(spool_directory, exist_ok=True)
+        spooled = self._adopt(content, spool_directory)
+        if spooled is None:
+            spooled = self._spool(content, spool_directory)
+        spool_path, digest, size = spooled
+        name = self.blob_name(name, digest)
+
+        try:
+            for attempt in range(2):
+                try:
+                    # The row lock orders this against a delete of the same blob
+                    with transaction.atomic():
+                        blob = (
+                            AudioBlob.objects.select_for_update()
+                            .filter(name=name)
+                            .first()
+                        )
+                        if blob is None:
+                            AudioBlob.objects.create(name=name, size=size)
+                        else:
+                            AudioBlob.objects.filter(name=name).update(
+                                refs=F("refs") + 1
+                            )
+                        if blob is None or not self.exists(name):
+                            self._put_blob(name, spool_path)
+                    break
+                except IntegrityError:
+                    # Another worker created the row first; add a reference
+                    if attempt:
+                        raise
+        finally:
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+        return name
+
+    def delete(self, name):
+        from .models import AudioBlob
+
+        with transaction.atomic():
+            blob = AudioBlob.objects.select_for_update().filter(name=name).first()
+            if blob is not None and blob.refs > 1:
+                AudioBlob.objects.filter(name=name).update(refs=F("refs") - 1)
+                return
+            if blob is not None:
+                blob.delete()
+            self._remove_blob(name)
+
+
+class ContentAddressedFileStorage(ContentAddressedMixin, FileSystemStorage):
+    """Content-addressed blobs under MEDIA_ROOT"""
+
+    adopt_temporary_files = True
+
+    def _spool_directory(self):
+        # On the same filesystem, so the final rename is atomic
+        return os.path.join(self.location, ".incoming")
+
+    def _put_blob(self, name, path):
+        final = self.path(name)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        os.replace(path, final)
+        if self.file_permissions_mode is not None:
+            os.chmod(final, self.file_permissions_mode)
+
+    def _remove_blob(self, name):
+        FileSystemStorage.delete(self, name)
+
+
+def _is_missing(error):
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+class S3AudioStorage(ContentAddressedMixin, Storage):
+    """
+    Content-addressed blobs in an S3-compatible bucket (S3, MinIO, R2, ...)
+
+    Uploads are spooled to a local temp file for hashing, then sent with one
+    upload_file call; S3 only makes an object visible once it is complete,
+    which gives the same atomicity as the local rename.
+    """
+
+    def __init__(self, bucket, client=None, endpoint_url=None, public_url=""):
+        """
+        Args:
+            bucket: Bucket name
+            client: A boto3 S3 client, or anything with the same methods
+                (built from ``endpoint_url`` and the environment if omitted)
+            endpoint_url: For S3-compatible stores other than AWS
+            public_url: Base URL the bucket is served from; presigned URLs
+                are used when empty
+        """
+        if client is None:
+            if boto3 is None:
+                raise ImproperlyConfigured(
+                    "AUDIO_STORAGE_BACKEND=s3 needs boto3: pipenv install boto3"
+                )
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.client = client
+        self.public_url = public_url
+
+    def _spool_directory(self):
+        return os.path.join(tempfile.gettempdir(), "audio-spool")
+
+    def _put_blob(self, name, path):
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.client.upload_file(
+            path, self.bucket, name, ExtraArgs={"ContentType": content_type}
+        )
+
+    def _remove_blob(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def _open(self, name, mode="rb"):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=name)
+        except Exception as e:
+            if _is_missing(e):
+                raise FileNotFoundError(name) from e
+            raise
+        return File(response["Body"], name=name)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+        except Exception as e:
+            if _is_missing(e):
+                return False
+            raise
+        return True
+
+    def size(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=name)["ContentLength"]
+
+    def url(self, name):
+        if self.public_url:
+            return urljoin(self.public_url.rstrip("/") + "/", name)
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": name}, ExpiresIn=3600
+        )
+
+
+def audio_storage():
+    """Storage for Message.audio_file, chosen by AUDIO_STORAGE_BACKEND"""
+    if settings.AUDIO_STORAGE_BACKEND == "s3":
+        return S3AudioStorage(
+            settings.AUDIO_S3_BUCKET,
+            endpoint_url=settings.AUDIO_S3_ENDPOINT_URL,
+            public_url=settings.AUDIO_S3_PUBLIC_URL,
+        )
+    return ContentAddressedFileStorage()
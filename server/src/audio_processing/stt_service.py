@@ -1,36 +1,128 @@
+import asyncio
 import os
 
-from openai import OpenAI
+from django.conf import settings
+from openai import AsyncOpenAI, OpenAI
+
+from .admission import UNLIMITED, Overloaded
+from .deadline import DeadlineExceeded, aadmit, admit, openai_options
+from .metrics import metrics
+from .resilience import DIRECT, is_timeout
+from .uploads import AudioUploadRejected
 
 
 class STTService:
     """Speech-to-Text using OpenAI Whisper"""
 
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def __init__(self, client=None, gate=UNLIMITED, resilience=DIRECT):
+        self.client = client or OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # AdmissionGate shared with the LLM (same OpenAI quota)
+        self.gate = gate
+        # Circuit breaker for transcription; uploads are never hedged
+        self.resilience = resilience
+
+    def _file_payload(self, audio_file):
+        # Pass the file handle itself: httpx streams it into the multipart
+        # body in chunks (rewinding on retries), so the upload is never
+        # loaded into memory whole
+        audio_file.seek(0)
+        return (audio_file.name, audio_file, audio_file.content_type)
+
+    def _reserve(self):
+        # Time kept back to answer the transcript and save the turn
+        return settings.DEADLINE_LLM_SECONDS + settings.DEADLINE_DB_SECONDS
+
+    def _sent(self, audio_file):
+        size = getattr(audio_file, "size", None) or 0
+        metrics.inc("upstream_bytes_total", size, service="stt", direction="sent")
 
-    def transcribe(self, audio_file):
+    def _failed(self, error, deadline, cut_short):
+        if cut_short and is_timeout(error):
+            return DeadlineExceeded("stt", deadline.remaining())
+        return Exception(f"STT error: {str(error)}")
+
+    def transcribe(self, audio_file, deadline=None):
         """
         Transcribe audio to text using Whisper
 
         Args:
             audio_file: Django UploadedFile object
+            deadline: The turn's Deadline (optional)
 
         Returns:
             str: Transcribed text
+
+        Raises:
+            Overloaded: OpenAI's admission queue is full, or the STT circuit
+                is open (BreakerOpen)
+            DeadlineExceeded: Too little time was left to transcribe
         """
+        cut_short = False
         try:
-            # Reset file pointer to beginning
-            audio_file.seek(0)
+            with admit(self.gate, deadline, "stt", self._reserve()):
+                options, cut_short = openai_options(
+                    deadline, "stt", self._reserve(), self.resilience.expected_latency()
+                )
+                client = self.client.with_options(**options)
+                transcript = self.resilience.call(
+                    lambda: client.audio.transcriptions.create(
+                        model="whisper-1",
+                        file=self._file_payload(audio_file),
+                    ),
+                    blame_timeouts=not cut_short,
+                )
+            self._sent(audio_file)
+            return transcript.text
+        except (Overloaded, DeadlineExceeded):
+            raise
+        except Exception as e:
+            raise self._failed(e, deadline, cut_short) from e
+
+
+class AsyncSTTService(STTService):
+    """Speech-to-Text using OpenAI Whisper (asyncio)"""
 
-            # Read file content as bytes and pass as tuple (filename, bytes, content_type)
-            file_content = audio_file.read()
-            audio_file.seek(0)  # Reset again in case needed
+    def __init__(self, client=None, gate=UNLIMITED, resilience=DIRECT):
+        self.client = client or AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.gate = gate
+        self.resilience = resilience
 
-            transcript = self.client.audio.transcriptions.create(
-                model="whisper-1",
-                file=(audio_file.name, file_content, audio_file.content_type),
+    async def aclose(self):
+        """Close the underlying HTTP client before the event loop goes away"""
+        await self.client.close()
+
+    def _read_payload(self, audio_file):
+        # AsyncOpenAI would read a file handle on the event loop, so the
+        # upload is read into memory (in a thread) instead; the upload cap
+        # bounds the copy
+        max_bytes = settings.AUDIO_UPLOAD_MAX_BYTES
+        audio_file.seek(0)
+        data = audio_file.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise AudioUploadRejected(
+                f"Audio upload exceeds the {max_bytes / 1024**2:g} MB limit"
             )
+        return (audio_file.name, data, audio_file.content_type)
+
+    async def transcribe(self, audio_file, deadline=None):
+        """Async variant of STTService.transcribe"""
+        cut_short = False
+        try:
+            payload = await asyncio.to_thread(self._read_payload, audio_file)
+            async with aadmit(self.gate, deadline, "stt", self._reserve()):
+                options, cut_short = openai_options(
+                    deadline, "stt", self._reserve(), self.resilience.expected_latency()
+                )
+                client = self.client.with_options(**options)
+                transcript = await self.resilience.acall(
+                    lambda: client.audio.transcriptions.create(
+                        model="whisper-1", file=payload
+                    ),
+                    blame_timeouts=not cut_short,
+                )
+            self._sent(audio_file)
             return transcript.text
+        except (Overloaded, DeadlineExceeded, AudioUploadRejected):
+            raise
         except Exception as e:
-            raise Exception(f"STT error: {str(e)}")
+            raise self._failed(e, deadline, cut_short) from e
@@ -1 +1,989 @@
-# Create your tests here.
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+
+from django.core.files.base import ContentFile, File
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+
+from companion.models import Message, Session, User
+
+from .admission import AdmissionGate, Overloaded
+from .audio_spool import AudioSpool
+from .deadline import Deadline, DeadlineExceeded, admit
+from .llm_service import SYSTEM_PROMPT, LLMService
+from .metrics import LATENCY_BUCKETS, Metrics
+from .models import AudioBlob
+from .prompt import PromptBuilder, count_message_tokens, count_tokens
+from .registry import registry
+from .resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    BreakerOpen,
+    CircuitBreaker,
+    Resilience,
+    is_provider_fault,
+)
+from .sentences import SentenceBuffer, aiter_sentences, iter_sentences
+from .storage import ContentAddressedFileStorage, S3AudioStorage
+from .stt_service import AsyncSTTService
+from .tts_cache import DiskStore, TTSCache, cache_key
+from .tts_service import AsyncTTSService, TTSService
+from .uploads import MULTIPART_OVERHEAD, AudioUploadLimitHandler, AudioUploadRejected
+from .vad import FRAME_MS, SAMPLE_RATE, keep_frames, np, speech_frames
+
+
+class LocalS3Client:
+    """Stand-in for a boto3 S3 client, keeping objects in a dict"""
+
+    class Missing(Exception):
+        response = {"Error": {"Code": "404"}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        with open(path, "rb") as handle:
+            self.objects[(bucket, key)] = handle.read()
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.Missing(Key)
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key):
+        self.head_object(Bucket, Key)
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?signed"
+
+
+class BrokenUpload(File):
+    """An upload whose connection drops after the first chunk"""
+
+    def chunks(self, chunk_size=None):
+        yield b"partial"
+        raise ConnectionResetError
+
+
+class ContentAddressedFileStorageTests(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.storage = ContentAddressedFileStorage(location=self.location)
+
+    def files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.location)
+            for root, _, names in os.walk(self.location)
+            for name in names
+        )
+
+    def test_sharded_by_content_hash(self):
+        name = self.storage.save("audio/user_1_2.WEBM", ContentFile(b"hello"))
+        digest = "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824"
+        self.assertEqual(name, f"audio/2c/f2/{digest}.webm")
+        self.assertEqual(self.files(), [name])
+
+    def test_identical_content_is_stored_once(self):
+        first = self.storage.save("audio/a.mp3", ContentFile(b"fallback"))
+        second = self.storage.save("audio/b.mp3", ContentFile(b"fallback"))
+        self.assertEqual(first, second)
+        self.assertEqual(self.files(), [first])
+        self.assertEqual(AudioBlob.objects.get(name=first).refs, 2)
+
+        self.storage.delete(first)
+        self.assertTrue(self.storage.exists(first))
+        self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+        self.assertFalse(AudioBlob.objects.exists())
+
+    def test_spooled_upload_is_moved_not_copied(self):
+        upload = TemporaryUploadedFile("q.webm", "audio/webm", 5, None)
+        upload.write(b"hello")
+        upload.flush()
+        inode = os.stat(upload.temporary_file_path()).st_ino
+        name = self.storage.save("audio/user_1_2.webm", upload)
+        self.assertEqual(os.stat(self.storage.path(name)).st_ino, inode)
+        self.assertEqual(self.storage.open(name).read(), b"hello")
+        upload.close()  # Its temp file has already moved
+        self.assertEqual(self.files(), [name])
+
+    def test_failed_upload_leaves_nothing_behind(self):
+        with self.assertRaises(ConnectionResetError):
+            self.storage.save("audio/a.webm", BrokenUpload(io.BytesIO()))
+        self.assertEqual(self.files(), [])
+        self.assertFalse(AudioBlob.objects.exists())
+
+    def test_files_from_before_content_addressing(self):
+        with open(os.path.join(self.location, "old.webm"), "wb") as handle:
+            handle.write(b"old")
+        self.assertEqual(self.storage.open("old.webm").read(), b"old")
+        self.storage.delete("old.webm")
+        self.assertEqual(self.files(), [])
+
+
+class S3AudioStorageTests(TestCase):
+    def setUp(self):
+        self.client = LocalS3Client()
+        self.storage = S3AudioStorage("audio-bucket", client=self.client)
+
+    def test_save_open_and_refcounted_delete(self):
+        first = self.storage.save("audio/a.mp3", ContentFile(b"fallback"))
+        second = self.storage.save("audio/b.mp3", ContentFile(b"fallback"))
+        self.assertEqual(first, second)
+        self.assertEqual(list(self.client.objects), [("audio-bucket", first)])
+        self.assertEqual(self.storage.open(first).read(), b"fallback")
+        self.assertEqual(self.storage.size(first), 8)
+        self.assertTrue(self.storage.url(first).endswith("?signed"))
+
+        self.storage.delete(first)
+        self.assertTrue(self.storage.exists(first))
+        self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(first)
+
+    def test_public_url(self):
+        storage = S3AudioStorage(
+            "audio-bucket", client=self.client, public_url="https://cdn.test/audio"
+        )
+        self.assertEqual(
+            storage.url("audio/ab/cd/x.mp3"), "https://cdn.test/audio/audio/ab/cd/x.mp3"
+        )
+
+
+class MessageAudioTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings = override_settings(MEDIA_ROOT=self.media)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        user = User.objects.create_user("ada_obi")
+        self.session = Session.objects.create(user=user)
+
+    def message_with_audio(self, data):
+        message = Message.objects.create(
+            session=self.session, role="assistant", text="I'm here for you"
+        )
+        message.audio_file.save(f"assistant_{message.id}.mp3", ContentFile(data))
+        return message
+
+    def test_deleting_messages_releases_their_audio(self):
+        first = self.message_with_audio(b"canned")
+        second = self.message_with_audio(b"canned")
+        self.assertEqual(first.audio_file.name, second.audio_file.name)
+        storage = first.audio_file.storage
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.exists(second.audio_file.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(storage.exists(second.audio_file.name))
+
+    def test_rehome_legacy_audio(self):
+        os.makedirs(os.path.join(self.media, "audio"))
+        for i in range(2):
+            with open(os.path.join(self.media, f"audio/user_1_{i}.webm"), "wb") as f:
+                f.write(b"hello")
+            Message.objects.create(
+                session=self.session,
+                role="user",
+                text="hi",
+                audio_file=f"audio/user_1_{i}.webm",
+            )
+
+        call_command("rehome_audio", stdout=io.StringIO())
+        names = {message.audio_file.name for message in Message.objects.all()}
+        self.assertEqual(len(names), 1)
+        self.assertRegex(names.pop(), r"^audio/2c/f2/2cf24dba[0-9a-f]{56}\.webm$")
+        self.assertFalse(
+            os.path.exists(os.path.join(self.media, "audio/user_1_0.webm"))
+        )
+        self.assertEqual(AudioBlob.objects.get().refs, 2)
+
+
+class AdmissionGateTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def gate(self, **limits):
+        limits = {
+            "concurrency": 2,
+            "requests_per_minute": 60000,
+            "queue_size": 4,
+            "max_wait": 0.05,
+            **limits,
+        }
+        return AdmissionGate("openai", self.directory, **limits)
+
+    def test_concurrency_is_shared_between_gates(self):
+        # Two gates on one directory stand in for two worker processes
+        first, second = self.gate(), self.gate()
+        with first.admit(), second.admit():
+            with self.assertRaises(Overloaded):
+                with first.admit():
+                    pass
+            self.assertEqual(first.stats()["in_flight"], 2)
+        with second.admit():
+            pass
+        stats = first.stats()
+        self.assertEqual((stats["admitted"], stats["timed_out"]), (1, 1))
+        self.assertEqual((stats["in_flight"], stats["queue_depth"]), (0, 0))
+
+    def test_full_queue_fails_fast(self):
+        gate = self.gate(concurrency=1, queue_size=0, max_wait=5)
+        with gate.admit():
+            began = time.monotonic()
+            with self.assertRaises(Overloaded) as raised:
+                with gate.admit():
+                    pass
+        self.assertLess(time.monotonic() - began, 0.5)
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(gate.stats()["rejected"], 1)
+
+    def test_rate_limit(self):
+        gate = self.gate(requests_per_minute=60, max_wait=0.1)
+        for _ in range(2):  # The burst
+            with gate.admit():
+                pass
+        began = time.monotonic()
+        with self.assertRaises(Overloaded):
+            # The next token is a second away, past max_wait: no point waiting
+            with gate.admit():
+                pass
+        self.assertLess(time.monotonic() - began, 0.05)
+
+    def test_waiters_are_admitted_as_slots_free(self):
+        gate = self.gate(concurrency=1, max_wait=2)
+
+        async def call(order):
+            async with gate.aadmit():
+                order.append("start")
+                await asyncio.sleep(0.01)
+                order.append("end")
+
+        async def main():
+            order = []
+            await asyncio.gather(*(call(order) for _ in range(3)))
+            return order
+
+        self.assertEqual(asyncio.run(main()), ["start", "end"] * 3)
+        self.assertEqual(gate.stats()["queued"], 2)
+
+    def test_async_attempts_take_the_lock_off_the_event_loop(self):
+        gate = self.gate(concurrency=1)
+        threads = []
+        for name in ("_attempt", "_release"):
+
+            def record(*args, method=getattr(gate, name)):
+                threads.append(threading.current_thread())
+                return method(*args)
+
+            setattr(gate, name, record)
+
+        async def main():
+            async with gate.aadmit():
+                pass
+
+        asyncio.run(main())
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_cancelled_async_waiter_leaves_the_queue(self):
+        gate = self.gate(concurrency=1, max_wait=2)
+
+        async def main():
+            async with gate.aadmit():
+                waiter = asyncio.ensure_future(gate.aadmit().__aenter__())
+                while not gate.stats()["queue_depth"]:
+                    await asyncio.sleep(0.01)
+                waiter.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await waiter
+                self.assertEqual(gate.stats()["queue_depth"], 0)
+
+        asyncio.run(main())
+        self.assertEqual(gate.stats()["in_flight"], 0)
+
+    def test_slots_of_dead_workers_are_reclaimed(self):
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        gate = self.gate(concurrency=1, max_wait=2)
+        with open(gate.path, "w") as state:
+            json.dump({"leases": {"crashed": [dead.pid, time.time()]}}, state)
+        with gate.admit():
+            self.assertEqual(gate.stats()["in_flight"], 1)
+
+    def assertFreed(self, gate, timeout=2):
+        """The slot is given back within ``timeout`` seconds"""
+        until = time.monotonic() + timeout
+        while gate.stats()["in_flight"] and time.monotonic() < until:
+            time.sleep(0.01)
+        self.assertEqual(gate.stats()["in_flight"], 0)
+
+    def yarngpt(self, gate, service=TTSService):
+        provider = FaultyProvider()
+        self.addCleanup(provider.server_close)
+        self.addCleanup(provider.shutdown)
+        tts = service(gate=gate)
+        tts.api_url = provider.url
+        return tts
+
+    def test_slow_reader_does_not_hold_the_slot(self):
+        # The client has taken one chunk and stalls: YarnGPT is done, so
+        # the slot is free before the client reads the rest
+        gate = self.gate(concurrency=1)
+        chunks = self.yarngpt(gate).stream_synthesize("Hello", "idera")
+        self.assertEqual(next(chunks), b"ID3audio")
+        self.assertFreed(gate)
+        self.assertEqual(list(chunks), [])
+
+    def test_slow_async_reader_does_not_hold_the_slot(self):
+        gate = self.gate(concurrency=1)
+
+        async def main():
+            tts = self.yarngpt(gate, service=AsyncTTSService)
+            try:
+                chunks = tts.stream_synthesize("Hello", "idera")
+                first = await anext(chunks)
+                for _ in range(200):
+                    if not gate.stats()["in_flight"]:
+                        break
+                    await asyncio.sleep(0.01)
+                freed = not gate.stats()["in_flight"]
+                await chunks.aclose()
+                return first, freed
+            finally:
+                await tts.aclose()
+
+        self.assertEqual(asyncio.run(main()), (b"ID3audio", True))
+
+    def test_slow_sentence_speaker_does_not_hold_the_llm_slot(self):
+        def chunk(text):
+            return mock.Mock(choices=[mock.Mock(delta=mock.Mock(content=text))])
+
+        gate = self.gate(concurrency=1)
+        client = mock.Mock()
+        client.with_options().chat.completions.create.return_value = iter(
+            [chunk("Hello there. "), chunk("How are you?")]
+        )
+        deltas = LLMService(client=client, gate=gate).stream_response("Hi")
+        # As if the first sentence were being spoken before reading on
+        self.assertEqual(next(deltas), "Hello there. ")
+        self.assertFreed(gate)
+        self.assertEqual(list(deltas), ["How are you?"])
+
+
+class FaultyProvider(ThreadingHTTPServer):
+    """
+    Local stand-in for YarnGPT that misbehaves on cue: each request takes
+    the next (status, delay) from ``script``, then ``default`` once it runs out
+    """
+
+    daemon_threads = True
+
+    def __init__(self, script=(), default=(200, 0)):
+        super().__init__(("127.0.0.1", 0), FaultyProviderHandler)
+        self.script = list(script)
+        self.default = default
+        self.requests = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/tts"
+
+    def handle_error(self, request, client_address):
+        pass  # Clients that timed out or lost a hedge hang up on purpose
+
+    def next_fault(self):
+        with self.lock:
+            self.requests += 1
+            return self.script.pop(0) if self.script else self.default
+
+
+class FaultyProviderHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, delay = self.server.next_fault()
+        time.sleep(delay)
+        body = b"ID3audio" if status == 200 else b'{"error": "injected"}'
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ResilienceTests(TestCase):
+    def provider(self, *args, **kwargs):
+        provider = FaultyProvider(*args, **kwargs)
+        self.addCleanup(provider.server_close)
+        self.addCleanup(provider.shutdown)
+        return provider
+
+    def tts(self, provider, resilience, service=TTSService):
+        tts = service(resilience=resilience)
+        tts.api_url = provider.url
+        return tts
+
+    def resilience(self, clock=time.monotonic, **options):
+        breaker = CircuitBreaker(
+            "tts", window=4, min_calls=4, slow_call=0.5, open_seconds=30, clock=clock
+        )
+        return Resilience("tts", breaker, clock=clock, **options)
+
+    def test_breaker_opens_on_errors_and_closes_after_a_trial(self):
+        now = [0.0]
+        provider = self.provider(script=[(500, 0)] * 4)
+        resilience = self.resilience(clock=lambda: now[0])
+        tts = self.tts(provider, resilience)
+        for _ in range(4):
+            with self.assertRaisesRegex(Exception, "returned 500"):
+                tts.synthesize("Hello", "idera")
+
+        # Open: refused without a request reaching the provider
+        with self.assertRaises(BreakerOpen) as raised:
+            tts.synthesize("Hello", "idera")
+        self.assertEqual(provider.requests, 4)
+        self.assertEqual(raised.exception.retry_after, 30)
+
+        now[0] += 31
+        self.assertEqual(resilience.breaker.state, HALF_OPEN)
+        self.assertEqual(tts.synthesize("Hello", "idera"), b"ID3audio")
+        self.assertEqual(resilience.breaker.state, CLOSED)
+
+    def test_cancelled_trial_call_leaves_the_circuit_half_open(self):
+        now = [0.0]
+        resilience = self.resilience(clock=lambda: now[0])
+        resilience.breaker._open()
+        now[0] += 31
+
+        async def main():
+            started = asyncio.Event()
+
+            async def stall():
+                started.set()
+                await asyncio.sleep(10)
+
+            async def answer():
+                return "Hello"
+
+            # The trial call is cancelled, as when the client goes away
+            trial = asyncio.ensure_future(resilience.acall(stall))
+            await started.wait()
+            trial.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await trial
+            self.assertEqual(resilience.breaker.state, HALF_OPEN)
+            return await resilience.acall(answer)
+
+        self.assertEqual(asyncio.run(main()), "Hello")
+        self.assertEqual(resilience.breaker.state, CLOSED)
+
+    def test_slow_calls_and_client_errors(self):
+        breaker = CircuitBreaker("llm", window=4, min_calls=4, slow_call=1)
+        for _ in range(3):
+            breaker.record(False, 2.0)  # Answered, but too slowly
+        # A 400 says nothing about the provider's health
+        breaker.record(None)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(False, 0.1)
+        self.assertEqual(breaker.state, OPEN)
+
+        error = Exception("bad request")
+        error.status_code = 400
+        self.assertFalse(is_provider_fault(error))
+        error.status_code = 429
+        self.assertTrue(is_provider_fault(error))
+
+    def test_stalled_provider_times_out(self):
+        provider = self.provider(default=(200, 2))
+        tts = self.tts(provider, self.resilience())
+        tts.timeout = (1, 0.2)
+        began = time.monotonic()
+        with self.assertRaisesRegex(Exception, "TTS error"):
+            tts.synthesize("Hello", "idera")
+        self.assertLess(time.monotonic() - began, 1)
+
+    def prime(self, resilience, seconds=0.02, calls=20):
+        for _ in range(calls):
+            resilience.latencies.add(seconds)
+            resilience._hedge_tokens = 10
+
+    def test_slow_call_is_hedged(self):
+        # The first request stalls; the hedge, sent at the p95, answers
+        provider = self.provider(script=[(200, 1.5)])
+        resilience = self.resilience(hedge=True)
+        self.prime(resilience)
+        tts = self.tts(provider, resilience)
+        began = time.monotonic()
+        self.assertEqual(tts.synthesize("Hello", "idera"), b"ID3audio")
+        self.assertLess(time.monotonic() - began, 1)
+        self.assertEqual(provider.requests, 2)
+        stats = resilience.stats()
+        self.assertEqual((stats["hedged"], stats["hedges_won"]), (1, 1))
+
+    def test_async_hedge_cancels_the_loser(self):
+        provider = self.provider(script=[(200, 1.5)])
+        resilience = self.resilience(hedge=True)
+        self.prime(resilience)
+
+        async def main():
+            tts = self.tts(provider, resilience, service=AsyncTTSService)
+            try:
+                return await tts.synthesize("Hello", "idera")
+            finally:
+                await tts.aclose()
+
+        began = time.monotonic()
+        self.assertEqual(asyncio.run(main()), b"ID3audio")
+        self.assertLess(time.monotonic() - began, 1)
+        self.assertEqual(resilience.stats()["hedges_won"], 1)
+
+    def test_hedges_are_budgeted(self):
+        provider = self.provider(default=(200, 0.1))
+        resilience = self.resilience(hedge=True, hedge_budget=0)
+        self.prime(resilience)
+        resilience._hedge_tokens = 0
+        tts = self.tts(provider, resilience)
+        tts.synthesize("Hello", "idera")
+        self.assertEqual(provider.requests, 1)
+        self.assertEqual(resilience.stats()["hedged"], 0)
+
+
+class DeadlineTests(TestCase):
+    def provider(self, *args, **kwargs):
+        provider = FaultyProvider(*args, **kwargs)
+        self.addCleanup(provider.server_close)
+        self.addCleanup(provider.shutdown)
+        return provider
+
+    def test_budget_fits_attempts_into_the_time_left(self):
+        now = [0.0]
+        deadline = Deadline(10, clock=lambda: now[0])
+        # A full 60s timeout can't fit twice, so the retry is dropped
+        self.assertEqual(deadline.budget("llm", 60, 1, reserve=2), (8, 0))
+        # Calls usually answer in 2s: both attempts fit, 4s each
+        self.assertEqual(deadline.budget("llm", 60, 1, reserve=2, expected=2), (4, 1))
+
+        now[0] = 7.5
+        with self.assertRaises(DeadlineExceeded) as raised:
+            deadline.budget("llm", 60, reserve=2)
+        self.assertEqual(raised.exception.stage, "llm")
+
+    def test_header_is_clamped(self):
+        factory = RequestFactory()
+        cases = [("1", 5), ("12.5", 12.5), ("600", 90), ("soon", 30)]
+        # Parse as floats, but aren't a number of seconds
+        cases += [("nan", 30), ("inf", 30), ("-inf", 30)]
+        for header, seconds in cases:
+            request = factory.post("/", HTTP_X_REQUEST_TIMEOUT=header)
+            self.assertEqual(Deadline.for_request(request).seconds, seconds)
+
+    @override_settings(DEADLINE_DB_SECONDS=0, DEADLINE_TTS_SECONDS=0.1)
+    def test_tts_timeout_is_cut_to_the_deadline(self):
+        provider = self.provider(default=(200, 2))
+        breaker = CircuitBreaker("tts", window=1, min_calls=1)
+        resilience = Resilience("tts", breaker)
+        tts = TTSService(resilience=resilience)
+        tts.api_url = provider.url
+        began = time.monotonic()
+        with self.assertRaisesRegex(Exception, "TTS error"):
+            tts.synthesize("Hello", "idera", Deadline(0.3))
+        self.assertLess(time.monotonic() - began, 1)
+        # Timing out early was our doing, not the provider's
+        self.assertEqual(resilience.stats()["failed"], 0)
+        self.assertEqual(breaker.state, CLOSED)
+
+        # Out of time: nothing is sent at all
+        with self.assertRaises(DeadlineExceeded):
+            tts.synthesize("Hello again", "idera", Deadline(0))
+        self.assertEqual(provider.requests, 1)
+
+    def test_busy_gate_near_the_deadline(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        gate = AdmissionGate("openai", directory, 1, 60000, 1, max_wait=5)
+        with gate.admit():
+            # Too little time left to queue: the stage is out of time
+            with self.assertRaises(DeadlineExceeded) as raised:
+                with admit(gate, Deadline(1.5), "llm"):
+                    pass
+            self.assertEqual(raised.exception.stage, "llm")
+
+            # A full queue is still a full queue, even with time to wait
+            def wait_in_line():
+                with gate.admit():
+                    pass
+
+            waiter = threading.Thread(target=wait_in_line)
+            waiter.start()
+            while not gate.stats()["queue_depth"]:
+                time.sleep(0.01)
+            with self.assertRaises(Overloaded) as raised:
+                with admit(gate, Deadline(3), "llm"):
+                    pass
+            self.assertTrue(raised.exception.queue_full)
+        waiter.join()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.metrics = Metrics(self.directory, flush_interval=3600)
+
+    def worker_file(self, pid, counters=(), gauges=(), histograms=()):
+        snapshot = {
+            "pid": pid,
+            "counters": list(counters),
+            "gauges": list(gauges),
+            "histograms": list(histograms),
+        }
+        with open(os.path.join(self.directory, f"{pid}.json"), "w") as f:
+            json.dump(snapshot, f)
+
+    def test_workers_are_added_up(self):
+        labels = {"input": "text", "stage": "llm", "voice": "Idera"}
+        self.metrics.inc("llm_tokens_total", 5, kind="prompt")
+        self.metrics.observe("stage_seconds", 0.2, **labels)
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        counts[-1] = 1  # Slower than every bucket
+        self.worker_file(
+            os.getppid(),
+            counters=[["llm_tokens_total", {"kind": "prompt"}, 7]],
+            gauges=[["circuit_open", {"service": "tts"}, 1]],
+            histograms=[["stage_seconds", labels, LATENCY_BUCKETS, counts, 90.0]],
+        )
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        self.worker_file(
+            exited.pid,
+            counters=[["llm_tokens_total", {"kind": "prompt"}, 1]],
+            gauges=[["circuit_open", {"service": "tts"}, 1]],
+        )
+
+        lines = self.metrics.render().splitlines()
+        self.assertIn("# TYPE mindvoice_stage_seconds histogram", lines)
+        # Exited workers' counts stay; their gauges don't
+        self.assertIn('mindvoice_llm_tokens_total{kind="prompt"} 13', lines)
+        self.assertIn('mindvoice_circuit_open{service="tts"} 1', lines)
+        series = 'input="text",stage="llm",voice="Idera"'
+        self.assertIn(f'mindvoice_stage_seconds_bucket{{{series},le="0.25"}} 1', lines)
+        self.assertIn(f'mindvoice_stage_seconds_bucket{{{series},le="+Inf"}} 2', lines)
+        self.assertIn(f"mindvoice_stage_seconds_sum{{{series}}} 90.2", lines)
+        self.assertIn(f"mindvoice_stage_seconds_count{{{series}}} 2", lines)
+
+    def test_flush_and_spans(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.span("stt", input="audio"):
+                raise ValueError
+        list(self.metrics.first(iter([b"a", b"b"]), "tts"))
+        self.metrics.flush()
+
+        with open(os.path.join(self.directory, f"{os.getpid()}.json")) as f:
+            snapshot = json.load(f)
+        stages = sorted(labels["stage"] for _, labels, *_ in snapshot["histograms"])
+        self.assertEqual(stages, ["stt", "tts"])
+
+
+class SentenceBufferTests(TestCase):
+    def test_deltas_are_regrouped_into_sentences(self):
+        buffer = SentenceBuffer()
+        self.assertEqual(
+            buffer.feed("I hear you, Ada. That sounds"), ["I hear you, Ada."]
+        )
+        self.assertEqual(buffer.feed(" heavy!\n"), ["That sounds heavy!"])
+        self.assertEqual(buffer.feed('"Take it slow." What'), ['"Take it slow."'])
+        self.assertEqual(buffer.flush(), ["What"])
+        self.assertEqual(buffer.flush(), [])
+
+    def test_short_sentences_are_merged_with_the_next(self):
+        deltas = ["Okay. ", "Yes. ", "Tell me more about it. ", "Hm."]
+        self.assertEqual(
+            list(iter_sentences(deltas)),
+            ["Okay. Yes. Tell me more about it.", "Hm."],
+        )
+        # Decimals and abbreviations without a space don't end a sentence
+        self.assertEqual(
+            list(iter_sentences(["It is 2.5 km away. ", "Go."], min_chars=0)),
+            ["It is 2.5 km away.", "Go."],
+        )
+
+    def test_async_deltas(self):
+        async def deltas():
+            for delta in ["Okay. ", "I understand that. ", "Go on"]:
+                yield delta
+
+        async def main():
+            return [sentence async for sentence in aiter_sentences(deltas())]
+
+        self.assertEqual(asyncio.run(main()), ["Okay. I understand that.", "Go on"])
+
+
+class TTSCacheTests(TestCase):
+    def test_concurrent_misses_are_coalesced(self):
+        cache = TTSCache(memory_bytes=1024)
+        key = cache_key("idera", "Hello")
+        self.assertIsNone(cache.claim(key))  # The leader
+        waiters = [cache.claim(key) for _ in range(2)]
+        self.assertIs(waiters[0], waiters[1])
+
+        cache.resolve(key, b"ID3audio")
+        self.assertEqual(waiters[0].result(timeout=1), b"ID3audio")
+        self.assertEqual(cache.get(key), b"ID3audio")
+        stats = cache.stats()
+        self.assertEqual((stats["misses"], stats["coalesced"]), (1, 2))
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_leader_errors_reach_the_waiters(self):
+        cache = TTSCache(memory_bytes=1024)
+        key = cache_key("idera", "Hello")
+        cache.claim(key)
+        waiter = cache.claim(key)
+        cache.resolve(key, error=Exception("TTS error: down"))
+        with self.assertRaisesRegex(Exception, "down"):
+            waiter.result(timeout=1)
+        # Nothing was cached, so the next caller leads a fresh attempt
+        self.assertIsNone(cache.get(key))
+        self.assertIsNone(cache.claim(key))
+
+    def test_waiters_synthesize_themselves_when_the_leader_is_abandoned(self):
+        cache = TTSCache(memory_bytes=1024)
+        tts = TTSService(cache=cache)
+        tts._stream_synthesize = mock.Mock(return_value=iter([b"ID3", b"audio"]))
+        tts._synthesize = mock.Mock(return_value=b"ID3audio")
+        leader = tts.stream_synthesize("Hello", "idera")
+        self.assertEqual(next(leader), b"ID3")
+
+        waiter = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(waiter.shutdown)
+        audio = waiter.submit(tts.synthesize, "Hello", "idera")
+        while not cache.stats()["coalesced"]:
+            time.sleep(0.01)
+        leader.close()  # The leader's client went away mid-sentence
+        self.assertEqual(audio.result(timeout=1), b"ID3audio")
+        tts._synthesize.assert_called_once()
+
+    def test_waiters_give_up_at_the_deadline(self):
+        cache = TTSCache(memory_bytes=1024)
+        cache.claim(cache_key("idera", "Hello"))  # A leader that never finishes
+        tts = TTSService(cache=cache)
+        began = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            tts.synthesize("Hello", "idera", Deadline(0.1))
+        self.assertLess(time.monotonic() - began, 1)
+
+    def test_disk_evicts_least_recently_used_down_to_90_percent(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        disk = DiskStore(directory, max_bytes=1000)
+        keys = [cache_key("idera", str(i)) for i in range(11)]
+        for age, key in enumerate(keys[:10]):
+            disk.put(key, b"x" * 100)
+            os.utime(disk._path(key), (1000 + age, 1000 + age))
+        disk.get(keys[0])  # Reading it makes it the most recently used
+
+        disk.put(keys[10], b"x" * 100)
+        self.assertEqual(disk.evictions, 2)
+        self.assertEqual(
+            [key for key in keys if disk.get(key) is None], [keys[1], keys[2]]
+        )
+        self.assertEqual(disk._scan_size(), 900)
+
+
+class AudioSpoolTests(TestCase):
+    def test_tee_passes_chunks_through_and_keeps_a_copy(self):
+        with AudioSpool(max_memory=4) as spool:
+            self.assertEqual(
+                list(spool.tee(iter([b"ID3", b"ab", b"cd"]))), [b"ID3", b"ab", b"cd"]
+            )
+            self.assertEqual(spool.size, 7)
+            # Past max_memory the spool has spilled to a temp file
+            self.assertTrue(spool.file._rolled)
+            self.assertEqual(spool.as_file("reply.mp3").read(), b"ID3abcd")
+
+    def test_atee(self):
+        async def chunks():
+            for chunk in [b"ID3", b"ab"]:
+                yield chunk
+
+        async def main(spool):
+            return [chunk async for chunk in spool.atee(chunks())]
+
+        with AudioSpool() as spool:
+            self.assertEqual(asyncio.run(main(spool)), [b"ID3", b"ab"])
+            self.assertFalse(spool.file._rolled)
+            stored = spool.as_file("reply.mp3")
+            self.assertEqual((stored.name, stored.read()), ("reply.mp3", b"ID3ab"))
+
+    def test_abandoned_stream_keeps_what_was_sent(self):
+        with AudioSpool() as spool:
+            chunks = spool.tee(iter([b"ID3", b"ab", b"cd"]))
+            next(chunks)
+            chunks.close()
+            self.assertEqual(spool.as_file("reply.mp3").read(), b"ID3")
+
+
+@override_settings(AUDIO_UPLOAD_MAX_BYTES=1000)
+class AudioUploadLimitTests(TestCase):
+    def post(self, size):
+        stt = mock.Mock()
+        with mock.patch.object(registry, "stt", return_value=stt):
+            response = self.client.post(
+                "/api/voice_input/",
+                {"audio": ContentFile(b"x" * size, name="q.webm")},
+            )
+        return response, stt
+
+    def handler(self, content_length):
+        request = RequestFactory().post("/api/voice_input/")
+        handler = AudioUploadLimitHandler(request)
+        handler.handle_raw_input(None, request.META, content_length, b"--b")
+        return request, handler
+
+    def test_declared_length_over_the_cap_is_cut_off_unread(self):
+        request, handler = self.handler(1000 + MULTIPART_OVERHEAD + 1)
+        with self.assertRaises(StopUpload) as raised:
+            handler.new_file("audio", "q.webm", "audio/webm", None)
+        self.assertTrue(raised.exception.connection_reset)
+        self.assertIn("limit", request.audio_upload_error)
+
+    def test_streamed_bytes_over_the_cap_stop_the_upload(self):
+        # Small enough declared length, so only the streamed bytes tell
+        request, handler = self.handler(1500)
+        handler.new_file("audio", "q.webm", "audio/webm", None)
+        self.assertEqual(handler.receive_data_chunk(b"x" * 600, 0), b"x" * 600)
+        with self.assertRaises(StopUpload) as raised:
+            handler.receive_data_chunk(b"x" * 600, 600)
+        self.assertFalse(raised.exception.connection_reset)
+
+    def test_oversized_recording_is_a_413_before_stt(self):
+        response, stt = self.post(1500)
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("limit", response.json()["error"])
+        stt.transcribe.assert_not_called()
+
+    def test_async_stt_sends_the_upload_as_bytes(self):
+        # AsyncOpenAI would read a file handle on the event loop
+        client = mock.Mock()
+        create = mock.AsyncMock(return_value=mock.Mock(text="Hello"))
+        client.with_options.return_value.audio.transcriptions.create = create
+        stt = AsyncSTTService(client=client)
+
+        audio = SimpleUploadedFile("q.webm", b"x" * 600, "audio/webm")
+        self.assertEqual(asyncio.run(stt.transcribe(audio)), "Hello")
+        self.assertEqual(
+            create.call_args.kwargs["file"], ("q.webm", b"x" * 600, "audio/webm")
+        )
+
+        create.reset_mock()
+        audio = SimpleUploadedFile("q.webm", b"x" * 1500, "audio/webm")
+        with self.assertRaises(AudioUploadRejected):
+            asyncio.run(stt.transcribe(audio))
+        create.assert_not_called()
+
+
+@skipUnless(np is not None, "VAD needs NumPy")
+class VoiceActivityTests(TestCase):
+    def frames(self, *parts):
+        """Concatenated 30 ms frames of each (kind, count) part"""
+        rng = np.random.default_rng(7)
+        frame = SAMPLE_RATE * FRAME_MS // 1000
+        chunks = []
+        for kind, count in parts:
+            n = frame * count
+            if kind == "noise":
+                chunk = rng.normal(0, 50, n)
+            elif kind == "voiced":
+                chunk = 8000 * np.sin(2 * np.pi * 200 * np.arange(n) / SAMPLE_RATE)
+            else:  # A quiet hiss crossing zero at every sample, like "s"
+                chunk = np.resize([230, -230], n)
+            chunks.append(chunk)
+        return np.concatenate(chunks).astype(np.int16)
+
+    def test_speech_frames(self):
+        samples = self.frames(("noise", 10), ("voiced", 5), ("unvoiced", 2))
+        speech = speech_frames(samples)
+        self.assertEqual(speech.tolist(), [False] * 10 + [True] * 5 + [True] * 2)
+        self.assertFalse(speech_frames(self.frames(("noise", 20))).any())
+        self.assertEqual(len(speech_frames(np.zeros(100, dtype=np.int16))), 0)
+
+    def test_keep_frames_pads_speech_and_collapses_pauses(self):
+        speech = np.array([0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0, 0], dtype=bool)
+        keep = keep_frames(speech, pad_frames=1, max_pause_frames=2)
+        # Padded to frames 2-5 and 9-11; the pause between is cut to two
+        # frames, and the silence around the speech is dropped
+        self.assertEqual(
+            keep.astype(int).tolist(), [0, 0, 1, 1, 1, 1, 1, 1, 0, 1, 1, 1, 0]
+        )
+        self.assertFalse(keep_frames(np.zeros(5, dtype=bool), 1, 2).any())
+
+
+class PromptBuilderTests(TestCase):
+    def history(self, count):
+        return [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " * 5}
+            for i in range(count)
+        ]
+
+    def test_newest_history_that_fits_the_budget(self):
+        history = self.history(6)
+        cost = count_message_tokens(history[:1])
+        builder = PromptBuilder("Be kind.", history_budget=4 * cost - 1)
+        messages, stats = builder.build("How are you?", history)
+
+        self.assertEqual(messages[1:-1], history[3:])
+        self.assertEqual(messages[-1], {"role": "user", "content": "How are you?"})
+        self.assertEqual((stats["history_messages"], stats["dropped_messages"]), (3, 3))
+        self.assertEqual(stats["prompt_tokens"], count_message_tokens(messages))
+
+        # The summary is paid for out of the same budget
+        summary = "Ada is anxious about exams."
+        messages, stats = builder.build("How are you?", history, summary)
+        self.assertIn(summary, messages[1]["content"])
+        self.assertLess(stats["history_messages"], 3)
+
+    def test_long_messages_are_capped(self):
+        builder = PromptBuilder("Be kind.", message_limit=20)
+        long = {"role": "user", "content": "word " * 200}
+        messages, _ = builder.build("Hi", [long])
+        self.assertTrue(messages[1]["content"].endswith(" …"))
+        self.assertLessEqual(count_tokens(messages[1]["content"]), 22)
+
+    def test_system_prefix_is_byte_for_byte_stable(self):
+        builder = PromptBuilder(SYSTEM_PROMPT)
+        prefixes = {
+            json.dumps(builder.build(text, history, summary)[0][0])
+            for text, history, summary in [
+                ("Hi", [], ""),
+                ("I can't sleep", self.history(4), "Ada has exams."),
+                ("Thanks", self.history(40), "Ada slept better."),
+            ]
+        }
+        self.assertEqual(
+            prefixes, {json.dumps({"role": "system", "content": SYSTEM_PROMPT})}
+        )
@@ -0,0 +1,268 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(voice, text):
+    """Content address of a synthesis: hash of (voice, normalized text)"""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    digest = hashlib.sha256(f"{voice.capitalize()}\0{normalized}".encode())
+    return digest.hexdigest()
+
+
+class MemoryLRU:
+    """In-memory LRU of audio blobs bounded by total bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskStore:
+    """
+    Bounded on-disk blob store shared by all workers on a host
+
+    Files are written atomically (temp file + rename) so concurrent workers
+    never read partial audio. Reads bump mtime, and once the tracked size
+    passes ``max_bytes`` the directory is rescanned and the least recently
+    used files are removed down to 90% of the budget.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, key):
+        return self.directory / key[:2] / f"{key}.mp3"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                yield from (
+                    entry
+                    for entry in os.scandir(shard.path)
+                    if entry.name.endswith(".mp3")
+                )
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._files())
+
+    def _evict(self):
+        entries = sorted(
+            ((entry.stat(), entry.path) for entry in self._files()),
+            key=lambda item: item[0].st_mtime,
+        )
+        size = sum(stat.st_size for stat, _ in entries)
+        target = self.max_bytes * 0.9
+        for stat, path in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            size -= stat.st_size
+            self.evictions += 1
+        self._size = size
+
+
+class TTSCache:
+    """
+    Two-tier (memory LRU + disk) cache of synthesized audio
+
+    Identical concurrent syntheses are coalesced: the first caller for a key
+    becomes the leader and the others wait on its Future. Coalescing is per
+    process; the disk tier is what workers share.
+    """
+
+    def __init__(
+        self, memory_bytes, disk_dir=None, disk_bytes=0, max_entry_bytes=1024**2
+    ):
+        self.memory = MemoryLRU(memory_bytes)
+        # Larger syntheses are streamed through without being cached
+        self.max_entry_bytes = max_entry_bytes
+        self.disk = DiskStore(disk_dir, disk_bytes) if disk_dir and disk_bytes else None
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get_memory(self, key):
+        with self._lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.counters["memory_hits"] += 1
+        return data
+
+    def get_disk(self, key):
+        if self.disk is None:
+            return None
+        data = self.disk.get(key)
+        if data is not None:
+            self._count("disk_hits")
+            with self._lock:
+                self.memory.put(key, data)
+        return data
+
+    def get(self, key):
+        """Return cached audio for ``key`` or None (no miss is counted)"""
+        data = self.get_memory(key)
+        if data is None:
+            data = self.get_disk(key)
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self.memory.put(key, data)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, data)
+            except OSError as e:
+                logger.warning("TTS cache disk write failed: %s", e)
+
+    def claim(self, key):
+        """
+        Register interest in synthesizing ``key``
+
+        Returns:
+            Future or None: None if the caller is now the leader and must call
+            ``resolve``; otherwise a Future that completes with the leader's
+            audio (None if it was too large to cache) or exception
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return future
+            self._in_flight[key] = Future()
+            self.counters["misses"] += 1
+            return None
+
+    def resolve(self, key, data=None, error=None):
+        """Finish a claimed synthesis, storing ``data`` and waking any waiters"""
+        if error is None and data and len(data) <= self.max_entry_bytes:
+            self.put(key, data)
+        with self._lock:
+            future = self._in_flight.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(data)
+
+    def get_or_synthesize(self, key, synthesize, wait=Future.result):
+        """
+        Return cached audio, waiting on or running ``synthesize()`` on a miss
+
+        Args:
+            key: Cache key of the audio
+            synthesize: Produces the audio when this caller leads
+            wait: Returns the leader's result from its Future, e.g. within a
+                deadline (by default, however long it takes)
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        future = self.claim(key)
+        if future is not None:
+            data = wait(future)
+            if data is not None:
+                return data
+            # The leader's audio was too large to cache, or abandoned
+            return synthesize()
+
+        try:
+            data = synthesize()
+        except Exception as e:
+            self.resolve(key, error=e)
+            raise
+        self.resolve(key, data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(
+                memory_entries=len(self.memory),
+                memory_bytes=self.memory.size,
+                memory_evictions=self.memory.evictions,
+                in_flight=len(self._in_flight),
+            )
+        if self.disk is not None:
+            stats["disk_evictions"] = self.disk.evictions
+        return stats
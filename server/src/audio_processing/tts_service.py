@@ -1,58 +1,451 @@
+import asyncio
+import concurrent.futures
+import logging
 import os
 
+import httpx
 import requests
+from django.conf import settings
+
+from .admission import UNLIMITED, Overloaded, aread_ahead, read_ahead
+from .audio_spool import AudioSpool
+from .deadline import DeadlineExceeded, aadmit, admit
+from .metrics import metrics
+from .resilience import DIRECT
+from .tts_cache import cache_key
+
+logger = logging.getLogger(__name__)
+
+
+class YarnGPTError(Exception):
+    """YarnGPT answered with an error status"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def yarngpt_timeout():
+    """(connect, read) seconds for YarnGPT requests"""
+    return (settings.UPSTREAM_CONNECT_TIMEOUT, settings.YARNGPT_TIMEOUT)
+
+
+def _received(size):
+    metrics.inc("upstream_bytes_total", size, service="tts", direction="received")
+
+
+def _iter_cached(data, chunk_size=8192):
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start : start + chunk_size]
+
+
+class _CacheCollector:
+    """Collects streamed chunks for the cache, giving up past ``max_bytes``"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.size = 0
+
+    def add(self, chunk):
+        self.size += len(chunk)
+        if self.chunks is None:
+            return
+        if self.size > self.max_bytes:
+            self.chunks = None
+        else:
+            self.chunks.append(chunk)
+
+    def data(self):
+        return b"".join(self.chunks) if self.chunks is not None else None
 
 
 class TTSService:
     """Text-to-Speech using YarnGPT API"""
 
-    def __init__(self):
+    def __init__(
+        self, session=None, cache=None, canned=None, gate=UNLIMITED, resilience=DIRECT
+    ):
         self.api_key = os.getenv("YARNGPT_API_KEY")
         self.api_url = os.getenv("YARNGPT_API_URL", "https://yarngpt.ai/api/v1/tts")
-        print(f"TTS Service initialized with URL: {self.api_url}")
+        # A shared requests.Session keeps connections to YarnGPT alive
+        self.session = session or requests
+        # Optional TTSCache; repeated (voice, text) pairs skip YarnGPT entirely
+        self.cache = cache
+        # Optional CannedAudioStore of pre-rendered fixed utterances
+        self.canned = canned
+        # AdmissionGate for YarnGPT; cached and canned audio bypass it
+        self.gate = gate
+        # Circuit breaker and hedging; while the circuit is open synthesis
+        # fails at once and the voice views answer with text only
+        self.resilience = resilience
+        self.timeout = yarngpt_timeout()
+        logger.debug("TTS service initialized with URL: %s", self.api_url)
+
+    def _prepare(self, text, voice):
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+
+        # YarnGPT expects capitalized voice names (Idera, not idera)
+        voice_capitalized = voice.capitalize()
+
+        payload = {"text": text, "voice": voice_capitalized}
+
+        logger.debug(
+            "Sending TTS request: voice=%s, text_length=%d",
+            voice_capitalized,
+            len(text),
+        )
+        return headers, payload
 
-    def synthesize(self, text, voice="Chinenye"):
+    def _error_message(self, response):
+        error_msg = f"YarnGPT API returned {response.status_code}"
+        try:
+            error_detail = response.json()
+            error_msg += f": {error_detail}"
+        except:
+            error_msg += f": {response.text}"
+        return error_msg
+
+    def _timeout(self, deadline):
+        """
+        (connect, read) timeout that leaves time to save the turn, and
+        whether it was cut short to fit
+
+        Raises:
+            DeadlineExceeded: Too little time is left; the turn goes text-only
+        """
+        if deadline is None:
+            return self.timeout, False
+        connect, read = self.timeout
+        budget, _ = deadline.budget(
+            "tts",
+            read,
+            reserve=settings.DEADLINE_DB_SECONDS,
+            minimum=settings.DEADLINE_TTS_SECONDS,
+        )
+        return (min(connect, budget), budget), budget < read
+
+    def _admit(self, deadline):
+        return admit(
+            self.gate,
+            deadline,
+            "tts",
+            settings.DEADLINE_DB_SECONDS,
+            settings.DEADLINE_TTS_SECONDS,
+        )
+
+    def _aadmit(self, deadline):
+        return aadmit(
+            self.gate,
+            deadline,
+            "tts",
+            settings.DEADLINE_DB_SECONDS,
+            settings.DEADLINE_TTS_SECONDS,
+        )
+
+    def _wait_for(self, future, deadline):
+        """Another request's synthesis of the same audio, within our deadline"""
+        try:
+            return future.result(None if deadline is None else deadline.remaining())
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceeded("tts", 0)
+
+    def _request(self, text, voice, timeout=None):
+        headers, payload = self._prepare(text, voice)
+
+        response = self.session.post(
+            self.api_url,
+            headers=headers,
+            json=payload,
+            stream=True,
+            timeout=timeout or self.timeout,
+        )
+
+        if response.status_code != 200:
+            with response:
+                raise YarnGPTError(self._error_message(response), response.status_code)
+
+        return response
+
+    def _open(self, text, voice, deadline=None):
+        """Send the request through the breaker (and hedging, up to headers)"""
+        timeout, cut_short = self._timeout(deadline)
+        return self.resilience.call(
+            lambda: self._request(text, voice, timeout),
+            discard=lambda r: r.close(),
+            blame_timeouts=not cut_short,
+        )
+
+    def synthesize(self, text, voice="Chinenye", deadline=None):
         """
         Convert text to speech using YarnGPT
 
         Args:
             text: Text to convert
             voice: Voice variant to use (case-insensitive, will be capitalized)
+            deadline: The turn's Deadline (optional). Canned and cached
+                audio is returned however late it is
 
         Returns:
             bytes: Audio data
+
+        Raises:
+            DeadlineExceeded: Too little time was left to call YarnGPT, or
+                to wait for another request synthesizing the same text
+        """
+        if self.canned is not None:
+            data = self.canned.get(voice, text)
+            if data is not None:
+                return data
+        if self.cache is None:
+            return self._synthesize(text, voice, deadline)
+        return self.cache.get_or_synthesize(
+            cache_key(voice, text),
+            lambda: self._synthesize(text, voice, deadline),
+            wait=lambda future: self._wait_for(future, deadline),
+        )
+
+    def _synthesize(self, text, voice, deadline=None):
+        try:
+            with self._admit(deadline):
+                response = self._open(text, voice, deadline)
+
+                # Collect audio chunks (joined once, not re-copied per chunk)
+                with response:
+                    audio_data = b"".join(response.iter_content(chunk_size=8192))
+            logger.debug("TTS success: %d bytes received", len(audio_data))
+            _received(len(audio_data))
+            return audio_data
+
+        except (Overloaded, DeadlineExceeded):
+            raise
+        except Exception as e:
+            raise Exception(f"TTS error: {str(e)}")
+
+    def stream_synthesize(self, text, voice="Chinenye", deadline=None):
+        """
+        Convert text to speech, yielding audio as YarnGPT sends it
+
+        Args:
+            text: Text to convert
+            voice: Voice variant to use (case-insensitive, will be capitalized)
+            deadline: The turn's Deadline (optional), as for ``synthesize``
+
+        Yields:
+            bytes: MP3 audio chunks, in order
+        """
+        if self.canned is not None:
+            data = self.canned.get(voice, text)
+            if data is not None:
+                yield from _iter_cached(data)
+                return
+        if self.cache is None:
+            yield from self._stream_synthesize(text, voice, deadline)
+            return
+
+        key = cache_key(voice, text)
+        data = self.cache.get(key)
+        if data is None:
+            future = self.cache.claim(key)
+            if future is None:
+                yield from self._stream_as_leader(key, text, voice, deadline)
+                return
+            # Someone else is already synthesizing this exact text
+            data = self._wait_for(future, deadline)
+            if data is None:
+                # Too large to cache; stream our own copy
+                yield from self._stream_synthesize(text, voice, deadline)
+                return
+        yield from _iter_cached(data)
+
+    def tee(self, text, voice, spool=None, deadline=None):
+        """
+        Stream synthesized audio while spooling a copy for storage
+
+        Args:
+            text: Text to convert
+            voice: Voice variant to use
+            spool: AudioSpool to append to (a new one is created if omitted)
+            deadline: The turn's Deadline (optional)
+
+        Returns:
+            tuple: (chunk iterator, AudioSpool). Iterate the chunks to drive
+            the upstream request; the spool is complete once they are exhausted
         """
+        spool = spool or AudioSpool(settings.AUDIO_SPOOL_MAX_MEMORY)
+        return spool.tee(self.stream_synthesize(text, voice, deadline)), spool
+
+    def _stream_as_leader(self, key, text, voice, deadline=None):
+        # Only entries small enough to cache are collected, so memory per
+        # stream stays bounded however long the audio is
+        collector = _CacheCollector(self.cache.max_entry_bytes)
         try:
-            headers = {"Authorization": f"Bearer {self.api_key}"}
+            for chunk in self._stream_synthesize(text, voice, deadline):
+                collector.add(chunk)
+                yield chunk
+        except Exception as e:
+            self.cache.resolve(key, error=e)
+            raise
+        except GeneratorExit:
+            # Client went away mid-sentence; nothing is wrong with YarnGPT, so
+            # waiters get None and synthesize themselves
+            self.cache.resolve(key, None)
+            raise
+        self.cache.resolve(key, collector.data())
+
+    def _stream_synthesize(self, text, voice, deadline=None):
+        try:
+            # Read ahead, so the slot is freed when YarnGPT finishes rather
+            # than when the client has downloaded the audio
+            yield from read_ahead(self._stream_upstream(text, voice, deadline))
+        except (Overloaded, DeadlineExceeded):
+            raise
+        except Exception as e:
+            raise Exception(f"TTS error: {str(e)}")
 
-            # YarnGPT expects capitalized voice names (Idera, not idera)
-            voice_capitalized = voice.capitalize()
+    def _stream_upstream(self, text, voice, deadline=None):
+        """Audio chunks from YarnGPT, holding an admission slot throughout"""
+        with self._admit(deadline):
+            response = self._open(text, voice, deadline)
+            received = 0
+            try:
+                with response:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        if chunk:
+                            received += len(chunk)
+                            yield chunk
+            finally:
+                _received(received)
 
-            payload = {"text": text, "voice": voice_capitalized}
 
-            print(
-                f"Sending TTS request: voice={voice_capitalized}, text_length={len(text)}"
-            )
+class AsyncTTSService(TTSService):
+    """Text-to-Speech using YarnGPT API (asyncio, via httpx)"""
+
+    def __init__(
+        self, client=None, cache=None, canned=None, gate=UNLIMITED, resilience=DIRECT
+    ):
+        super().__init__(cache=cache, canned=canned, gate=gate, resilience=resilience)
+        connect, read = self.timeout
+        self.client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect)
+        )
+
+    async def aclose(self):
+        """Close the underlying HTTP client before the event loop goes away"""
+        await self.client.aclose()
+
+    async def synthesize(self, text, voice="Chinenye", deadline=None):
+        """Async variant of TTSService.synthesize"""
+        chunks = [
+            chunk async for chunk in self.stream_synthesize(text, voice, deadline)
+        ]
+        audio_data = b"".join(chunks)
+        logger.debug("TTS success: %d bytes received", len(audio_data))
+        return audio_data
 
-            response = requests.post(
-                self.api_url, headers=headers, json=payload, stream=True
+    async def _await(self, future, deadline):
+        """Async variant of ``_wait_for``"""
+        # Shielded: timing out must not cancel the leader's shared future
+        waiting = asyncio.shield(asyncio.wrap_future(future))
+        try:
+            return await asyncio.wait_for(
+                waiting, None if deadline is None else deadline.remaining()
             )
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("tts", 0)
+
+    async def stream_synthesize(self, text, voice="Chinenye", deadline=None):
+        """Async variant of TTSService.stream_synthesize"""
+        if self.canned is not None:
+            data = self.canned.get(voice, text)
+            if data is not None:
+                for chunk in _iter_cached(data):
+                    yield chunk
+                return
+        if self.cache is None:
+            async for chunk in self._stream_synthesize(text, voice, deadline):
+                yield chunk
+            return
 
-            if response.status_code == 200:
-                # Collect audio chunks
-                audio_data = b""
-                for chunk in response.iter_content(chunk_size=8192):
-                    audio_data += chunk
-                print(f"✓ TTS Success: {len(audio_data)} bytes received")
-                return audio_data
-            else:
-                error_msg = f"YarnGPT API returned {response.status_code}"
-                try:
-                    error_detail = response.json()
-                    error_msg += f": {error_detail}"
-                except:
-                    error_msg += f": {response.text}"
-                raise Exception(error_msg)
+        key = cache_key(voice, text)
+        data = self.cache.get_memory(key)
+        if data is None:
+            data = await asyncio.to_thread(self.cache.get_disk, key)
+        if data is None:
+            future = self.cache.claim(key)
+            if future is None:
+                async for chunk in self._stream_as_leader(key, text, voice, deadline):
+                    yield chunk
+                return
+            data = await self._await(future, deadline)
+            if data is None:
+                async for chunk in self._stream_synthesize(text, voice, deadline):
+                    yield chunk
+                return
+        for chunk in _iter_cached(data):
+            yield chunk
 
+    async def _stream_as_leader(self, key, text, voice, deadline=None):
+        collector = _CacheCollector(self.cache.max_entry_bytes)
+        try:
+            async for chunk in self._stream_synthesize(text, voice, deadline):
+                collector.add(chunk)
+                yield chunk
+        except Exception as e:
+            self.cache.resolve(key, error=e)
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            self.cache.resolve(key, None)
+            raise
+        self.cache.resolve(key, collector.data())
+
+    async def _arequest(self, text, voice, timeout=None):
+        headers, payload = self._prepare(text, voice)
+        request = self.client.build_request(
+            "POST",
+            self.api_url,
+            headers=headers,
+            json=payload,
+            timeout=(
+                httpx.USE_CLIENT_DEFAULT
+                if timeout is None
+                else httpx.Timeout(timeout[1], connect=timeout[0])
+            ),
+        )
+        response = await self.client.send(request, stream=True)
+        if response.status_code != 200:
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            raise YarnGPTError(self._error_message(response), response.status_code)
+        return response
+
+    async def _stream_synthesize(self, text, voice, deadline=None):
+        try:
+            upstream = self._stream_upstream(text, voice, deadline)
+            async for chunk in aread_ahead(upstream):
+                yield chunk
+        except (Overloaded, DeadlineExceeded):
+            raise
         except Exception as e:
             raise Exception(f"TTS error: {str(e)}")
+
+    async def _stream_upstream(self, text, voice, deadline=None):
+        """Async variant of TTSService._stream_upstream"""
+        async with self._aadmit(deadline):
+            timeout, cut_short = self._timeout(deadline)
+            response = await self.resilience.acall(
+                lambda: self._arequest(text, voice, timeout),
+                discard=lambda r: r.aclose(),
+                blame_timeouts=not cut_short,
+            )
+            received = 0
+            try:
+                async for chunk in response.aiter_bytes(chunk_size=8192):
+                    received += len(chunk)
+                    yield chunk
+            finally:
+                _received(received)
+                await response.aclose()
@@ -0,0 +1,148 @@
+import logging
+import shutil
+import subprocess
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+logger = logging.getLogger(__name__)
+
+# Multipart framing and the small form fields sent alongside the audio
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class AudioUploadRejected(Exception):
+    """The recording is over AUDIO_UPLOAD_MAX_BYTES or AUDIO_UPLOAD_MAX_SECONDS"""
+
+
+class AudioUploadLimitHandler(FileUploadHandler):
+    """
+    Upload handler that stops oversized request bodies while they stream in
+
+    Installed ahead of Django's default handlers on the voice endpoints. Those
+    keep uploads up to FILE_UPLOAD_MAX_MEMORY_SIZE in memory and spool larger
+    ones to a temporary file, so nothing past the cap is ever buffered. The
+    rejection reason is left on ``request.audio_upload_error``.
+    """
+
+    def __init__(self, request=None, max_bytes=None):
+        super().__init__(request)
+        self.max_bytes = max_bytes or settings.AUDIO_UPLOAD_MAX_BYTES
+        self.request_length = 0
+
+    def _reject(self, connection_reset=False):
+        self.request.audio_upload_error = (
+            f"Audio upload exceeds the {self.max_bytes / 1024**2:g} MB limit"
+        )
+        raise StopUpload(connection_reset=connection_reset)
+
+    def handle_raw_input(
+        self, input_data, META, content_length, boundary, encoding=None
+    ):
+        self.request_length = content_length
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        if self.request_length > self.max_bytes + MULTIPART_OVERHEAD:
+            # Declared too large: don't read the rest of the body at all
+            self._reject(connection_reset=True)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_bytes:
+            self._reject()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def ffmpeg_source(audio_file):
+    """
+    How to hand an upload to ffmpeg/ffprobe
+
+    Returns:
+        tuple: (input argument, stdin bytes or None). Spooled uploads are read
+        in place; in-memory ones (at most FILE_UPLOAD_MAX_MEMORY_SIZE) are piped
+    """
+    if hasattr(audio_file, "temporary_file_path"):
+        return audio_file.temporary_file_path(), None
+    audio_file.seek(0)
+    data = audio_file.read()
+    audio_file.seek(0)
+    return "pipe:0", data
+
+
+def probe_duration(audio_file):
+    """
+    Duration of an uploaded recording in seconds, read with ffprobe
+
+    Returns None when ffprobe is missing or the container doesn't say (e.g.
+    WebM from MediaRecorder), in which case only the size cap applies.
+    """
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        return None
+
+    source, stdin_data = ffmpeg_source(audio_file)
+
+    def run(*entries):
+        result = subprocess.run(
+            [ffprobe, "-v", "error", *entries, "-of", "csv=p=0", source],
+            input=stdin_data,
+            capture_output=True,
+            timeout=10,
+        )
+        values = []
+        for line in result.stdout.decode().split():
+            try:
+                values.append(float(line.strip(",")))
+            except ValueError:
+                continue
+        return values
+
+    try:
+        durations = run("-show_entries", "format=duration")
+        if not durations:
+            # No duration header: fall back to the last audio packet timestamp
+            durations = run(
+                "-select_streams", "a:0", "-show_entries", "packet=pts_time"
+            )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("ffprobe failed: %s", e)
+        return None
+    return max(durations) if durations else None
+
+
+def check_audio_upload(request, audio_file):
+    """
+    Enforce the upload limits before any upstream call
+
+    Args:
+        request: The request the upload arrived on
+        audio_file: Django UploadedFile, or None for text turns
+
+    Returns:
+        float or None: Duration in seconds, if it could be determined
+
+    Raises:
+        AudioUploadRejected: The recording is too large or too long
+    """
+    error = getattr(request, "audio_upload_error", None)
+    if error:
+        raise AudioUploadRejected(error)
+    if audio_file is None:
+        return None
+
+    max_bytes = settings.AUDIO_UPLOAD_MAX_BYTES
+    if audio_file.size > max_bytes:
+        raise AudioUploadRejected(
+            f"Audio upload exceeds the {max_bytes / 1024**2:g} MB limit"
+        )
+
+    duration = probe_duration(audio_file)
+    max_seconds = settings.AUDIO_UPLOAD_MAX_SECONDS
+    if duration is not None and duration > max_seconds:
+        raise AudioUploadRejected(
+            f"Audio is {duration:.0f}s long; the limit is {max_seconds:g}s"
+        )
+    return duration
@@ -0,0 +1,239 @@
+import logging
+import shutil
+import subprocess
+import threading
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from .uploads import ffmpeg_source
+
+try:
+    import numpy as np
+except ImportError:  # VAD is optional; the registry disables it without NumPy
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+
+# RMS (full scale = 1.0) below which a frame never counts as speech, ~-40 dBFS
+MIN_SPEECH_RMS = 0.01
+# Speech must clear the recording's own noise floor by this factor
+NOISE_FLOOR_RATIO = 3.0
+# Quiet frames with this many zero crossings per sample are unvoiced
+# consonants ("s", "f", "th") rather than silence
+UNVOICED_ZCR = 0.25
+
+# Trimmed audio is re-encoded as Opus, which Whisper accepts
+OPUS_BITRATE = "24k"
+
+
+class SilentAudio(Exception):
+    """The recording contains no detectable speech"""
+
+
+def vad_available():
+    """Whether NumPy and ffmpeg are both present"""
+    return np is not None and shutil.which("ffmpeg") is not None
+
+
+def _ffmpeg(args, stdin_data=None):
+    result = subprocess.run(
+        [shutil.which("ffmpeg"), "-v", "error", *args],
+        input=stdin_data,
+        capture_output=True,
+        timeout=60,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode().strip()}")
+    return result.stdout
+
+
+def decode_pcm(audio_file, sample_rate=SAMPLE_RATE):
+    """Decode an upload to mono 16-bit PCM samples"""
+    source, stdin_data = ffmpeg_source(audio_file)
+    pcm = _ffmpeg(
+        ["-i", source, "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+        stdin_data,
+    )
+    return np.frombuffer(pcm, dtype=np.int16)
+
+
+def encode_opus(samples, sample_rate=SAMPLE_RATE):
+    """Encode mono 16-bit PCM samples as Ogg/Opus"""
+    return _ffmpeg(
+        [
+            *("-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "-i", "pipe:0"),
+            *("-c:a", "libopus", "-b:a", OPUS_BITRATE, "-f", "ogg", "pipe:1"),
+        ],
+        samples.tobytes(),
+    )
+
+
+def speech_frames(samples, sample_rate=SAMPLE_RATE, frame_ms=FRAME_MS):
+    """
+    Classify fixed-size frames as speech from short-time energy and ZCR
+
+    The threshold adapts to the recording: a frame is speech when its RMS
+    clears both an absolute floor and a multiple of the quietest decile.
+    Quieter frames still count when their zero-crossing rate marks them as
+    unvoiced consonants.
+
+    Returns:
+        numpy.ndarray: One bool per whole frame
+    """
+    frame = sample_rate * frame_ms // 1000
+    count = len(samples) // frame
+    if count == 0:
+        return np.zeros(0, dtype=bool)
+
+    frames = samples[: count * frame].reshape(count, frame).astype(np.float32)
+    frames /= 32768.0
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    signs = np.signbit(frames).astype(np.int8)
+    zcr = np.mean(np.abs(np.diff(signs, axis=1)), axis=1)
+
+    threshold = max(np.percentile(rms, 10) * NOISE_FLOOR_RATIO, MIN_SPEECH_RMS)
+    return (rms > threshold) | ((rms > threshold / 2) & (zcr > UNVOICED_ZCR))
+
+
+def keep_frames(speech, pad_frames, max_pause_frames):
+    """
+    Frames to keep: speech padded on both sides, with leading and trailing
+    silence removed and internal pauses shortened to ``max_pause_frames``
+
+    Returns:
+        numpy.ndarray: One bool per frame (all False if there is no speech)
+    """
+    if not speech.any():
+        return speech
+
+    # Pad speech onsets and endings so word edges aren't clipped
+    if pad_frames:
+        window = np.ones(2 * pad_frames + 1)
+        speech = np.convolve(speech, window, mode="same") > 0
+
+    # Position of each frame within its current run of silence
+    index = np.arange(len(speech))
+    run_start = np.maximum.accumulate(np.where(speech, index + 1, 0))
+    keep = speech | (index - run_start < max_pause_frames)
+
+    voiced = np.flatnonzero(speech)
+    keep[: voiced[0]] = False
+    keep[voiced[-1] + 1 :] = False
+    return keep
+
+
+class SpeechTrimmer:
+    """
+    Optional pre-STT stage that cuts silence out of a recording
+
+    Decodes the upload to 16 kHz PCM, trims leading and trailing silence and
+    collapses long pauses, then re-encodes what is left for Whisper. Uploads
+    with no speech raise SilentAudio so they never reach the provider. When
+    there is little to trim, the original upload is passed through untouched.
+    Per-process totals are kept in ``counters`` to measure the savings.
+    """
+
+    def __init__(self, max_pause=0.6, padding=0.2, min_trim=0.5, min_speech=0.2):
+        self.max_pause = max_pause
+        self.padding = padding
+        self.min_trim = min_trim
+        self.min_speech = min_speech
+        self._lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "trimmed": 0,
+            "passed_through": 0,
+            "silent": 0,
+            "failed": 0,
+            "seconds_in": 0.0,
+            "seconds_trimmed": 0.0,
+            "bytes_in": 0,
+            "bytes_saved": 0,
+        }
+
+    def _record(self, outcome, stats):
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters[outcome] += 1
+            self.counters["seconds_in"] += stats["seconds_in"]
+            self.counters["seconds_trimmed"] += stats["seconds_trimmed"]
+            self.counters["bytes_in"] += stats["bytes_in"]
+            self.counters["bytes_saved"] += stats["bytes_saved"]
+
+    def process(self, audio_file):
+        """
+        Prepare an upload for STT
+
+        Args:
+            audio_file: Django UploadedFile
+
+        Returns:
+            tuple: (file to transcribe, per-request stats dict)
+
+        Raises:
+            SilentAudio: No speech was found
+        """
+        stats = {
+            "seconds_in": 0.0,
+            "seconds_trimmed": 0.0,
+            "bytes_in": audio_file.size,
+            "bytes_saved": 0,
+        }
+        try:
+            samples = decode_pcm(audio_file)
+        except (OSError, RuntimeError, subprocess.SubprocessError) as e:
+            # Let Whisper have a go at anything ffmpeg can't read
+            logger.warning("VAD skipped, could not decode audio: %s", e)
+            self._record("failed", stats)
+            return audio_file, stats
+
+        frame = SAMPLE_RATE * FRAME_MS // 1000
+        speech = speech_frames(samples)
+        keep = keep_frames(
+            speech,
+            pad_frames=int(self.padding * 1000 / FRAME_MS),
+            max_pause_frames=int(self.max_pause * 1000 / FRAME_MS),
+        )
+        stats["seconds_in"] = len(samples) / SAMPLE_RATE
+
+        if speech.sum() * FRAME_MS / 1000 < self.min_speech:
+            stats["seconds_trimmed"] = stats["seconds_in"]
+            stats["bytes_saved"] = audio_file.size
+            self._record("silent", stats)
+            logger.info("VAD: no speech in %.1fs of audio", stats["seconds_in"])
+            raise SilentAudio("No speech detected in the recording")
+
+        kept = samples[: len(keep) * frame][np.repeat(keep, frame)]
+        trimmed_seconds = stats["seconds_in"] - len(kept) / SAMPLE_RATE
+        if trimmed_seconds < self.min_trim:
+            self._record("passed_through", stats)
+            return audio_file, stats
+
+        try:
+            data = encode_opus(kept)
+        except (OSError, RuntimeError, subprocess.SubprocessError) as e:
+            logger.warning("VAD skipped, could not encode audio: %s", e)
+            self._record("failed", stats)
+            return audio_file, stats
+        if len(data) >= audio_file.size:
+            # Re-encoding a well-compressed upload can cost more than it saves
+            self._record("passed_through", stats)
+            return audio_file, stats
+
+        stats["seconds_trimmed"] = trimmed_seconds
+        stats["bytes_saved"] = audio_file.size - len(data)
+        self._record("trimmed", stats)
+        logger.debug(
+            "VAD: trimmed %.1fs of %.1fs, saved %d bytes",
+            trimmed_seconds,
+            stats["seconds_in"],
+            stats["bytes_saved"],
+        )
+        return SimpleUploadedFile("speech.ogg", data, "audio/ogg"), stats
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
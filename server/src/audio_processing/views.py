@@ -1 +1,77 @@
-# Create your views here.
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.permissions import BasePermission, IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .metrics import CONTENT_TYPE, metrics
+from .registry import registry
+
+
+class CanScrapeMetrics(BasePermission):
+    """Staff, or a scraper sending METRICS_TOKEN as a bearer token"""
+
+    def has_permission(self, request, view):
+        token = settings.METRICS_TOKEN
+        header = request.headers.get("Authorization", "")
+        if token and hmac.compare_digest(header.encode(), f"Bearer {token}".encode()):
+            return True
+        return bool(request.user and request.user.is_staff)
+
+
+class UpstreamPoolStatsView(APIView):
+    """Connection pool usage of this worker's upstream clients (staff only)"""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(registry.pool_stats())
+
+
+class TTSCacheStatsView(APIView):
+    """Hit/miss/eviction counters of this worker's TTS cache (staff only)"""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        cache = registry.tts_cache()
+        return Response(cache.stats() if cache else {"enabled": False})
+
+
+class VADStatsView(APIView):
+    """Silence trimmed before STT by this worker (staff only)"""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        trimmer = registry.vad()
+        return Response(trimmer.stats() if trimmer else {"enabled": False})
+
+
+class AdmissionStatsView(APIView):
+    """Queue depth and wait times at each provider's admission gate (staff only)"""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(registry.admission_stats())
+
+
+class ResilienceStatsView(APIView):
+    """Circuit breaker state and hedged calls per service (staff only)"""
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(registry.resilience_stats())
+
+
+class MetricsView(APIView):
+    """Prometheus metrics, added up across this host's workers: /metrics"""
+
+    permission_classes = [CanScrapeMetrics]
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type=CONTENT_TYPE)
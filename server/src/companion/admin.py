@@ -1,7 +1,68 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import PAGE_VAR
 from django.contrib.auth.admin import UserAdmin
+from django.http import QueryDict
 
 from .models import Message, Session, User
+from .pagination import EstimatedCountPaginator
+from .search import matching
+
+
+class UsernameFilter(admin.SimpleListFilter):
+    """
+    Filter by a username typed into the sidebar
+
+    A plain "user" list_filter renders a link per user, loading the whole
+    user table on every changelist.
+    """
+
+    title = "user"
+    parameter_name = "username"
+    template = "admin/companion/username_filter.html"
+    user_lookup = "user__username"
+
+    def lookups(self, request, model_admin):
+        # One placeholder choice so the filter is shown; it renders a box
+        return [(self.value(), self.value())]
+
+    def choices(self, changelist):
+        # The box's form must carry the changelist's other filters along
+        query_string = changelist.get_query_string(
+            remove=[self.parameter_name, PAGE_VAR]
+        )
+        yield {
+            "value": self.value() or "",
+            "hidden": [
+                (name, value)
+                for name, values in QueryDict(query_string[1:]).lists()
+                for value in values
+            ],
+        }
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.user_lookup: self.value()})
+        return queryset
+
+
+class VoiceFilter(admin.SimpleListFilter):
+    """
+    Filter by voice from the fixed voice list
+
+    list_filter = ["voice_used"] would build its choices with a DISTINCT
+    over the whole message table.
+    """
+
+    title = "voice used"
+    parameter_name = "voice_used"
+
+    def lookups(self, request, model_admin):
+        return [(voice, voice) for voice, _ in User.VOICE_CHOICES]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(voice_used=self.value())
+        return queryset
 
 
 @admin.register(User)
@@ -16,6 +77,8 @@ class CustomUserAdmin(UserAdmin):
     ]
     list_filter = ["voice_preference", "consent"]
     search_fields = ["username", "full_name", "email"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     fieldsets = UserAdmin.fieldsets + (
         (
             "Profile",
@@ -28,24 +91,53 @@ class CustomUserAdmin(UserAdmin):
 @admin.register(Session)
 class SessionAdmin(admin.ModelAdmin):
     list_display = ["user", "started_at", "updated_at", "message_count"]
-    list_filter = ["started_at"]
-    search_fields = ["user__username", "user__full_name", "title"]
+    list_filter = [UsernameFilter, "started_at"]
+    list_select_related = ["user"]
+    search_fields = ["=user__username", "^user__full_name", "title"]
     readonly_fields = ["started_at", "updated_at"]
+    autocomplete_fields = ["user"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
-    def message_count(self, obj):
-        return obj.messages.count()
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_message_count()
 
-    message_count.short_description = "Messages"
+    @admin.display(description="Messages", ordering="message_count")
+    def message_count(self, obj):
+        return obj.message_count
 
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ["user_full_name", "user", "session", "role", "text_preview", "voice_used", "timestamp"]
-    list_filter = ["role", "voice_used", "timestamp", "user"]
-    search_fields = ["text", "user_full_name", "session__user__username", "user__username", "user__full_name"]
+    list_display = [
+        "user_full_name",
+        "user",
+        "session",
+        "role",
+        "text_preview",
+        "voice_used",
+        "timestamp",
+    ]
+    list_filter = ["role", VoiceFilter, "timestamp", "audio_state", UsernameFilter]
+    # Session.__str__ shows its user's username
+    list_select_related = ["user", "session__user"]
+    # Searched through the full-text index (get_search_results); filter by
+    # user with the sidebar
+    search_fields = ["text"]
+    search_help_text = (
+        'Words, "quoted phrases", or, -excluded; matches message text only'
+    )
     readonly_fields = ["timestamp"]
+    autocomplete_fields = ["user"]
+    raw_id_fields = ["session"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return matching(queryset, search_term), False
+
+    @admin.display(description="Text")
     def text_preview(self, obj):
         return obj.text[:50] + "..." if len(obj.text) > 50 else obj.text
-
-    text_preview.short_description = "Text"
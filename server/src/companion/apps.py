@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CompanionConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "companion"
+
+    def ready(self):
+        # Keeps the conversation context cache in step with writes
+        from . import signals  # noqa: F401
+        from .search import restore_sqlite_triggers
+
+        # Table rebuilds in SQLite migrations drop the search index triggers
+        post_migrate.connect(restore_sqlite_triggers, sender=self)
@@ -0,0 +1,431 @@
+import asyncio
+import base64
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authentication import CSRFCheck
+from rest_framework.authtoken.models import Token
+
+from audio_processing.admission import Overloaded
+from audio_processing.audio_spool import AudioSpool
+from audio_processing.canned import FALLBACK_TIMEOUT
+from audio_processing.deadline import Deadline, DeadlineExceeded
+from audio_processing.metrics import metrics
+from audio_processing.registry import registry
+from audio_processing.resilience import BreakerOpen
+from audio_processing.sentences import aiter_sentences
+from audio_processing.uploads import (
+    AudioUploadLimitHandler,
+    AudioUploadRejected,
+    check_audio_upload,
+)
+from audio_processing.vad import SilentAudio
+
+from .context import context_store
+from .models import Message, Session
+from .summaries import schedule_summary
+from .views import _encode_header, _metric_labels, _retry_after, _stream_event
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class CsrfFailed(Exception):
+    pass
+
+
+def _check_csrf(request):
+    """
+    The CSRF check DRF's SessionAuthentication makes, so another site can't
+    post turns with the user's session cookie. Blocking: a form body is
+    parsed for the token
+    """
+    check = CSRFCheck(lambda request: None)
+    # Sets request.META["CSRF_COOKIE"], which process_view() reads
+    check.process_request(request)
+    reason = check.process_view(request, None, (), {})
+    if reason:
+        raise CsrfFailed(f"CSRF Failed: {reason}")
+
+
+async def _authenticate(request):
+    """
+    Resolve the user from a DRF ``Token`` header, else the Django session
+
+    Raises:
+        InvalidToken: The token is unknown or its user inactive
+        CsrfFailed: A session user's request has no valid CSRF token
+    """
+    keyword, _, key = request.headers.get("Authorization", "").partition(" ")
+    if keyword == "Token" and key.strip():
+        try:
+            token = await Token.objects.select_related("user").aget(key=key.strip())
+        except Token.DoesNotExist:
+            raise InvalidToken("Invalid token.")
+        if not token.user.is_active:
+            raise InvalidToken("User inactive or deleted.")
+        return token.user
+
+    user = await request.auser()
+    if not user.is_authenticated:
+        return None
+    await asyncio.to_thread(_check_csrf, request)
+    return user
+
+
+def _parse_request(request):
+    """
+    Return the JSON or form fields and the ``audio`` upload. Blocking: the
+    multipart parser copies the upload into memory or a temporary file
+    """
+    if request.content_type == "application/json":
+        return json.loads(request.body or b"{}"), None
+    return request.POST, request.FILES.get("audio")
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncVoiceInputView(View):
+    """
+    Async variant of VoiceInputView: /api/voice_input/async/
+
+    Same request and response contract (including ``stream=true``), but every
+    upstream call and DB query is awaited, so under an ASGI server one worker
+    process can hold hundreds of in-flight turns instead of one per thread.
+    """
+
+    async def _load_history(self, user):
+        """Return the recent messages and rolling summary of the active session"""
+        session_id, conversation_history, summary = await context_store.ahistory(
+            user.id
+        )
+        if session_id:
+            logger.debug("Loaded %d messages for context", len(conversation_history))
+        return conversation_history, summary
+
+    async def _save_turn(
+        self,
+        user,
+        transcript,
+        response_text,
+        voice_preference,
+        audio_file,
+        audio_spool=None,
+        labels=None,
+    ):
+        """Persist the user and assistant messages of one turn, timing each write"""
+        labels = labels or {}
+        session_id = await context_store.aactive_session_id(user.id)
+        if not session_id:
+            with metrics.span("db_session", **labels):
+                session_id = (await Session.objects.acreate(user=user)).id
+            logger.debug("New session %s created for user %s", session_id, user.id)
+
+        with metrics.span("db_user_message", **labels):
+            user_message = await Message.objects.acreate(
+                session_id=session_id, user=user, role="user", text=transcript
+            )
+        if audio_file:
+            with metrics.span("db_user_audio", **labels):
+                await sync_to_async(user_message.audio_file.save)(
+                    f"user_{user.id}_{user_message.id}.webm", audio_file
+                )
+            audio_file.close()
+
+        with metrics.span("db_assistant_message", **labels):
+            assistant_message = await Message.objects.acreate(
+                session_id=session_id,
+                user=user,
+                role="assistant",
+                text=response_text,
+                voice_used=voice_preference,
+            )
+        if audio_spool is not None:
+            await self._save_assistant_audio(assistant_message, audio_spool, labels)
+        logger.debug("Turn saved: %s, %s", user_message.id, assistant_message.id)
+        # Older messages are folded into the session summary off this path
+        schedule_summary(session_id)
+        return assistant_message
+
+    async def _save_assistant_audio(self, assistant_message, audio_spool, labels):
+        if not audio_spool.size:
+            return
+        name = f"assistant_{assistant_message.user_id}_{assistant_message.id}.mp3"
+        with metrics.span("db_assistant_audio", **labels):
+            await sync_to_async(assistant_message.audio_file.save)(
+                name, audio_spool.as_file(name)
+            )
+
+    async def _stream_audio(
+        self, first_chunk, audio_stream, audio_spool, assistant_message, labels
+    ):
+        """Async variant of VoiceInputView._stream_audio"""
+        try:
+            yield first_chunk
+            async for chunk in audio_stream:
+                yield chunk
+            if assistant_message:
+                await self._save_assistant_audio(assistant_message, audio_spool, labels)
+        except Exception as e:
+            logger.warning("TTS stream failed: %s", e)
+        finally:
+            audio_spool.close()
+
+    async def _stream_turn(
+        self,
+        user,
+        transcript,
+        conversation_history,
+        summary,
+        voice_preference,
+        audio_file,
+        deadline,
+        labels,
+        canned_reply=None,
+    ):
+        """Async variant of VoiceInputView._stream_turn"""
+        yield _stream_event("transcript", text=transcript)
+
+        response_parts = []
+        audio_spool = AudioSpool(settings.AUDIO_SPOOL_MAX_MEMORY)
+        tts_error = None
+
+        async def deltas():
+            if canned_reply is not None:
+                response_parts.append(canned_reply)
+                yield canned_reply
+                return
+            async for delta in llm_service.stream_response(
+                transcript, conversation_history, summary, deadline
+            ):
+                response_parts.append(delta)
+                yield delta
+
+        llm_service = registry.async_llm()
+        tts_service = registry.async_tts()
+        try:
+            sentences = metrics.afirst(
+                aiter_sentences(deltas()), "llm_first_sentence", **labels
+            )
+            async for sentence in sentences:
+                yield _stream_event("text", text=sentence)
+                if tts_error:
+                    continue
+                try:
+                    audio_stream = audio_spool.atee(
+                        tts_service.stream_synthesize(
+                            sentence, voice_preference, deadline
+                        )
+                    )
+                    async for chunk in metrics.afirst(audio_stream, "tts", **labels):
+                        with metrics.span("serialize", **labels):
+                            event = _stream_event(
+                                "audio", data=base64.b64encode(chunk).decode()
+                            )
+                        yield event
+                except Exception as tts_e:
+                    tts_error = str(tts_e)
+                    logger.warning("TTS failed: %s", tts_error)
+
+            response_text = "".join(response_parts).strip()
+
+            if user and canned_reply is None:
+                async with deadline.adatabase():
+                    await self._save_turn(
+                        user,
+                        transcript,
+                        response_text,
+                        voice_preference,
+                        audio_file,
+                        audio_spool,
+                        labels,
+                    )
+
+            yield _stream_event(
+                "done",
+                transcript=transcript,
+                response_text=response_text,
+                tts_error=tts_error,
+            )
+        except Exception as e:
+            logger.exception("Error occurred while streaming: %s", e)
+            yield _stream_event("error", error=str(e))
+        finally:
+            audio_spool.close()
+
+    async def post(self, request):
+        deadline = Deadline.for_request(request)
+        try:
+            # Before authenticating: the CSRF check may parse the body
+            request.upload_handlers.insert(0, AudioUploadLimitHandler(request))
+            try:
+                user = await _authenticate(request)
+            except InvalidToken as e:
+                return JsonResponse({"detail": str(e)}, status=401)
+            except CsrfFailed as e:
+                return JsonResponse({"detail": str(e)}, status=403)
+
+            data, audio_file = await asyncio.to_thread(_parse_request, request)
+            text_input = data.get("text")
+
+            try:
+                # ffprobe runs in a thread so the event loop isn't blocked
+                await asyncio.to_thread(check_audio_upload, request, audio_file)
+            except AudioUploadRejected as e:
+                return JsonResponse({"error": str(e)}, status=413)
+
+            if not audio_file and not text_input:
+                return JsonResponse(
+                    {"error": "Please provide either audio file or text input"},
+                    status=400,
+                )
+
+            voice_preference = data.get("voice_preference")
+            if user:
+                if voice_preference and voice_preference != user.voice_preference:
+                    user.voice_preference = voice_preference
+                    await user.asave(update_fields=["voice_preference"])
+                else:
+                    voice_preference = user.voice_preference
+            else:
+                voice_preference = voice_preference or "Chinenye"
+            labels = _metric_labels(voice_preference, audio_file)
+
+            # Step 1: Get transcript (either from STT or direct text)
+            timed_out = False
+            if audio_file:
+                stt_input = audio_file
+                vad = registry.vad()
+                if vad is not None:
+                    try:
+                        with metrics.span("vad", **labels):
+                            stt_input, _ = await asyncio.to_thread(
+                                vad.process, audio_file
+                            )
+                    except SilentAudio as e:
+                        return JsonResponse({"error": str(e)}, status=422)
+                try:
+                    with metrics.span("stt", **labels):
+                        transcript = await registry.async_stt().transcribe(
+                            stt_input, deadline
+                        )
+                except (DeadlineExceeded, BreakerOpen) as e:
+                    logger.warning("%s", e)
+                    timed_out, transcript = True, ""
+            else:
+                transcript = text_input
+
+            conversation_history, summary = [], ""
+            if user and not timed_out:
+                async with deadline.adatabase():
+                    with metrics.span("history", **labels):
+                        conversation_history, summary = await self._load_history(user)
+
+            stream = request.GET.get("stream") or data.get("stream")
+            if str(stream).lower() in ("1", "true", "yes"):
+                response = StreamingHttpResponse(
+                    self._stream_turn(
+                        user,
+                        transcript,
+                        conversation_history,
+                        summary,
+                        voice_preference,
+                        audio_file,
+                        deadline,
+                        labels,
+                        FALLBACK_TIMEOUT if timed_out else None,
+                    ),
+                    content_type="application/x-ndjson",
+                )
+                response["X-Transcript"] = _encode_header(transcript)
+                response["X-User-Query"] = _encode_header(transcript)
+                response["X-Encoding"] = "base64"
+                return response
+
+            # Step 2: LLM
+            if timed_out:
+                response_text = FALLBACK_TIMEOUT
+            else:
+                with metrics.span("llm", **labels):
+                    response_text = await registry.async_llm().get_response(
+                        transcript, conversation_history, summary, deadline
+                    )
+
+            # Step 3: TTS
+            audio_stream = None
+            audio_spool = AudioSpool(settings.AUDIO_SPOOL_MAX_MEMORY)
+            first_chunk = b""
+            tts_error = None
+            try:
+                with metrics.span("tts", **labels):
+                    audio_stream = audio_spool.atee(
+                        registry.async_tts().stream_synthesize(
+                            response_text, voice_preference, deadline
+                        )
+                    )
+                    first_chunk = await anext(audio_stream, b"")
+            except Exception as tts_e:
+                tts_error = str(tts_e)
+                logger.warning("TTS failed, continuing without audio: %s", tts_error)
+
+            # Step 4: Save messages to database for authenticated users
+            assistant_message = None
+            if user and not timed_out:
+                async with deadline.adatabase():
+                    assistant_message = await self._save_turn(
+                        user,
+                        transcript,
+                        response_text,
+                        voice_preference,
+                        audio_file,
+                        labels=labels,
+                    )
+
+            if first_chunk:
+                response = StreamingHttpResponse(
+                    self._stream_audio(
+                        first_chunk,
+                        audio_stream,
+                        audio_spool,
+                        assistant_message,
+                        labels,
+                    ),
+                    content_type="audio/mpeg",
+                )
+                response["Content-Disposition"] = 'attachment; filename="response.mp3"'
+                with metrics.span("serialize", **labels):
+                    response["X-Transcript"] = _encode_header(transcript)
+                    response["X-Response-Text"] = _encode_header(response_text)
+                    response["X-User-Query"] = _encode_header(transcript)
+                response["X-Encoding"] = "base64"
+                return response
+
+            audio_spool.close()
+            with metrics.span("serialize", **labels):
+                return JsonResponse(
+                    {
+                        "user_query": transcript,
+                        "transcript": transcript,
+                        "response_text": response_text,
+                        "audio_url": None,
+                        "tts_error": tts_error,
+                        "message": "TTS service unavailable. Text response provided.",
+                    }
+                )
+
+        except Overloaded as e:
+            logger.warning("Rejected: %s", e)
+            response = JsonResponse({"error": str(e)}, status=503)
+            response["Retry-After"] = _retry_after(e)
+            return response
+        except Exception as e:
+            logger.exception("Error occurred: %s", e)
+            return JsonResponse({"error": str(e)}, status=500)
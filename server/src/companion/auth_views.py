@@ -4,6 +4,8 @@ from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .usernames import create_user_with_unique_username
+
 User = get_user_model()
 
 
@@ -20,25 +22,15 @@ class RegisterView(APIView):
                 {"error": "Full name is required"}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Generate a unique username from full_name
-        base_username = full_name.lower().replace(" ", "_")
-        username = base_username
-        counter = 1
-        while User.objects.filter(username=username).exists():
-            username = f"{base_username}_{counter}"
-            counter += 1
-
-        # Create user without password (we'll use token auth)
-        user = User.objects.create_user(
-            username=username,
-            full_name=full_name,
+        # Create user with a unique username derived from full_name and no
+        # password (create_user leaves it unusable; we use token auth)
+        user = create_user_with_unique_username(
+            full_name,
             consent=True,  # Implicit consent by registering
         )
-        user.set_unusable_password()  # No password needed
-        user.save()
 
         # Create token for authentication
-        token, _ = Token.objects.get_or_create(user=user)
+        token = Token.objects.create(user=user)
 
         return Response(
             {
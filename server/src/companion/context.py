@@ -0,0 +1,237 @@
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Message, Session
+
+# Cached marker for "this user has no session yet"
+NO_SESSION = 0
+
+
+class LocalLRU:
+    """
+    Per-process LRU with expiry, speaking the subset of Django's cache API
+    that ConversationContextStore uses
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class ConversationContextStore:
+    """
+    Rolling window of recent messages (and the rolling summary) per session,
+    plus each user's active session, so a turn doesn't re-query either
+
+    Entries are kept up to date by the model signals in ``signals.py`` as
+    messages and sessions are written. With a shared Django cache
+    (CONVERSATION_CACHE_ALIAS, e.g. Redis) the database is only read on a
+    miss, and entries expire after CONVERSATION_CACHE_TTL seconds, which
+    bounds staleness from bulk writes that bypass signals.
+
+    The default backend is a per-process LRU, and signals only reach the
+    writing worker's copy. So with it the active session id is read from the
+    database on every turn (one index lookup), and windows expire after
+    CONVERSATION_LOCAL_CACHE_TTL seconds, bounding how long another worker's
+    messages can be missing from the prompt.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    alias = settings.CONVERSATION_CACHE_ALIAS
+                    self._backend = (
+                        caches[alias]
+                        if alias
+                        else LocalLRU(settings.CONVERSATION_CACHE_MAX_ENTRIES)
+                    )
+        return self._backend
+
+    @property
+    def shared(self):
+        """Whether the backend is a cache every worker sees"""
+        return not isinstance(self.backend, LocalLRU)
+
+    def reset(self):
+        """Forget everything cached locally, e.g. after a test rolls back"""
+        with self._lock:
+            self._backend = None
+
+    def _set(self, key, value):
+        timeout = settings.CONVERSATION_CACHE_TTL
+        if not self.shared:
+            timeout = min(timeout, settings.CONVERSATION_LOCAL_CACHE_TTL)
+        self.backend.set(key, value, timeout)
+
+    @staticmethod
+    def _user_key(user_id):
+        return f"conversation:user:{user_id}"
+
+    @staticmethod
+    def _session_key(session_id):
+        return f"conversation:session:{session_id}"
+
+    @staticmethod
+    def _latest_session(user_id):
+        return (
+            Session.objects.filter(user_id=user_id)
+            .order_by("-updated_at")
+            .values_list("id", flat=True)
+        )
+
+    def _cached_session_id(self, user_id):
+        # Another worker may have started a session the local LRU missed
+        return self.backend.get(self._user_key(user_id)) if self.shared else None
+
+    def active_session_id(self, user_id):
+        """The user's most recently updated session id, or None"""
+        session_id = self._cached_session_id(user_id)
+        if session_id is None:
+            session_id = self._latest_session(user_id).first() or NO_SESSION
+            self._set(self._user_key(user_id), session_id)
+        return session_id or None
+
+    def _window(self, session_id):
+        window = self.backend.get(self._session_key(session_id))
+        if window is None:
+            recent = (
+                Message.objects.filter(session_id=session_id)
+                .order_by("-timestamp")
+                .values("id", "role", "text")[: settings.CONVERSATION_WINDOW]
+            )
+            summary = (
+                Session.objects.filter(id=session_id)
+                .values_list("summary", flat=True)
+                .first()
+            )
+            window = {
+                "summary": summary or "",
+                "messages": [
+                    {"id": msg["id"], "role": msg["role"], "content": msg["text"]}
+                    for msg in reversed(recent)
+                ],
+            }
+            self._set(self._session_key(session_id), window)
+        return window
+
+    @staticmethod
+    def _unpack(session_id, window):
+        history = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in window["messages"]
+        ]
+        return session_id, history, window["summary"]
+
+    def history(self, user_id):
+        """
+        Recent conversation of the user's active session
+
+        Returns:
+            tuple: (session id or None, list of {"role", "content"} dicts in
+            chronological order, rolling summary of older messages)
+        """
+        session_id = self.active_session_id(user_id)
+        if session_id is None:
+            return None, [], ""
+        return self._unpack(session_id, self._window(session_id))
+
+    async def ahistory(self, user_id):
+        """Async variant of history; only database reads leave the event loop"""
+        session_id = await self.aactive_session_id(user_id)
+        if session_id is None:
+            return None, [], ""
+        window = self.backend.get(self._session_key(session_id))
+        if window is None:
+            window = await sync_to_async(self._window)(session_id)
+        return self._unpack(session_id, window)
+
+    async def aactive_session_id(self, user_id):
+        """Async variant of active_session_id"""
+        session_id = self._cached_session_id(user_id)
+        if session_id is None:
+            session_id = await self._latest_session(user_id).afirst() or NO_SESSION
+            self._set(self._user_key(user_id), session_id)
+        return session_id or None
+
+    def session_touched(self, user_id, session_id, created):
+        """A session was saved: it is now the user's most recently updated"""
+        self._set(self._user_key(user_id), session_id)
+        if created:
+            self._set(self._session_key(session_id), {"summary": "", "messages": []})
+
+    def session_deleted(self, user_id, session_id):
+        self.backend.delete(self._user_key(user_id))
+        self.backend.delete(self._session_key(session_id))
+
+    def message_saved(self, message, created):
+        """Append a new message to its cached window, or refresh an edited one"""
+        key = self._session_key(message.session_id)
+        with self._lock:
+            window = self.backend.get(key)
+            if window is None:
+                return
+            messages = window["messages"]
+            entry = {"id": message.id, "role": message.role, "content": message.text}
+            if created:
+                messages = (messages + [entry])[-settings.CONVERSATION_WINDOW :]
+            elif any(msg["id"] == message.id for msg in messages):
+                messages = [
+                    entry if msg["id"] == message.id else msg for msg in messages
+                ]
+            else:
+                # Edits to messages older than the window don't affect it
+                return
+            self._set(key, {**window, "messages": messages})
+
+    def message_deleted(self, message):
+        key = self._session_key(message.session_id)
+        window = self.backend.get(key)
+        if window is not None and any(
+            msg["id"] == message.id for msg in window["messages"]
+        ):
+            self.backend.delete(key)
+
+    def summary_updated(self, session_id, summary):
+        key = self._session_key(session_id)
+        with self._lock:
+            window = self.backend.get(key)
+            if window is not None:
+                self._set(key, {**window, "summary": summary})
+
+
+context_store = ConversationContextStore()
@@ -0,0 +1,261 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+
+from django.db.models import Q
+
+from .models import Message, Session, User
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Exported columns per table, written in this order so every row's
+# references (user_id, session_id) appear before it
+TABLES = {
+    "users": [
+        "id",
+        "username",
+        "full_name",
+        "email",
+        "voice_preference",
+        "consent",
+        "created_at",
+        "last_login",
+    ],
+    "sessions": ["id", "user_id", "title", "summary", "started_at", "updated_at"],
+    "messages": [
+        "id",
+        "session_id",
+        "user_id",
+        "user_full_name",
+        "role",
+        "text",
+        "audio_file",
+        "voice_used",
+        "timestamp",
+    ],
+}
+
+
+class ExportMismatch(Exception):
+    """The checkpoint to resume from was written with different options"""
+
+
+class Exporter:
+    """
+    Stream users, sessions and messages to JSONL or CSV files
+
+    Rows are read in keyset chunks (``id > last id``, ``chunk_size`` at a
+    time), so memory stays flat and each chunk is a primary key range scan
+    however far into the table it is, without holding a cursor or
+    transaction open for the whole export. After each chunk is written and
+    synced to disk, the last id and file size are saved to a checkpoint;
+    ``resume`` truncates each file back to its checkpoint and carries on.
+
+    With ``compress`` each chunk is its own gzip member, so a file cut back
+    to a checkpoint is still valid gzip (readers concatenate members).
+    """
+
+    def __init__(
+        self,
+        directory,
+        fmt="jsonl",
+        compress=False,
+        since=None,
+        until=None,
+        user_ids=None,
+        audio=False,
+        chunk_size=5000,
+        on_chunk=None,
+    ):
+        """
+        Args:
+            directory: Output directory (created if missing)
+            fmt: "jsonl" or "csv"
+            compress: Gzip each file
+            since: Only messages sent, sessions active and users joined at
+                or after this, plus the sessions and users those reference
+            until: Only sessions started and messages sent before this
+            user_ids: Only these users, their sessions and messages
+            audio: Copy message audio files into ``directory/audio``
+            chunk_size: Rows per query and per checkpoint
+            on_chunk: Called as ``on_chunk(table, rows, seconds)`` after
+                each chunk, with this run's totals for the table
+        """
+        self.directory = Path(directory)
+        self.fmt = fmt
+        self.compress = compress
+        self.since = since
+        self.until = until
+        self.user_ids = sorted(user_ids) if user_ids else None
+        self.audio = audio
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.missing_audio = 0
+
+    def options(self):
+        return {
+            "format": self.fmt,
+            "compress": self.compress,
+            "since": self.since.isoformat() if self.since else None,
+            "until": self.until.isoformat() if self.until else None,
+            "user_ids": self.user_ids,
+            "audio": self.audio,
+        }
+
+    def path(self, table):
+        return self.directory / (
+            f"{table}.{self.fmt}" + (".gz" if self.compress else "")
+        )
+
+    def querysets(self):
+        users = User.objects.all()
+        sessions = Session.objects.all()
+        messages = Message.objects.all()
+        if self.user_ids:
+            users = users.filter(id__in=self.user_ids)
+            sessions = sessions.filter(user_id__in=self.user_ids)
+            messages = messages.filter(session__user_id__in=self.user_ids)
+        if self.until:
+            sessions = sessions.filter(started_at__lt=self.until)
+            messages = messages.filter(timestamp__lt=self.until)
+        if self.since:
+            messages = messages.filter(timestamp__gte=self.since)
+            # A new message doesn't bump its session's updated_at, so the
+            # sessions and users it references are added explicitly
+            sessions = sessions.filter(
+                Q(updated_at__gte=self.since) | Q(id__in=messages.values("session_id"))
+            )
+            users = users.filter(
+                Q(created_at__gte=self.since)
+                | Q(id__in=sessions.values("user_id"))
+                | Q(id__in=messages.values("user_id"))
+            )
+        return {"users": users, "sessions": sessions, "messages": messages}
+
+    def run(self, resume=False):
+        """
+        Export every table, resuming from the checkpoint if asked
+
+        Returns:
+            dict: Per table, this run's ``rows``, ``seconds`` and the
+            file's total ``bytes``
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        checkpoint = self._load_checkpoint(resume)
+        querysets = self.querysets()
+
+        stats = {}
+        for table, columns in TABLES.items():
+            state = checkpoint["tables"].setdefault(
+                table, {"last_id": 0, "bytes": 0, "rows": 0, "done": False}
+            )
+            stats[table] = self._export_table(
+                table, querysets[table], columns, state, checkpoint
+            )
+        return stats
+
+    def _export_table(self, table, queryset, columns, state, checkpoint):
+        path = self.path(table)
+        rows = 0
+        began = time.perf_counter()
+        if not state["done"]:
+            with open(path, "ab") as handle:
+                # Drop anything written after the last checkpoint
+                handle.truncate(state["bytes"])
+                handle.seek(state["bytes"])
+                while True:
+                    chunk = list(
+                        queryset.filter(id__gt=state["last_id"])
+                        .order_by("id")
+                        .values(*columns)[: self.chunk_size]
+                    )
+                    if chunk:
+                        if table == "messages" and self.audio:
+                            self._bundle_audio(chunk)
+                        data = self._encode(chunk, columns, header=not state["bytes"])
+                        handle.write(
+                            gzip.compress(data, mtime=0) if self.compress else data
+                        )
+                        handle.flush()
+                        os.fsync(handle.fileno())
+
+                        rows += len(chunk)
+                        state["last_id"] = chunk[-1]["id"]
+                        state["bytes"] = handle.tell()
+                        state["rows"] += len(chunk)
+                    state["done"] = len(chunk) < self.chunk_size
+                    self._save_checkpoint(checkpoint)
+                    if self.on_chunk and chunk:
+                        self.on_chunk(table, rows, time.perf_counter() - began)
+                    if state["done"]:
+                        break
+        return {
+            "rows": rows,
+            "seconds": time.perf_counter() - began,
+            "bytes": state["bytes"],
+        }
+
+    def _encode(self, chunk, columns, header):
+        rows = [
+            [
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in (row[column] for column in columns)
+            ]
+            for row in chunk
+        ]
+        if self.fmt == "jsonl":
+            return "".join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+                for row in rows
+            ).encode()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        return buffer.getvalue().encode()
+
+    def _bundle_audio(self, chunk):
+        """Copy each message's audio file into the export, streaming it"""
+        storage = Message._meta.get_field("audio_file").storage
+        for row in chunk:
+            name = row["audio_file"]
+            if not name:
+                continue
+            target = self.directory / "audio" / name
+            if target.exists():  # Copied before an interruption
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with storage.open(name, "rb") as source:
+                    partial = target.with_name(target.name + ".part")
+                    with open(partial, "wb") as destination:
+                        shutil.copyfileobj(source, destination)
+                    os.replace(partial, target)
+            except FileNotFoundError:
+                self.missing_audio += 1
+
+    def _load_checkpoint(self, resume):
+        path = self.directory / CHECKPOINT_FILE
+        if resume and path.exists():
+            checkpoint = json.loads(path.read_text())
+            if checkpoint["options"] != self.options():
+                raise ExportMismatch(
+                    f"{path} was written with {checkpoint['options']}, "
+                    f"not {self.options()}"
+                )
+            return checkpoint
+        return {"options": self.options(), "tables": {}}
+
+    def _save_checkpoint(self, checkpoint):
+        # Written aside and renamed, so a crash never leaves half a checkpoint
+        path = self.directory / CHECKPOINT_FILE
+        partial = path.with_name(path.name + ".part")
+        partial.write_text(json.dumps(checkpoint, indent=2))
+        os.replace(partial, path)
@@ -0,0 +1,71 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from companion.retention import AudioRetention
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encode aged message audio as low-bitrate Opus, or drop it, per "
+        "AUDIO_RETENTION, and report the storage reclaimed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.AUDIO_RETENTION_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--io-limit",
+            type=float,
+            help="MB/s of audio read and written (default "
+            "AUDIO_RETENTION_IO_BYTES_PER_SECOND; 0 for no cap)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the messages due for each step",
+        )
+        parser.add_argument(
+            "--forever",
+            action="store_true",
+            help="Keep running, starting a pass every --interval seconds",
+        )
+        parser.add_argument("--interval", type=int, default=3600)
+
+    def handle(self, *args, **options):
+        io_limit = options["io_limit"]
+        retention = AudioRetention(
+            batch_size=options["batch_size"],
+            io_limit=None if io_limit is None else int(io_limit * 1e6),
+        )
+
+        if options["dry_run"]:
+            for role in retention.policy:
+                for action in ["drop", "compact"]:
+                    count = retention.due(role, action).count()
+                    self.stdout.write(f"{role}: {count} to {action}")
+            return
+
+        while True:
+            began = time.monotonic()
+            stats = retention.run()
+            elapsed = time.monotonic() - began
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Compacted {stats['compacted']} and dropped "
+                    f"{stats['dropped']} recordings in {elapsed:.0f}s, "
+                    f"reclaiming {stats['bytes_reclaimed'] / 1e6:.1f} MB"
+                )
+            )
+            if stats["missing"] or stats["failed"]:
+                self.stderr.write(
+                    f"{stats['missing']} recording(s) already missing, "
+                    f"{stats['failed']} failed"
+                )
+            if not options["forever"]:
+                return
+            close_old_connections()
+            time.sleep(max(0, options["interval"] - elapsed))
@@ -0,0 +1,112 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from companion.export import TABLES, Exporter, ExportMismatch
+from companion.models import User
+
+
+def _parse_moment(value):
+    """An ISO date (midnight) or datetime, in the project time zone if naive"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f"Not an ISO date or datetime: {value}")
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream users, sessions and messages into users/sessions/messages "
+        "files in a directory, with constant memory and resumable checkpoints"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Output directory")
+        parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+        parser.add_argument("--gzip", action="store_true", help="Gzip each file")
+        parser.add_argument(
+            "--since",
+            help="Only messages sent (with their sessions and users), sessions "
+            "active and users joined at or after this ISO date/datetime",
+        )
+        parser.add_argument(
+            "--until",
+            help="Only messages sent (and sessions started) before this "
+            "ISO date/datetime",
+        )
+        parser.add_argument(
+            "--user",
+            action="append",
+            dest="usernames",
+            metavar="USERNAME",
+            help="Only this username's data (repeatable)",
+        )
+        parser.add_argument(
+            "--audio",
+            action="store_true",
+            help="Copy message audio files into DIRECTORY/audio",
+        )
+        parser.add_argument("--chunk-size", type=int, default=5000)
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Carry on from DIRECTORY's checkpoint instead of starting over",
+        )
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options["usernames"]:
+            found = dict(
+                User.objects.filter(username__in=options["usernames"]).values_list(
+                    "username", "id"
+                )
+            )
+            unknown = set(options["usernames"]) - set(found)
+            if unknown:
+                raise CommandError(f"Unknown user(s): {', '.join(sorted(unknown))}")
+            user_ids = list(found.values())
+
+        verbosity = options["verbosity"]
+
+        def on_chunk(table, rows, seconds):
+            if verbosity > 1:
+                self.stdout.write(
+                    f"  {table}: {rows:,} rows ({rows / seconds:,.0f} rows/s)"
+                )
+
+        exporter = Exporter(
+            options["directory"],
+            fmt=options["format"],
+            compress=options["gzip"],
+            since=_parse_moment(options["since"]) if options["since"] else None,
+            until=_parse_moment(options["until"]) if options["until"] else None,
+            user_ids=user_ids,
+            audio=options["audio"],
+            chunk_size=options["chunk_size"],
+            on_chunk=on_chunk,
+        )
+        try:
+            stats = exporter.run(resume=options["resume"])
+        except ExportMismatch as e:
+            raise CommandError(f"Can't resume: {e}")
+
+        for table in TABLES:
+            table_stats = stats[table]
+            rate = table_stats["rows"] / max(table_stats["seconds"], 1e-9)
+            self.stdout.write(
+                f"{table}: {table_stats['rows']:,} rows in "
+                f"{table_stats['seconds']:.1f}s ({rate:,.0f} rows/s), "
+                f"{table_stats['bytes'] / 1e6:.1f} MB -> {exporter.path(table)}"
+            )
+        if exporter.missing_audio:
+            self.stderr.write(
+                f"{exporter.missing_audio} audio file(s) missing from storage"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Exported to {exporter.directory}"))
@@ -0,0 +1,244 @@
+import contextlib
+import datetime
+import itertools
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from companion.models import Message, Session, User, UsernameSequence
+from companion.usernames import base_username
+
+FIRST_NAMES = (
+    "Ada Adaeze Bola Chidi Chioma Dayo Emeka Funmi Gbenga Ibrahim Ifeoma Kemi "
+    "Kunle Musa Nkechi Obinna Ola Segun Tolu Uche Yemi Zara Amina Bisi Chinedu "
+    "David Grace Hauwa John Joy Mary Michael Ngozi Peter Ruth Samuel Sarah "
+    "Tunde Victor Esther"
+).split()
+SURNAME_SYLLABLES = (
+    "ad ba chi da eke fa gu ibe jo ka lo mba nwa oko pe ro sa tu uzo wa ye "
+    "zi ola ogu ani bel ike ndu ofo"
+).split()
+# Registered over and over, for the username allocator to work through
+NAMESAKE = "John Doe"
+
+WORDS = (
+    "i you the a to and of it is was that my me feel feeling have been just "
+    "like so not but really today about work what do know think want talk "
+    "can time day night sleep tired people always never again anxious exams "
+    "stress panic lonely family friends job school money breathing calm "
+    "hopeful overwhelmed deadline relationship try small step notice"
+).split()
+
+# Fields stamped with "now" on insert, which bulk_create would otherwise
+# overwrite with the time of the run
+STAMPED_FIELDS = [
+    (User, "created_at"),
+    (Session, "started_at"),
+    (Session, "updated_at"),
+    (Message, "timestamp"),
+]
+
+
+@contextlib.contextmanager
+def explicit_timestamps():
+    """Let bulk_create keep the timestamps given to it"""
+    fields = [model._meta.get_field(name) for model, name in STAMPED_FIELDS]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def full_names(rng, count):
+    """``count`` distinct "First Middle Surname" names, so LoginView finds one"""
+    surnames = [a.title() + b for a in SURNAME_SYLLABLES for b in SURNAME_SYLLABLES]
+    first = len(FIRST_NAMES)
+    combinations = first * first * len(surnames)
+    if count > combinations:
+        raise CommandError(f"Can only name {combinations:,} distinct users")
+    for index in rng.sample(range(combinations), count):
+        index, given = divmod(index, first)
+        surname, middle = divmod(index, first)
+        yield f"{FIRST_NAMES[given]} {FIRST_NAMES[middle]} {surnames[surname]}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-insert synthetic users, sessions and messages for load and "
+        "database benchmarks: heavy-tailed activity per user and messages per "
+        "session, timestamps spread over --months. Not for a live database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=12,
+            help="Sessions start at random over this many months up to now",
+        )
+        parser.add_argument(
+            "--namesakes",
+            type=int,
+            default=1000,
+            help=f'Extra users all named "{NAMESAKE}"',
+        )
+        parser.add_argument(
+            "--alpha",
+            type=float,
+            default=1.3,
+            help="Pareto shape of session lengths and of activity per user; "
+            "lower means a heavier tail",
+        )
+        parser.add_argument("--max-session-messages", type=int, default=2000)
+        parser.add_argument("--batch-size", type=int, default=10000)
+        parser.add_argument("--seed", type=int, default=7)
+
+    def handle(self, *args, **options):
+        if options["users"] < 1 or options["messages"] < 0:
+            raise CommandError("Need at least one user and no negative counts")
+        rng = random.Random(options["seed"])
+        self.verbosity = options["verbosity"]
+        self.batch_size = options["batch_size"]
+        self.now = timezone.now()
+        self.span = datetime.timedelta(days=30 * options["months"])
+
+        began = time.monotonic()
+        with explicit_timestamps():
+            users = self.create_users(rng, options["users"], options["namesakes"])
+            sessions, messages = self.create_conversations(
+                rng,
+                users,
+                options["messages"],
+                options["alpha"],
+                options["max_session_messages"],
+            )
+        # Fresh planner statistics, which the admin's row estimate reads
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {len(users):,} users, {sessions:,} sessions and "
+                f"{messages:,} messages in {time.monotonic() - began:.0f}s"
+            )
+        )
+
+    def progress(self, text):
+        if self.verbosity > 1:
+            self.stdout.write(text, ending="\r")
+            self.stdout.flush()
+
+    def create_users(self, rng, count, namesakes):
+        """
+        Returns:
+            list: (id, full name, voice) per user
+        """
+        voices = [voice for voice, _ in User.VOICE_CHOICES]
+        # The hash of an unusable password, as RegisterView leaves it
+        password = make_password(None)
+        names = [(name, base_username(name)) for name in full_names(rng, count)]
+        base = base_username(NAMESAKE)
+        names += [
+            (NAMESAKE, base if n == 0 else f"{base}_{n}") for n in range(namesakes)
+        ]
+        if User.objects.filter(username__in=[names[0][1], base]).exists():
+            raise CommandError("The database already has synthetic users")
+
+        users = []
+        for start in range(0, len(names), self.batch_size):
+            batch = []
+            for full_name, username in names[start : start + self.batch_size]:
+                joined = self.now - self.span * rng.random()
+                batch.append(
+                    User(
+                        username=username,
+                        full_name=full_name,
+                        password=password,
+                        voice_preference=rng.choice(voices),
+                        consent=True,
+                        date_joined=joined,
+                        created_at=joined,
+                    )
+                )
+            created = User.objects.bulk_create(batch)
+            users += [
+                (user.id, user.full_name, user.voice_preference) for user in created
+            ]
+            self.progress(f"  {len(users):,} users")
+        if namesakes:
+            # As if they had all registered through the allocator
+            UsernameSequence.objects.update_or_create(
+                base=base, defaults={"last_suffix": namesakes - 1}
+            )
+        return users
+
+    def create_conversations(self, rng, users, total, alpha, max_length):
+        """Sessions of Pareto-distributed length until ``total`` messages"""
+        # A few users hold most of the sessions
+        cumulative = list(itertools.accumulate(rng.paretovariate(alpha) for _ in users))
+
+        sessions = written = 0
+        while written < total:
+            # A batch's worth of messages, split into sessions
+            planned, size = [], 0
+            while size < self.batch_size and written + size < total:
+                length = min(
+                    int(rng.paretovariate(alpha)) * 2,
+                    max_length,
+                    total - written - size,
+                )
+                gaps = [
+                    datetime.timedelta(seconds=rng.randint(5, 120))
+                    for _ in range(length - 1)
+                ]
+                # Ends before now, however long it ran
+                started = self.now - sum(gaps, self.span * rng.random())
+                user = rng.choices(users, cum_weights=cumulative)[0]
+                planned.append((user, started, gaps))
+                size += length
+
+            with transaction.atomic():
+                created = Session.objects.bulk_create(
+                    Session(
+                        user_id=user[0],
+                        started_at=started,
+                        updated_at=started + sum(gaps, datetime.timedelta()),
+                    )
+                    for user, started, gaps in planned
+                )
+                batch = []
+                for session, (user, when, gaps) in zip(created, planned):
+                    for n, gap in enumerate([datetime.timedelta(), *gaps]):
+                        when += gap
+                        role = "user" if n % 2 == 0 else "assistant"
+                        batch.append(
+                            Message(
+                                session_id=session.id,
+                                user_id=user[0],
+                                user_full_name=user[1],
+                                role=role,
+                                text=self.text(rng),
+                                voice_used=user[2] if role == "assistant" else "",
+                                timestamp=when,
+                            )
+                        )
+                Message.objects.bulk_create(batch, batch_size=self.batch_size)
+            sessions += len(created)
+            written += size
+            self.progress(f"  {written:,} messages")
+        if self.verbosity > 1:
+            self.stdout.write("")
+        return sessions, written
+
+    @staticmethod
+    def text(rng):
+        return " ".join(rng.choices(WORDS, k=rng.randint(4, 40)))
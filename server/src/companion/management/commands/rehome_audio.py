@@ -0,0 +1,59 @@
+import re
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+
+from companion.models import Message
+
+# Names written by the content-addressed storage: .../ab/cd/<sha256>.ext
+CONTENT_ADDRESSED = re.compile(r"(^|/)[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$")
+
+
+class Command(BaseCommand):
+    help = (
+        "Move message audio saved under MEDIA_ROOT before content addressing "
+        "into the configured audio storage, deduplicating it"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, batch_size=500, **options):
+        legacy = FileSystemStorage()
+        storage = Message._meta.get_field("audio_file").storage
+
+        moved = missing = bytes_moved = 0
+        last_id = 0
+        while True:
+            batch = list(
+                Message.objects.filter(id__gt=last_id)
+                .exclude(audio_file="")
+                .exclude(audio_file__isnull=True)
+                .order_by("id")
+                .values_list("id", "audio_file")[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            for message_id, name in batch:
+                if CONTENT_ADDRESSED.search(name):
+                    continue
+                try:
+                    with legacy.open(name) as source:
+                        new_name = storage.save(name, source)
+                        bytes_moved += source.size
+                except FileNotFoundError:
+                    missing += 1
+                    continue
+                Message.objects.filter(id=message_id).update(audio_file=new_name)
+                legacy.delete(name)
+                moved += 1
+
+        if missing:
+            self.stderr.write(f"{missing} audio file(s) missing from {legacy.location}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Moved {moved} audio files ({bytes_moved / 1e6:.1f} MB) "
+                f"into content-addressed storage"
+            )
+        )
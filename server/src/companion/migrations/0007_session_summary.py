@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 01:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("companion", "0006_alter_user_voice_preference"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="session",
+            name="summarized_through",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="session",
+            name="summary",
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("companion", "0008_hot_query_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsernameSequence",
+            fields=[
+                (
+                    "base",
+                    models.CharField(max_length=150, primary_key=True, serialize=False),
+                ),
+                ("last_suffix", models.IntegerField()),
+            ],
+        ),
+    ]
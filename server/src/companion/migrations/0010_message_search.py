@@ -0,0 +1,25 @@
+from django.db import migrations
+
+from companion.search import create_search_index, drop_search_index
+
+
+def forwards(apps, schema_editor):
+    create_search_index(schema_editor)
+
+
+def backwards(apps, schema_editor):
+    drop_search_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+    # Full-text index over Message.text, kept in step by the database:
+    # a generated tsvector column with a GIN index on PostgreSQL, an FTS5
+    # table maintained by triggers on SQLite (see companion/search.py)
+
+    dependencies = [
+        ("companion", "0009_username_sequence"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
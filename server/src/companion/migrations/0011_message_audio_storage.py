@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:27
+
+import audio_processing.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audio_processing", "0001_initial"),
+        ("companion", "0010_message_search"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="audio_file",
+            field=models.FileField(
+                blank=True,
+                null=True,
+                storage=audio_processing.storage.audio_storage,
+                upload_to="audio/",
+            ),
+        ),
+    ]
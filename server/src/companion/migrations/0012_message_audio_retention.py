@@ -0,0 +1,43 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("companion", "0011_message_audio_storage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="audio_compacted_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="audio_original_bytes",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="audio_state",
+            field=models.CharField(
+                choices=[
+                    ("original", "Original"),
+                    ("compacted", "Compacted"),
+                    ("dropped", "Dropped"),
+                ],
+                default="original",
+                max_length=10,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["audio_state", "role", "timestamp"],
+                name="message_audio_retention_idx",
+            ),
+        ),
+    ]
@@ -1,5 +1,9 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Substr
+
+from audio_processing.storage import audio_storage
 
 
 class User(AbstractUser):
@@ -31,10 +35,61 @@ class User(AbstractUser):
     consent = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # LoginView looks users up by full name
+            models.Index(fields=["full_name"], name="user_full_name_idx"),
+        ]
+
     def __str__(self):
         return self.full_name if self.full_name else self.username
 
 
+class SessionQuerySet(models.QuerySet):
+    def with_message_count(self):
+        """
+        Annotate each session with ``message_count``
+
+        A correlated subquery on the (session, timestamp) index, evaluated
+        only for the rows actually returned, rather than a JOIN + GROUP BY
+        over every message of every matching session.
+        """
+        return self.annotate(
+            message_count=Coalesce(
+                Subquery(
+                    _session_messages()
+                    .values("session")
+                    .annotate(count=Count("pk"))
+                    .values("count")
+                ),
+                0,
+            )
+        )
+
+    def with_stats(self, preview_chars=120):
+        """
+        Annotate each session with ``message_count``, ``last_message_at``,
+        ``last_message_role`` and ``last_message_preview``
+
+        All are correlated subqueries like ``with_message_count``, so a page
+        of sessions stays one query however many messages they hold.
+        """
+        last = _session_messages().order_by("-timestamp")
+        return self.with_message_count().annotate(
+            last_message_at=Subquery(last.values("timestamp")[:1]),
+            last_message_role=Subquery(last.values("role")[:1]),
+            last_message_preview=Subquery(
+                last.annotate(preview=Substr("text", 1, preview_chars)).values(
+                    "preview"
+                )[:1]
+            ),
+        )
+
+
+def _session_messages():
+    return Message.objects.filter(session=OuterRef("pk")).order_by()
+
+
 class Session(models.Model):
     """Chat session grouping multiple messages"""
 
@@ -42,9 +97,22 @@ class Session(models.Model):
     started_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=255, blank=True)  # Optional session title
+    # Rolling summary of the messages that have left the prompt's history
+    summary = models.TextField(blank=True)
+    summarized_through = models.BigIntegerField(
+        null=True, blank=True
+    )  # Id of the last message folded into the summary
+
+    objects = SessionQuerySet.as_manager()
 
     class Meta:
         ordering = ["-updated_at"]
+        indexes = [
+            # A user's sessions, most recent first (active session, history)
+            models.Index(
+                fields=["user", "-updated_at"], name="session_user_updated_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.started_at}"
@@ -57,6 +125,14 @@ class Message(models.Model):
         ("user", "User"),
         ("assistant", "Assistant"),
     ]
+    AUDIO_ORIGINAL = "original"
+    AUDIO_COMPACTED = "compacted"
+    AUDIO_DROPPED = "dropped"
+    AUDIO_STATE_CHOICES = [
+        (AUDIO_ORIGINAL, "Original"),
+        (AUDIO_COMPACTED, "Compacted"),
+        (AUDIO_DROPPED, "Dropped"),
+    ]
 
     session = models.ForeignKey(
         Session, on_delete=models.CASCADE, related_name="messages"
@@ -67,12 +143,31 @@ class Message(models.Model):
     user_full_name = models.CharField(max_length=255, blank=True)
     role = models.CharField(max_length=20, choices=ROLE_CHOICES)
     text = models.TextField()
-    audio_file = models.FileField(upload_to="audio/", null=True, blank=True)
+    audio_file = models.FileField(
+        upload_to="audio/", storage=audio_storage, null=True, blank=True
+    )
+    # Bookkeeping for the retention job (companion/retention.py)
+    audio_state = models.CharField(
+        max_length=10, choices=AUDIO_STATE_CHOICES, default=AUDIO_ORIGINAL
+    )
+    audio_compacted_at = models.DateTimeField(null=True, blank=True)
+    audio_original_bytes = models.BigIntegerField(null=True, blank=True)
     voice_used = models.CharField(max_length=50, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ["timestamp"]
+        indexes = [
+            # A session's messages in time order (context window, summaries)
+            models.Index(
+                fields=["session", "timestamp"], name="message_session_time_idx"
+            ),
+            # Recordings due for compaction or deletion, oldest first
+            models.Index(
+                fields=["audio_state", "role", "timestamp"],
+                name="message_audio_retention_idx",
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         # Auto-populate user_full_name from user if not set
@@ -83,3 +178,13 @@ class Message(models.Model):
     def __str__(self):
         username = self.user.username if self.user else "Anonymous"
         return f"{username} - {self.role}: {self.text[:50]}..."
+
+
+class UsernameSequence(models.Model):
+    """Last suffix handed out per base username (see usernames.py)"""
+
+    base = models.CharField(max_length=150, primary_key=True)
+    last_suffix = models.IntegerField()
+
+    def __str__(self):
+        return f"{self.base}: {self.last_suffix}"
@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+
+class SessionCursorPagination(CursorPagination):
+    """
+    Keyset pages of a user's sessions, most recently active first
+
+    The cursor carries the last ``updated_at`` seen, so every page is an
+    index range scan on (user, -updated_at) rather than an OFFSET that
+    reads and discards all the earlier rows. A session that gets a new
+    message while the user is paging moves to the first page.
+    """
+
+    ordering = "-updated_at"
+    page_size = settings.HISTORY_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.HISTORY_MAX_PAGE_SIZE
+
+
+class MessageCursorPagination(CursorPagination):
+    """Keyset pages of a session's messages, newest first"""
+
+    ordering = "-timestamp"
+    page_size = settings.HISTORY_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.HISTORY_MAX_PAGE_SIZE
+
+
+def estimated_row_count(model):
+    """
+    A table's row count from the database's planner statistics
+
+    Returns None when there are none (SQLite before ANALYZE, a PostgreSQL
+    table never vacuumed or analyzed) or on other databases.
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [connection.ops.quote_name(table)],
+            )
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == "sqlite":
+            try:
+                # Every row's stat starts with the table's row count
+                cursor.execute(
+                    "SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table]
+                )
+            except DatabaseError:  # ANALYZE has never run
+                return None
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Admin paginator that skips COUNT(*) on large unfiltered tables
+
+    An exact count reads the whole table; past ADMIN_EXACT_COUNT_LIMIT rows
+    the changelist shows the planner's estimate instead. Filtered and
+    searched lists are still counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate is not None and estimate > settings.ADMIN_EXACT_COUNT_LIMIT:
+                return estimate
+        return super().count
@@ -0,0 +1,264 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from audio_processing.models import AudioBlob
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+ARCHIVE_NAME = "archive.ogg"
+
+
+def encode_archive(source_path, target_path, bitrate):
+    """
+    Re-encode a recording as mono 16 kHz Opus for long-term keeping
+
+    Speech stays intelligible at 8-16 kbit/s with Opus' VoIP mode, a tenth
+    or less of the original uploads and TTS MP3s. One ffmpeg thread, so a
+    pass never takes more than one core from the web workers.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg is not installed")
+    result = subprocess.run(
+        [
+            *(ffmpeg, "-v", "error", "-y", "-threads", "1", "-i", source_path),
+            *("-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", bitrate),
+            *("-application", "voip", "-f", "ogg", target_path),
+        ],
+        capture_output=True,
+        timeout=120,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode().strip()}")
+
+
+class Throttle:
+    """Hold a stream of reads and writes to an average byte rate"""
+
+    def __init__(self, bytes_per_second, clock=time.monotonic, sleep=time.sleep):
+        self.rate = bytes_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self.started = clock()
+        self.spent = 0
+
+    def spend(self, nbytes):
+        if not self.rate:
+            return
+        now = self.clock()
+        if self.spent / self.rate < now - self.started - 1:
+            # Idle for a while: don't let the saved-up allowance burst
+            self.started, self.spent = now, 0
+        self.spent += nbytes
+        ahead = self.spent / self.rate - (now - self.started)
+        if ahead > 0:
+            self.sleep(ahead)
+
+
+class AudioRetention:
+    """
+    Compact or drop message audio as it ages, per AUDIO_RETENTION
+
+    Each pass works through due messages in batches, oldest first. Audio is
+    copied through a scratch directory at no more than the I/O limit, and
+    every change goes through the audio storage so shared (deduplicated)
+    blobs keep correct reference counts. A message's audio is only swapped
+    if it hasn't changed since it was read.
+    """
+
+    def __init__(
+        self,
+        policy=None,
+        batch_size=None,
+        io_limit=None,
+        bitrate=None,
+        encode=encode_archive,
+        throttle=None,
+    ):
+        """
+        Args:
+            policy: {role: {"compact_after_days": n, "drop_after_days": n}},
+                AUDIO_RETENTION by default
+            batch_size: Messages fetched per query
+            io_limit: Bytes per second of audio read and written (0 = no cap)
+            bitrate: Opus bitrate of compacted audio
+            encode: ``encode(source_path, target_path, bitrate)``
+            throttle: A Throttle, built from ``io_limit`` if omitted
+        """
+        self.policy = policy or settings.AUDIO_RETENTION
+        self.batch_size = batch_size or settings.AUDIO_RETENTION_BATCH_SIZE
+        if io_limit is None:
+            io_limit = settings.AUDIO_RETENTION_IO_BYTES_PER_SECOND
+        self.bitrate = bitrate or settings.AUDIO_ARCHIVE_BITRATE
+        self.encode = encode
+        self.throttle = throttle or Throttle(io_limit)
+        self.field = Message._meta.get_field("audio_file")
+        self.storage = self.field.storage
+
+    def due(self, role, action, now=None):
+        """Messages of ``role`` whose audio is due for "compact" or "drop" """
+        days = self.policy.get(role, {}).get(f"{action}_after_days", 0)
+        if not days:
+            return Message.objects.none()
+        states = [Message.AUDIO_ORIGINAL]
+        if action == "drop":
+            states.append(Message.AUDIO_COMPACTED)
+        cutoff = (now or timezone.now()) - timedelta(days=days)
+        return (
+            Message.objects.filter(
+                audio_state__in=states, role=role, timestamp__lt=cutoff
+            )
+            .exclude(audio_file="")
+            .exclude(audio_file__isnull=True)
+        )
+
+    def run(self, now=None):
+        """
+        One pass over every role's due messages: drop first, so nothing is
+        compacted only to be deleted
+
+        Returns:
+            dict: compacted, dropped, missing and failed message counts, and
+                bytes_reclaimed from storage
+        """
+        now = now or timezone.now()
+        stats = dict(compacted=0, dropped=0, missing=0, failed=0, bytes_reclaimed=0)
+        for role in self.policy:
+            self._work_through(self.due(role, "drop", now), self._drop, now, stats)
+            self._work_through(
+                self.due(role, "compact", now), self._compact, now, stats
+            )
+        return stats
+
+    def _work_through(self, queryset, handle, now, stats):
+        """
+        Handle each due message in batches, skipping any that fail
+
+        Batches are paged by (timestamp, id) past the last message seen, so
+        messages that stay due after failing are never fetched again
+        """
+        last = None
+        while True:
+            page = queryset
+            if last is not None:
+                page = page.filter(
+                    Q(timestamp__gt=last[0]) | Q(timestamp=last[0], id__gt=last[1])
+                )
+            batch = list(
+                page.order_by("timestamp", "id").values_list(
+                    "id", "audio_file", "audio_original_bytes", "timestamp"
+                )[: self.batch_size]
+            )
+            if batch:
+                last = (batch[-1][3], batch[-1][0])
+            for message_id, name, original_bytes, _ in batch:
+                try:
+                    handle(message_id, name, original_bytes, now, stats)
+                except FileNotFoundError:
+                    self._mark_missing(message_id, name, now)
+                    stats["missing"] += 1
+                except Exception as e:
+                    logger.warning(
+                        "Audio retention skipped message %s: %s", message_id, e
+                    )
+                    stats["failed"] += 1
+            if len(batch) < self.batch_size:
+                return
+
+    def _release(self, name):
+        """
+        Drop one reference to a blob
+
+        Returns:
+            int: Bytes freed, 0 while other messages still share the blob
+        """
+        with transaction.atomic():
+            blob = AudioBlob.objects.select_for_update().filter(name=name).first()
+            if blob is not None:
+                freed = blob.size if blob.refs == 1 else 0
+            else:
+                # Saved before content addressing: not shared
+                freed = self.storage.size(name) if self.storage.exists(name) else 0
+            self.storage.delete(name)
+        return freed
+
+    def _size(self, name):
+        blob = AudioBlob.objects.filter(name=name).values_list("size", flat=True)
+        return blob.first() or self.storage.size(name)
+
+    def _drop(self, message_id, name, original_bytes, now, stats):
+        size = original_bytes or self._size(name)
+        updated = Message.objects.filter(id=message_id, audio_file=name).update(
+            audio_file="",
+            audio_state=Message.AUDIO_DROPPED,
+            audio_compacted_at=now,
+            audio_original_bytes=Coalesce(F("audio_original_bytes"), Value(size)),
+        )
+        if updated:
+            stats["bytes_reclaimed"] += self._release(name)
+            stats["dropped"] += 1
+
+    def _compact(self, message_id, name, original_bytes, now, stats):
+        with tempfile.TemporaryDirectory() as scratch:
+            source = os.path.join(scratch, "source" + os.path.splitext(name)[1])
+            with self.storage.open(name) as audio, open(source, "wb") as copy:
+                for chunk in audio.chunks(CHUNK_SIZE):
+                    copy.write(chunk)
+                    self.throttle.spend(len(chunk))
+            size = os.path.getsize(source)
+            target = os.path.join(scratch, ARCHIVE_NAME)
+            self.encode(source, target, self.bitrate)
+            archived = os.path.getsize(target)
+
+            if archived >= size:
+                # Already smaller than the archive format would make it
+                Message.objects.filter(id=message_id, audio_file=name).update(
+                    audio_state=Message.AUDIO_COMPACTED,
+                    audio_compacted_at=now,
+                    audio_original_bytes=size,
+                )
+                stats["compacted"] += 1
+                return
+
+            self.throttle.spend(archived)
+            with open(target, "rb") as archive:
+                new_name = self.storage.save(
+                    self.field.generate_filename(None, ARCHIVE_NAME), File(archive)
+                )
+
+        added = AudioBlob.objects.filter(name=new_name, refs=1).exists()
+        updated = Message.objects.filter(id=message_id, audio_file=name).update(
+            audio_file=new_name,
+            audio_state=Message.AUDIO_COMPACTED,
+            audio_compacted_at=now,
+            audio_original_bytes=size,
+        )
+        if not updated:
+            # The message changed or went while we were encoding
+            self.storage.delete(new_name)
+            return
+        stats["bytes_reclaimed"] += self._release(name) - (archived if added else 0)
+        stats["compacted"] += 1
+
+    def _mark_missing(self, message_id, name, now):
+        updated = Message.objects.filter(id=message_id, audio_file=name).update(
+            audio_file="", audio_state=Message.AUDIO_DROPPED, audio_compacted_at=now
+        )
+        if updated:
+            # Nothing left to remove, but the reference count still drops
+            self.storage.delete(name)
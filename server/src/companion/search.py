@@ -0,0 +1,218 @@
+import re
+
+from django.db import connection
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from .models import Message
+
+# Text search configuration of the generated search_vector column; queries
+# must use the same one for PostgreSQL to use its GIN index
+POSTGRES_CONFIG = "english"
+FTS_TABLE = "companion_message_fts"
+
+# Each FTS5 row also carries an "owner" token (u<user id>), so a search of
+# one user's messages intersects two index lists instead of looking up
+# every match in the message table. Ranking ignores it (bm25 weight 0).
+SQLITE_INDEX = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE}
+    USING fts5(text, owner, content='', tokenize='porter unicode61')
+    """,
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+]
+SQLITE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert
+    AFTER INSERT ON companion_message BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text, owner)
+        VALUES (new.id, new.text, 'u' || coalesce(new.user_id, 0));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete
+    AFTER DELETE ON companion_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, owner)
+        VALUES ('delete', old.id, old.text, 'u' || coalesce(old.user_id, 0));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update
+    AFTER UPDATE OF text, user_id ON companion_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text, owner)
+        VALUES ('delete', old.id, old.text, 'u' || coalesce(old.user_id, 0));
+        INSERT INTO {FTS_TABLE}(rowid, text, owner)
+        VALUES (new.id, new.text, 'u' || coalesce(new.user_id, 0));
+    END
+    """,
+]
+SQLITE_BACKFILL = f"""
+    INSERT INTO {FTS_TABLE}(rowid, text, owner)
+    SELECT id, text, 'u' || coalesce(user_id, 0) FROM companion_message
+"""
+POSTGRES_INDEX = [
+    f"""
+    ALTER TABLE companion_message ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('{POSTGRES_CONFIG}', text)) STORED
+    """,
+    """
+    CREATE INDEX message_search_vector_idx ON companion_message
+    USING GIN (search_vector)
+    """,
+]
+
+_TERMS = re.compile(r'(-?)"([^"]*)"|(-?)(\S+)')
+_WORDS = re.compile(r"\w+")
+
+
+def create_search_index(schema_editor):
+    """Add the full-text index over Message.text (run by migration 0010)"""
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        for sql in POSTGRES_INDEX:
+            schema_editor.execute(sql)
+    elif vendor == "sqlite":
+        for sql in SQLITE_INDEX + SQLITE_TRIGGERS + [SQLITE_BACKFILL]:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE companion_message DROP COLUMN search_vector")
+    elif vendor == "sqlite":
+        for suffix in ["insert", "delete", "update"]:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def restore_sqlite_triggers(using="default", **kwargs):
+    """
+    Recreate the SQLite triggers after migrations
+
+    SQLite can't alter most columns in place, so Django rebuilds the whole
+    table for such migrations, and the table's triggers go with it. The
+    copied rows keep their ids, so the FTS index itself stays valid.
+    """
+    from django.db import connections
+
+    db = connections[using]
+    if db.vendor != "sqlite":
+        return
+    with db.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [FTS_TABLE],
+        )
+        if cursor.fetchone():
+            for sql in SQLITE_TRIGGERS:
+                cursor.execute(sql)
+
+
+def fts5_query(text, user_id=None):
+    """
+    Translate a web-search style query into FTS5 syntax
+
+    Follows PostgreSQL's websearch_to_tsquery: words and "quoted phrases"
+    must all match, ``or`` between two terms matches either, and ``-term``
+    excludes a term. Punctuation is dropped, so no input is an FTS5 syntax
+    error. Returns "" when nothing is left to match.
+    """
+    expression = ""
+    either = False
+    for exclude, phrase, exclude_word, word in _TERMS.findall(text):
+        if word.lower() == "or" and not exclude_word:
+            either = bool(expression)
+            continue
+        words = _WORDS.findall(phrase or word)
+        if not words:
+            continue
+        term = 'text : "' + " ".join(words) + '"'
+        if exclude or exclude_word:
+            # FTS5's NOT needs something to subtract from
+            if expression:
+                expression += f" NOT {term}"
+        elif not expression:
+            expression = term
+        else:
+            expression += f" {'OR' if either else 'AND'} {term}"
+        either = False
+
+    if expression and user_id is not None:
+        expression = f"owner : u{int(user_id)} AND ({expression})"
+    return expression
+
+
+def matching(queryset, query):
+    """
+    Filter a Message queryset to those whose text matches ``query``
+
+    Unordered, for callers that sort by something else (the admin). Uses
+    the full-text index on PostgreSQL and SQLite; other databases fall back
+    to a substring match on each word.
+    """
+    if not fts5_query(query):
+        return queryset.none()
+    if connection.vendor == "postgresql":
+        return queryset.filter(
+            RawSQL(
+                "companion_message.search_vector @@ "
+                "websearch_to_tsquery(%s::regconfig, %s)",
+                [POSTGRES_CONFIG, query],
+                output_field=BooleanField(),
+            )
+        )
+    if connection.vendor == "sqlite":
+        return queryset.filter(
+            id__in=RawSQL(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                [fts5_query(query)],
+            )
+        )
+    for word in _WORDS.findall(query):
+        queryset = queryset.filter(text__icontains=word)
+    return queryset
+
+
+def search_messages(query, user_id, limit=20, offset=0):
+    """
+    One user's messages matching ``query``, best match first
+
+    Ranked by ts_rank on PostgreSQL and bm25 on SQLite; other databases get
+    the newest matches first.
+
+    Returns:
+        list: Messages, at most ``limit`` of them
+    """
+    expression = fts5_query(query, user_id)
+    if not expression:
+        return []
+
+    if connection.vendor == "postgresql":
+        sql = """
+            SELECT m.id FROM companion_message m,
+                websearch_to_tsquery(%s::regconfig, %s) query
+            WHERE m.search_vector @@ query AND m.user_id = %s
+            ORDER BY ts_rank(m.search_vector, query) DESC, m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        params = [POSTGRES_CONFIG, query, user_id, limit, offset]
+    elif connection.vendor == "sqlite":
+        sql = f"""
+            SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s
+            ORDER BY rank LIMIT %s OFFSET %s
+        """
+        params = [expression, limit, offset]
+    else:
+        return list(
+            matching(Message.objects.filter(user_id=user_id), query).order_by(
+                "-timestamp"
+            )[offset : offset + limit]
+        )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+    messages = Message.objects.in_bulk(ids)
+    # A row deleted between the two queries is simply left out
+    return [messages[id] for id in ids if id in messages]
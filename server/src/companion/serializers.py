@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Session, User
+from .models import Message, Session, User
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -11,14 +11,46 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class SessionSerializer(serializers.ModelSerializer):
+    """Expects a queryset from ``Session.objects.with_stats()``"""
+
+    message_count = serializers.IntegerField(read_only=True)
+    last_message_at = serializers.DateTimeField(read_only=True)
+    last_message_role = serializers.CharField(read_only=True)
+    last_message_preview = serializers.CharField(read_only=True)
+    duration_seconds = serializers.SerializerMethodField()
+
     class Meta:
         model = Session
         fields = [
             "id",
-            "user",
-            "timestamp",
-            "transcript",
-            "response_text",
-            "voice_used",
+            "title",
+            "started_at",
+            "updated_at",
+            "message_count",
+            "last_message_at",
+            "last_message_role",
+            "last_message_preview",
+            "duration_seconds",
         ]
-        read_only_fields = ["id", "timestamp"]
+        read_only_fields = fields
+
+    def get_duration_seconds(self, session):
+        # From the first turn to the last message; 0 for an empty session
+        if session.last_message_at is None:
+            return 0
+        return round((session.last_message_at - session.started_at).total_seconds())
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    audio_url = serializers.FileField(source="audio_file", read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ["id", "role", "text", "audio_url", "voice_used", "timestamp"]
+        read_only_fields = fields
+
+
+class SearchResultSerializer(MessageSerializer):
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ["session"]
+        read_only_fields = fields
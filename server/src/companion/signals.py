@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .context import context_store
+from .models import Message, Session
+
+
+@receiver(post_save, sender=Session)
+def session_saved(sender, instance, created, **kwargs):
+    context_store.session_touched(instance.user_id, instance.id, created)
+
+
+@receiver(post_delete, sender=Session)
+def session_deleted(sender, instance, **kwargs):
+    context_store.session_deleted(instance.user_id, instance.id)
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    context_store.message_saved(instance, created)
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    context_store.message_deleted(instance)
+    if instance.audio_file:
+        # Drops this message's reference to the (possibly shared) blob, once
+        # the delete is committed
+        audio = instance.audio_file
+        transaction.on_commit(lambda: audio.storage.delete(audio.name))
@@ -0,0 +1,125 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from audio_processing.prompt import count_tokens, truncate_to_tokens
+from audio_processing.registry import registry
+
+from .context import context_store
+from .models import Message, Session
+
+logger = logging.getLogger(__name__)
+
+# Most messages, and most tokens of them, folded into a summary in one LLM
+# call; a longer backlog takes several
+MAX_BATCH = 40
+MAX_BATCH_TOKENS = 4000
+
+_lock = threading.Lock()
+_executor = None
+_pending = set()
+
+
+def _unsummarized(session_id, summarized_through):
+    """
+    The oldest messages not yet in the summary that have left the history
+    window, at most MAX_BATCH of them
+    """
+    messages = Message.objects.filter(session_id=session_id)
+    if summarized_through is not None:
+        messages = messages.filter(id__gt=summarized_through)
+    # The newest message outside the window bounds the batch, so neither
+    # query reads more than the window and one batch
+    newest = list(
+        messages.order_by("-timestamp").values_list("timestamp", flat=True)[
+            settings.CONVERSATION_WINDOW : settings.CONVERSATION_WINDOW + 1
+        ]
+    )
+    if not newest:
+        return []
+    return list(
+        messages.filter(timestamp__lte=newest[0])
+        .order_by("timestamp")
+        .values("id", "role", "text")[:MAX_BATCH]
+    )
+
+
+def summarize_session(session_id, llm=None):
+    """
+    Fold messages that have left the history window into Session.summary
+
+    Runs once at least SESSION_SUMMARY_MIN_MESSAGES such messages are
+    waiting, so the summary is refreshed every couple of turns rather than
+    on each one. Each call folds in at most MAX_BATCH messages and
+    MAX_BATCH_TOKENS tokens, oldest first, and records how far it got.
+
+    Returns:
+        bool: Whether the summary was updated
+    """
+    session = (
+        Session.objects.filter(id=session_id)
+        .values("summary", "summarized_through")
+        .first()
+    )
+    if session is None:
+        return False
+
+    pending = _unsummarized(session_id, session["summarized_through"])
+    if len(pending) < settings.SESSION_SUMMARY_MIN_MESSAGES:
+        return False
+
+    batch, tokens = [], 0
+    for msg in pending:
+        content = truncate_to_tokens(msg["text"], settings.LLM_MESSAGE_TOKEN_LIMIT)
+        tokens += count_tokens(content)
+        if batch and tokens > MAX_BATCH_TOKENS:
+            break
+        batch.append({"id": msg["id"], "role": msg["role"], "content": content})
+
+    llm = llm or registry.llm()
+    summary = llm.summarize(
+        session["summary"],
+        [{"role": msg["role"], "content": msg["content"]} for msg in batch],
+    )
+    # update() leaves updated_at alone, so this doesn't reorder sessions
+    Session.objects.filter(id=session_id).update(
+        summary=summary, summarized_through=batch[-1]["id"]
+    )
+    context_store.summary_updated(session_id, summary)
+    logger.info(
+        "Session %s summary now covers %d more messages", session_id, len(batch)
+    )
+    return True
+
+
+def _run(session_id):
+    try:
+        # A long backlog (say, the first summary of a long session) is
+        # folded in one batch at a time
+        while summarize_session(session_id):
+            pass
+    except Exception:
+        logger.exception("Session summary failed for %s", session_id)
+    finally:
+        with _lock:
+            _pending.discard(session_id)
+        close_old_connections()
+
+
+def schedule_summary(session_id):
+    """Refresh a session's summary in the background, off the turn's path"""
+    global _executor
+    if not settings.SESSION_SUMMARY_ENABLED:
+        return
+    with _lock:
+        if session_id in _pending:
+            return
+        _pending.add(session_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="session-summary"
+            )
+    _executor.submit(_run, session_id)
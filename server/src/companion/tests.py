@@ -1 +1,1055 @@
-# Create your tests here.
+import csv
+import gzip
+import io
+import json
+import logging
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from audio_processing.admission import AdmissionGate, Overloaded
+from audio_processing.canned import FALLBACK_TIMEOUT
+from audio_processing.llm_service import LLMService
+from audio_processing.models import AudioBlob
+from audio_processing.registry import registry
+from audio_processing.resilience import BreakerOpen, CircuitBreaker, Resilience
+from audio_processing.tts_service import TTSService
+from mindvoice_project.log import (
+    BackgroundHandler,
+    JsonFormatter,
+    RequestContextFilter,
+    request_id,
+)
+
+from . import summaries
+from .context import context_store
+from .export import Exporter
+from .models import Message, Session, User
+from .pagination import EstimatedCountPaginator, estimated_row_count
+from .retention import AudioRetention, Throttle
+from .search import fts5_query, matching, search_messages
+from .usernames import allocate_username, create_user_with_unique_username
+
+# Plan lines that mean a full table/index scan or an explicit sort
+SQLITE_SLOW_PLAN = re.compile(r"\bSCAN\b|USE TEMP B-TREE")
+POSTGRES_SLOW_PLAN = re.compile(r"Seq Scan|^\s*(->\s*)?(Incremental )?Sort\b", re.M)
+
+
+@skipUnless(
+    connection.vendor in ("sqlite", "postgresql"),
+    "EXPLAIN checks cover SQLite/PostgreSQL",
+)
+class HotQueryPlanTests(TestCase):
+    """
+    The queries on the request path must be served by an index, with no
+    sequential scan and no sort, so their cost stays flat as tables grow
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("ada_obi", full_name="Ada Obi")
+        cls.session = Session.objects.create(user=cls.user)
+        Message.objects.create(
+            session=cls.session, user=cls.user, role="user", text="hi"
+        )
+
+    def explain(self, queryset):
+        if connection.vendor == "postgresql":
+            # Tiny test tables make a seq scan the cheapest plan; disabling
+            # the alternatives shows whether an index could serve the query
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("SET LOCAL enable_sort = off")
+        return queryset.explain()
+
+    def assertIndexed(self, queryset):
+        plan = self.explain(queryset)
+        slow = SQLITE_SLOW_PLAN if connection.vendor == "sqlite" else POSTGRES_SLOW_PLAN
+        self.assertIsNone(slow.search(plan), f"Query is not index-only:\n{plan}")
+
+    def test_login_by_full_name(self):
+        self.assertIndexed(User.objects.filter(full_name="Ada Obi"))
+
+    def test_username_probe(self):
+        self.assertIndexed(User.objects.filter(username="ada_obi"))
+
+    def test_active_session(self):
+        self.assertIndexed(
+            Session.objects.filter(user=self.user).order_by("-updated_at")[:1]
+        )
+
+    def test_session_history(self):
+        # Model ordering is -updated_at
+        self.assertIndexed(Session.objects.filter(user=self.user)[:10])
+
+    def test_recent_messages(self):
+        self.assertIndexed(
+            Message.objects.filter(session=self.session).order_by("-timestamp")[:10]
+        )
+
+    def test_session_messages_in_order(self):
+        self.assertIndexed(Message.objects.filter(session=self.session))
+
+    def test_session_page_with_stats(self):
+        self.assertIndexed(
+            Session.objects.filter(user=self.user)
+            .with_stats()
+            .order_by("-updated_at")[:21]
+        )
+
+
+class UsernameAllocationTests(TestCase):
+    def test_suffixes_follow_the_bare_name(self):
+        names = [
+            create_user_with_unique_username("John Doe").username for _ in range(3)
+        ]
+        self.assertEqual(names, ["john_doe", "john_doe_1", "john_doe_2"])
+
+    def test_one_query_per_allocation(self):
+        create_user_with_unique_username("John Doe")
+        with self.assertNumQueries(1):
+            self.assertEqual(allocate_username("john_doe"), "john_doe_1")
+
+    def test_seeds_from_existing_users(self):
+        for username in ["amaka", "amaka_1", "amaka_7", "amaka_eze", "amaka_x3"]:
+            User.objects.create_user(username)
+        self.assertEqual(allocate_username("amaka"), "amaka_8")
+
+    def test_retries_on_names_taken_elsewhere(self):
+        create_user_with_unique_username("Tunde")
+        # Created around the allocator, e.g. in the admin
+        User.objects.create_user("tunde_1")
+        self.assertEqual(create_user_with_unique_username("Tunde").username, "tunde_2")
+
+
+class SessionHistoryApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("ada_obi", full_name="Ada Obi")
+        cls.sessions = []
+        for i in range(5):
+            session = Session.objects.create(user=cls.user)
+            for j in range(i + 1):
+                Message.objects.create(
+                    session=session, user=cls.user, role="user", text=f"q{i}.{j}"
+                )
+            Message.objects.create(
+                session=session, user=cls.user, role="assistant", text=f"a{i}"
+            )
+            cls.sessions.append(session)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_pages_are_one_query_each(self):
+        ids = []
+        url = "/api/sessions/?page_size=2"
+        while url:
+            with self.assertNumQueries(1):
+                page = self.client.get(url).json()
+            ids += [session["id"] for session in page["results"]]
+            url = page["next"]
+        # Most recently active first, each session exactly once
+        self.assertEqual(ids, [session.id for session in reversed(self.sessions)])
+
+    def test_session_stats(self):
+        newest = self.client.get("/api/sessions/").json()["results"][0]
+        self.assertEqual(newest["message_count"], 6)
+        self.assertEqual(newest["last_message_role"], "assistant")
+        self.assertEqual(newest["last_message_preview"], "a4")
+        self.assertGreaterEqual(newest["duration_seconds"], 0)
+
+    def test_session_messages(self):
+        session = self.sessions[2]
+        with self.assertNumQueries(2):
+            page = self.client.get(f"/api/sessions/{session.id}/messages/").json()
+        self.assertEqual(
+            [message["text"] for message in page["results"]],
+            ["a2", "q2.2", "q2.1", "q2.0"],
+        )
+
+    def test_other_users_sessions_are_hidden(self):
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user("tunde"))
+        self.assertEqual(other.get("/api/sessions/").json()["results"], [])
+        response = other.get(f"/api/sessions/{self.sessions[0].id}/messages/")
+        self.assertEqual(response.status_code, 404)
+
+
+class AdminChangelistQueryTests(TestCase):
+    """Changelists must render in the same number of queries for any page"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser("root", "root@example.com", "pw")
+        for i in range(20):
+            user = User.objects.create_user(f"user_{i}", full_name=f"User {i}")
+            session = Session.objects.create(user=user)
+            for role in ["user", "assistant"]:
+                Message.objects.create(
+                    session=session, user=user, role=role, text="x" * 60
+                )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assertChangelistQueries(self, url, queries):
+        # Django session + user, estimated count, exact count, page of rows
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_session_changelist(self):
+        self.assertChangelistQueries("/admin/companion/session/", 5)
+
+    def test_session_changelist_by_message_count(self):
+        self.assertChangelistQueries("/admin/companion/session/?o=4", 5)
+
+    def test_message_changelist(self):
+        self.assertChangelistQueries("/admin/companion/message/", 5)
+
+    def test_message_changelist_filtered_by_username(self):
+        # Filtered lists skip the estimate
+        self.assertChangelistQueries(
+            "/admin/companion/message/?username=user_3&role=user", 4
+        )
+
+    def test_user_changelist(self):
+        self.assertChangelistQueries("/admin/companion/user/", 5)
+
+
+@skipUnless(
+    connection.vendor in ("sqlite", "postgresql"),
+    "Row estimates come from SQLite/PostgreSQL statistics",
+)
+class EstimatedCountPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("ada_obi")
+        session = Session.objects.create(user=user)
+        Message.objects.bulk_create(
+            Message(session=session, user=user, role="user", text=str(i))
+            for i in range(30)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=10)
+    def test_large_unfiltered_table_is_estimated(self):
+        self.assertEqual(estimated_row_count(Message), 30)
+        Message.objects.filter(text="0").delete()
+        # Statistics lag behind until the next ANALYZE
+        paginator = EstimatedCountPaginator(Message.objects.all(), 10)
+        self.assertEqual(paginator.count, 30)
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=10)
+    def test_filtered_queryset_is_counted(self):
+        paginator = EstimatedCountPaginator(Message.objects.filter(role="user"), 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 30)
+
+    def test_small_table_is_counted(self):
+        Message.objects.filter(text="0").delete()
+        paginator = EstimatedCountPaginator(Message.objects.all(), 10)
+        self.assertEqual(paginator.count, 29)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada = User.objects.create_user("ada_obi", full_name="Ada Obi")
+        cls.tunde = User.objects.create_user("tunde", full_name="Tunde")
+        for user in [cls.ada, cls.tunde]:
+            session = Session.objects.create(user=user)
+            for i in range(5):
+                Message.objects.create(
+                    session=session, user=user, role="user", text=f"{user} {i}"
+                )
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def read_jsonl(self, name):
+        with gzip.open(self.directory / name, "rt") as handle:
+            return [json.loads(line) for line in handle]
+
+    def test_jsonl_gzip_for_one_user(self):
+        call_command(
+            "export_conversations",
+            str(self.directory),
+            "--gzip",
+            "--user",
+            "tunde",
+            "--chunk-size",
+            "2",
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(
+            [user["username"] for user in self.read_jsonl("users.jsonl.gz")],
+            ["tunde"],
+        )
+        messages = self.read_jsonl("messages.jsonl.gz")
+        self.assertEqual(
+            [m["text"] for m in messages], [f"Tunde {i}" for i in range(5)]
+        )
+        self.assertEqual(
+            {m["session_id"] for m in messages},
+            {s["id"] for s in self.read_jsonl("sessions.jsonl.gz")},
+        )
+
+    def test_date_range(self):
+        Message.objects.filter(text="Ada Obi 0").update(
+            timestamp=timezone.now() - timedelta(days=30)
+        )
+        since = timezone.now() - timedelta(days=1)
+        Exporter(self.directory, since=since, compress=True).run()
+        texts = [m["text"] for m in self.read_jsonl("messages.jsonl.gz")]
+        self.assertNotIn("Ada Obi 0", texts)
+        self.assertEqual(len(texts), 9)
+
+    def test_since_includes_the_sessions_and_users_of_new_messages(self):
+        month_ago = timezone.now() - timedelta(days=30)
+        Session.objects.update(updated_at=month_ago)
+        User.objects.update(created_at=month_ago)
+        Message.objects.update(timestamp=month_ago)
+        # A new message in Tunde's old session; the session isn't touched
+        Message.objects.create(
+            session=Session.objects.get(user=self.tunde),
+            user=self.tunde,
+            role="user",
+            text="Tunde again",
+        )
+
+        Exporter(
+            self.directory, since=timezone.now() - timedelta(days=1), compress=True
+        ).run()
+        messages = self.read_jsonl("messages.jsonl.gz")
+        self.assertEqual([m["text"] for m in messages], ["Tunde again"])
+        sessions = self.read_jsonl("sessions.jsonl.gz")
+        self.assertEqual([s["id"] for s in sessions], [messages[0]["session_id"]])
+        users = self.read_jsonl("users.jsonl.gz")
+        self.assertEqual([u["username"] for u in users], ["tunde"])
+
+    def test_resume_after_interruption(self):
+        exporter = Exporter(self.directory, fmt="csv", compress=True, chunk_size=3)
+        encode = exporter._encode
+        calls = []
+
+        def crash_on_fourth_chunk(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 4:  # Second chunk of messages
+                raise KeyboardInterrupt
+            return encode(*args, **kwargs)
+
+        with mock.patch.object(exporter, "_encode", crash_on_fourth_chunk):
+            with self.assertRaises(KeyboardInterrupt):
+                exporter.run()
+        stats = Exporter(self.directory, fmt="csv", compress=True, chunk_size=3).run(
+            resume=True
+        )
+        self.assertEqual(stats["messages"]["rows"], 7)
+
+        with gzip.open(self.directory / "messages.csv.gz", "rt") as handle:
+            rows = list(csv.DictReader(handle))
+        self.assertEqual(
+            [row["id"] for row in rows],
+            [
+                str(pk)
+                for pk in Message.objects.order_by("id").values_list("id", flat=True)
+            ],
+        )
+
+    def test_audio_bundle(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        with self.settings(MEDIA_ROOT=media):
+            message = Message.objects.first()
+            message.audio_file.save("clip.mp3", ContentFile(b"ID3 audio"))
+            Exporter(self.directory, audio=True).run()
+        self.assertEqual(
+            (self.directory / "audio" / message.audio_file.name).read_bytes(),
+            b"ID3 audio",
+        )
+
+
+class SyntheticDataTests(TestCase):
+    def test_generate(self):
+        began = timezone.now()
+        call_command(
+            "generate_synthetic_data",
+            "--users=50",
+            "--messages=500",
+            "--namesakes=3",
+            "--months=2",
+            "--batch-size=100",
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(User.objects.count(), 53)
+        self.assertEqual(Message.objects.count(), 500)
+        # The namesakes share one full name
+        self.assertEqual(User.objects.values("full_name").distinct().count(), 51)
+        oldest = began - timedelta(days=61)
+        self.assertFalse(Message.objects.exclude(timestamp__range=(oldest, began)))
+        for session in Session.objects.with_stats()[:20]:
+            self.assertEqual(session.updated_at, session.last_message_at)
+        # The allocator carries on after the generated namesakes
+        self.assertEqual(
+            create_user_with_unique_username("John Doe").username, "john_doe_3"
+        )
+        # Timestamps are stamped on save again
+        self.assertGreaterEqual(
+            Session.objects.create(user=User.objects.first()).started_at, began
+        )
+
+
+class FTS5QueryTests(TestCase):
+    def test_words_phrases_or_and_exclusions(self):
+        self.assertEqual(
+            fts5_query('sleep "panic attack" or anxiety -work'),
+            'text : "sleep" AND text : "panic attack" OR text : "anxiety" '
+            'NOT text : "work"',
+        )
+
+    def test_punctuation_is_never_syntax(self):
+        self.assertEqual(
+            fts5_query('AND* "NEAR(x" ^'), 'text : "AND" AND text : "NEAR x"'
+        )
+        self.assertEqual(fts5_query("-only -excluded"), "")
+
+    def test_scoped_to_owner(self):
+        self.assertEqual(fts5_query("sleep", 7), 'owner : u7 AND (text : "sleep")')
+
+
+@skipUnless(
+    connection.vendor in ("sqlite", "postgresql"),
+    "Indexed search covers SQLite/PostgreSQL",
+)
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ada = User.objects.create_user("ada_obi")
+        cls.tunde = User.objects.create_user("tunde")
+        for user, texts in [
+            (
+                cls.ada,
+                [
+                    "I can't sleep before exams",
+                    "Sleeping badly, sleep is all I think about, no sleep",
+                    "Work has been fine",
+                ],
+            ),
+            (cls.tunde, ["I sleep well"]),
+        ]:
+            session = Session.objects.create(user=user)
+            for text in texts:
+                Message.objects.create(
+                    session=session, user=user, role="user", text=text
+                )
+
+    def texts(self, messages):
+        return [message.text for message in messages]
+
+    def test_ranked_and_scoped_to_the_user(self):
+        self.assertEqual(
+            self.texts(search_messages("sleep", self.ada.id)),
+            [
+                "Sleeping badly, sleep is all I think about, no sleep",
+                "I can't sleep before exams",
+            ],
+        )
+        self.assertEqual(
+            self.texts(search_messages("sleep", self.tunde.id)), ["I sleep well"]
+        )
+
+    def test_index_follows_updates_and_deletes(self):
+        Message.objects.filter(text="Work has been fine").update(
+            text="Work keeps me awake"
+        )
+        self.assertEqual(
+            self.texts(search_messages("awake", self.ada.id)), ["Work keeps me awake"]
+        )
+        self.assertEqual(search_messages("fine", self.ada.id), [])
+        Message.objects.filter(text__startswith="Sleeping").delete()
+        self.assertEqual(len(search_messages("sleep", self.ada.id)), 1)
+
+    def test_admin_matching_covers_all_users(self):
+        self.assertEqual(matching(Message.objects.all(), "sleep").count(), 3)
+        self.assertEqual(matching(Message.objects.all(), "sleep -exams").count(), 2)
+
+    def test_api(self):
+        client = APIClient()
+        client.force_authenticate(self.tunde)
+        with self.assertNumQueries(2):
+            response = client.get("/api/search/", {"q": "sleep"})
+        self.assertEqual(
+            [result["text"] for result in response.json()["results"]],
+            ["I sleep well"],
+        )
+        self.assertEqual(client.get("/api/search/").status_code, 400)
+
+
+def fake_encode(source_path, target_path, bitrate):
+    with open(target_path, "wb") as target:
+        target.write(b"opus")
+
+
+class AudioRetentionTests(TestCase):
+    POLICY = {
+        "user": {"compact_after_days": 30, "drop_after_days": 365},
+        "assistant": {"compact_after_days": 0, "drop_after_days": 90},
+    }
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings = override_settings(MEDIA_ROOT=media)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.user = User.objects.create_user("ada_obi")
+        self.session = Session.objects.create(user=self.user)
+        self.retention = AudioRetention(
+            policy=self.POLICY, batch_size=2, io_limit=0, encode=fake_encode
+        )
+
+    def recording(self, role, days_old, data):
+        message = Message.objects.create(
+            session=self.session, user=self.user, role=role, text="hi"
+        )
+        message.audio_file.save("clip.webm", ContentFile(data))
+        Message.objects.filter(id=message.id).update(
+            timestamp=timezone.now() - timedelta(days=days_old)
+        )
+        return message
+
+    def test_old_user_audio_is_compacted(self):
+        old = [self.recording("user", 40, b"x" * 1000 + bytes([i])) for i in range(3)]
+        recent = self.recording("user", 5, b"recent")
+
+        stats = self.retention.run()
+        self.assertEqual(stats["compacted"], 3)
+        # Three originals freed, one shared archive blob stored
+        self.assertEqual(stats["bytes_reclaimed"], 3 * 1001 - 4)
+
+        for message in old:
+            message.refresh_from_db()
+            self.assertEqual(message.audio_state, Message.AUDIO_COMPACTED)
+            self.assertEqual(message.audio_original_bytes, 1001)
+            self.assertTrue(message.audio_file.name.endswith(".ogg"))
+            self.assertEqual(message.audio_file.read(), b"opus")
+        recent.refresh_from_db()
+        self.assertEqual(recent.audio_state, Message.AUDIO_ORIGINAL)
+        self.assertEqual(AudioBlob.objects.count(), 2)
+        self.assertEqual(self.retention.run()["compacted"], 0)
+
+    def test_shared_audio_is_reclaimed_with_its_last_message(self):
+        first = self.recording("assistant", 100, b"fallback")
+        second = self.recording("assistant", 10, b"fallback")
+        self.assertEqual(self.retention.run()["bytes_reclaimed"], 0)
+        first.refresh_from_db()
+        self.assertEqual(first.audio_state, Message.AUDIO_DROPPED)
+        self.assertFalse(first.audio_file)
+        self.assertEqual(first.audio_original_bytes, 8)
+
+        Message.objects.filter(id=second.id).update(
+            timestamp=timezone.now() - timedelta(days=100)
+        )
+        stats = self.retention.run()
+        self.assertEqual((stats["dropped"], stats["bytes_reclaimed"]), (1, 8))
+        self.assertFalse(AudioBlob.objects.exists())
+
+    def test_failures_are_skipped(self):
+        def broken_encode(*args):
+            raise RuntimeError("ffmpeg failed")
+
+        self.retention.encode = broken_encode
+        # More failures than a batch holds (2), all at the same time
+        timestamp = timezone.now() - timedelta(days=40)
+        failing = [self.recording("user", 40, b"audio %d" % i) for i in range(5)]
+        Message.objects.filter(id__in=[m.id for m in failing]).update(
+            timestamp=timestamp
+        )
+        missing = self.recording("user", 40, b"lost")
+        missing.audio_file.storage.delete(missing.audio_file.name)
+
+        with CaptureQueriesContext(connection) as queries:
+            stats = self.retention.run()
+        self.assertEqual((stats["failed"], stats["missing"]), (5, 1))
+        # Each due message is fetched once: the failures aren't retried
+        fetches = [q for q in queries if '"audio_original_bytes" AS' in q["sql"]]
+        # Dropping: one empty batch per role; compacting: three full and one
+        # empty batch of the user's six
+        self.assertEqual(len(fetches), 2 + 4)
+        for message in failing:
+            message.refresh_from_db()
+            self.assertEqual(message.audio_state, Message.AUDIO_ORIGINAL)
+        missing.refresh_from_db()
+        self.assertEqual(missing.audio_state, Message.AUDIO_DROPPED)
+
+    def test_messages_left_due_are_visited_once(self):
+        # As when a message changes while it is being compacted
+        due = [self.recording("user", 40, b"audio %d" % i).id for i in range(5)]
+        visited = []
+
+        def leave_as_is(message_id, *args):
+            visited.append(message_id)
+            if len(visited) > 2 * len(due):
+                raise RuntimeError("Revisiting messages")
+
+        stats = dict(failed=0, missing=0)
+        self.retention._work_through(
+            self.retention.due("user", "compact"), leave_as_is, timezone.now(), stats
+        )
+        self.assertEqual(visited, due)
+        self.assertEqual(stats["failed"], 0)
+
+
+class ThrottleTests(TestCase):
+    def test_holds_the_average_rate(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        throttle = Throttle(1000, clock=lambda: now[0], sleep=sleep)
+        for _ in range(4):
+            throttle.spend(500)
+        self.assertEqual(now[0], 2.0)
+
+        # An idle spell doesn't bank a burst
+        now[0] += 60
+        sleeps.clear()
+        throttle.spend(1000)
+        self.assertEqual(sleeps, [1.0])
+
+
+class VoiceAdmissionTests(TestCase):
+    def test_overloaded_provider_is_a_503_with_retry_after(self):
+        llm = mock.Mock()
+        llm.get_response.side_effect = Overloaded("openai", 2.5)
+        with mock.patch.object(registry, "llm", return_value=llm):
+            response = APIClient().post(
+                "/api/voice_input/", {"text": "hello"}, format="json"
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "3")
+
+    def test_open_tts_circuit_answers_with_text_at_once(self):
+        llm = mock.Mock()
+        llm.get_response.return_value = "I hear you."
+        breaker = CircuitBreaker("tts", open_seconds=30)
+        breaker._open()
+        tts = TTSService(resilience=Resilience("tts", breaker))
+        tts.api_url = "http://127.0.0.1:9/unreachable"
+        with mock.patch.object(registry, "llm", return_value=llm), mock.patch.object(
+            registry, "tts", return_value=tts
+        ):
+            response = APIClient().post(
+                "/api/voice_input/", {"text": "hello"}, format="json"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["response_text"], "I hear you.")
+        self.assertIsNone(response.json()["audio_url"])
+        self.assertIn("circuit open", response.json()["tts_error"])
+
+    def canned_tts(self):
+        tts = mock.Mock()
+        tts.tee.side_effect = lambda text, *args, **kwargs: (
+            iter([b"ID3" + text.encode()]),
+            mock.Mock(),
+        )
+        return tts
+
+    def test_open_llm_circuit_speaks_the_canned_reply(self):
+        client = mock.Mock()
+        breaker = CircuitBreaker("llm", open_seconds=30)
+        breaker._open()
+        llm = LLMService(client=client, resilience=Resilience("llm", breaker))
+        with mock.patch.object(registry, "llm", return_value=llm), mock.patch.object(
+            registry, "tts", return_value=self.canned_tts()
+        ):
+            response = APIClient().post(
+                "/api/voice_input/", {"text": "hello"}, format="json"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            b"".join(response.streaming_content), b"ID3" + FALLBACK_TIMEOUT.encode()
+        )
+        client.with_options().chat.completions.create.assert_not_called()
+
+    def test_open_stt_circuit_speaks_the_canned_reply(self):
+        stt, llm = mock.Mock(), mock.Mock()
+        stt.transcribe.side_effect = BreakerOpen("stt", 30)
+        with mock.patch.object(registry, "stt", return_value=stt), mock.patch.object(
+            registry, "llm", return_value=llm
+        ), mock.patch.object(registry, "tts", return_value=self.canned_tts()):
+            response = APIClient().post(
+                "/api/voice_input/",
+                {"audio": SimpleUploadedFile("q.webm", b"webm", "audio/webm")},
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            b"".join(response.streaming_content), b"ID3" + FALLBACK_TIMEOUT.encode()
+        )
+        llm.get_response.assert_not_called()
+
+    @override_settings(DEADLINE_MIN_SECONDS=0.1)
+    def test_late_reply_skips_tts(self):
+        def slow_reply(*args):
+            time.sleep(0.3)
+            return "Sorry, I was thinking."
+
+        llm = mock.Mock()
+        llm.get_response.side_effect = slow_reply
+        tts = TTSService()
+        tts.api_url = "http://127.0.0.1:9/unreachable"
+        with mock.patch.object(registry, "llm", return_value=llm), mock.patch.object(
+            registry, "tts", return_value=tts
+        ):
+            response = APIClient().post(
+                "/api/voice_input/",
+                {"text": "hello"},
+                format="json",
+                HTTP_X_REQUEST_TIMEOUT="0.2",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["response_text"], "Sorry, I was thinking.")
+        self.assertIn("deadline exceeded", response.json()["tts_error"])
+        deadline = llm.get_response.call_args.args[-1]
+        self.assertEqual(deadline.seconds, 0.2)
+
+    @override_settings(DEADLINE_MIN_SECONDS=0.1)
+    def test_busy_gate_near_the_deadline_speaks_the_canned_reply(self):
+        # No time left to queue for OpenAI: the turn is late, not rejected
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        gate = AdmissionGate("openai", directory, 1, 60000, 4, max_wait=5)
+        client = mock.Mock()
+        llm = LLMService(client=client, gate=gate)
+        with gate.admit(), mock.patch.object(
+            registry, "llm", return_value=llm
+        ), mock.patch.object(registry, "tts", return_value=self.canned_tts()):
+            response = APIClient().post(
+                "/api/voice_input/",
+                {"text": "hello"},
+                format="json",
+                HTTP_X_REQUEST_TIMEOUT="2.5",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            b"".join(response.streaming_content), b"ID3" + FALLBACK_TIMEOUT.encode()
+        )
+        client.with_options().chat.completions.create.assert_not_called()
+
+
+@override_settings(SESSION_SUMMARY_ENABLED=False)
+class AsyncVoiceInputAuthTests(TestCase):
+    def setUp(self):
+        context_store.reset()
+        self.addCleanup(context_store.reset)
+        self.user = User.objects.create_user("ada_obi", voice_preference="idera")
+        self.llm = mock.Mock()
+        self.llm.get_response = mock.AsyncMock(return_value="I hear you.")
+        self.tts = mock.Mock()
+        self.tts.stream_synthesize.side_effect = Exception("TTS is down")
+
+    def post(self, client, **headers):
+        with mock.patch.object(
+            registry, "async_llm", return_value=self.llm
+        ), mock.patch.object(registry, "async_tts", return_value=self.tts):
+            return client.post(
+                "/api/voice_input/async/",
+                {"text": "hello", "voice_preference": "jude"},
+                content_type="application/json",
+                headers=headers,
+            )
+
+    def test_session_post_without_csrf_token_is_refused(self):
+        # As from another site, riding on the user's session cookie
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        response = self.post(client)
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("CSRF", response.json()["detail"])
+        self.llm.get_response.assert_not_called()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.voice_preference, "idera")
+        self.assertFalse(Message.objects.exists())
+
+    def test_token_post_needs_no_csrf_token(self):
+        token = Token.objects.create(user=self.user)
+        response = self.post(
+            Client(enforce_csrf_checks=True), Authorization=f"Token {token.key}"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["response_text"], "I hear you.")
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 2)
+
+
+@override_settings(METRICS_TOKEN="scrape-me")
+class MetricsEndpointTests(TestCase):
+    def test_turn_stages_are_exported(self):
+        llm = mock.Mock()
+        llm.get_response.return_value = "Hello there."
+        tts = mock.Mock()
+        tts.tee.side_effect = Exception("TTS error: down")
+        with mock.patch.object(registry, "llm", return_value=llm), mock.patch.object(
+            registry, "tts", return_value=tts
+        ):
+            APIClient().post(
+                "/api/voice_input/",
+                {"text": "hello", "voice_preference": "idera"},
+                format="json",
+            )
+
+        self.assertEqual(APIClient().get("/metrics").status_code, 401)
+        response = APIClient().get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        body = response.content.decode()
+        for stage in ("llm", "tts", "serialize"):
+            self.assertIn(
+                f'mindvoice_stage_seconds_count{{input="text",stage="{stage}",'
+                'voice="Idera"}',
+                body,
+            )
+
+
+class StructuredLoggingTests(TestCase):
+    def _handler(self, stream, **filter_options):
+        handler = BackgroundHandler(stream)
+        handler.addFilter(RequestContextFilter(**filter_options))
+        handler.setFormatter(JsonFormatter())
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_turn_logs_carry_request_id_without_conversation_text(self):
+        stream = io.StringIO()
+        handler = self._handler(stream)
+        logger = logging.getLogger("companion.views")
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.DEBUG)
+
+        llm = mock.Mock()
+        llm.get_response.return_value = "Breathe slowly with me."
+        tts = mock.Mock()
+        tts.tee.side_effect = Exception("TTS error: down")
+        with mock.patch.object(registry, "llm", return_value=llm), mock.patch.object(
+            registry, "tts", return_value=tts
+        ):
+            response = APIClient().post(
+                "/api/voice_input/",
+                {"text": "I cannot sleep"},
+                format="json",
+                HTTP_X_REQUEST_ID="client-42",
+            )
+        handler.flush()
+
+        self.assertEqual(response["X-Request-ID"], "client-42")
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertIn("TTS failed", " ".join(r["message"] for r in records))
+        self.assertEqual({r["request_id"] for r in records}, {"client-42"})
+        self.assertIn("<14 chars>", [r.get("transcript") for r in records])
+        self.assertNotIn("sleep", stream.getvalue())
+        self.assertNotIn("Breathe", stream.getvalue())
+
+        # IDs a client can't be trusted with are replaced
+        response = APIClient().get("/api/welcome/", HTTP_X_REQUEST_ID="a b\nc")
+        self.assertRegex(response["X-Request-ID"], r"^[0-9a-f]{32}$")
+
+    def test_debug_records_are_sampled_per_request(self):
+        log_filter = RequestContextFilter(debug_sample_rate=0.25)
+        sampled = [log_filter.sampled(f"request-{i}") for i in range(2000)]
+        self.assertAlmostEqual(sum(sampled) / len(sampled), 0.25, delta=0.05)
+
+        def kept(level, rid):
+            token = request_id.set(rid)
+            try:
+                record = logging.makeLogRecord({"levelno": level, "msg": "step"})
+                return log_filter.filter(record)
+            finally:
+                request_id.reset(token)
+
+        skipped = f"request-{sampled.index(False)}"
+        chosen = f"request-{sampled.index(True)}"
+        self.assertFalse(kept(logging.DEBUG, skipped))
+        self.assertTrue(kept(logging.DEBUG, chosen))
+        self.assertTrue(kept(logging.WARNING, skipped))
+
+    def test_stalled_output_drops_records_instead_of_blocking(self):
+        release = threading.Event()
+
+        class StalledStream(io.StringIO):
+            def write(self, text):
+                release.wait(5)
+                return super().write(text)
+
+        stream = StalledStream()
+        handler = BackgroundHandler(stream, queue_size=5)
+        self.addCleanup(handler.close)
+        logger = logging.getLogger("tests.stalled")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        began = time.perf_counter()
+        for i in range(50):
+            logger.warning("record %d", i)
+        self.assertLess(time.perf_counter() - began, 1)
+        self.assertGreater(handler.dropped, 0)
+
+        release.set()
+        handler.flush()
+        logger.warning("after")
+        handler.flush()
+        self.assertIn("dropped", stream.getvalue())
+        self.assertIn("after", stream.getvalue())
+
+
+@override_settings(CONVERSATION_CACHE_ALIAS="default", CONVERSATION_WINDOW=2)
+class ConversationContextTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        context_store.reset()
+        self.addCleanup(context_store.reset)
+        self.user = User.objects.create_user("ada_obi", full_name="Ada Obi")
+
+    def say(self, session, role, text):
+        return Message.objects.create(
+            session=session, user=self.user, role=role, text=text
+        )
+
+    def test_writes_keep_the_window_current_without_queries(self):
+        self.assertEqual(context_store.history(self.user.id), (None, [], ""))
+        with self.assertNumQueries(0):
+            self.assertEqual(context_store.history(self.user.id), (None, [], ""))
+
+        session = Session.objects.create(user=self.user)
+        for role, text in [("user", "Hi"), ("assistant", "Hello"), ("user", "Ok")]:
+            self.say(session, role, text)
+        with self.assertNumQueries(0):
+            session_id, history, summary = context_store.history(self.user.id)
+        self.assertEqual(session_id, session.id)
+        # Only the last CONVERSATION_WINDOW messages are kept
+        self.assertEqual(
+            history,
+            [
+                {"role": "assistant", "content": "Hello"},
+                {"role": "user", "content": "Ok"},
+            ],
+        )
+
+        context_store.summary_updated(session.id, "Ada said hi.")
+        with self.assertNumQueries(0):
+            self.assertEqual(context_store.history(self.user.id)[2], "Ada said hi.")
+
+    def test_edits_and_deletes(self):
+        session = Session.objects.create(user=self.user)
+        first = self.say(session, "user", "Hi")
+        last = self.say(session, "assistant", "Hello")
+        context_store.history(self.user.id)
+
+        last.text = "Hello, Ada"
+        last.save()
+        with self.assertNumQueries(0):
+            history = context_store.history(self.user.id)[1]
+        self.assertEqual(history[-1]["content"], "Hello, Ada")
+
+        # Deleting a message in the window drops it, to be reloaded
+        first.delete()
+        with self.assertNumQueries(2):
+            history = context_store.history(self.user.id)[1]
+        self.assertEqual(history, [{"role": "assistant", "content": "Hello, Ada"}])
+
+        # A new session becomes the active one; deleting it falls back
+        newer = Session.objects.create(user=self.user)
+        self.assertEqual(context_store.history(self.user.id), (newer.id, [], ""))
+        newer.delete()
+        self.assertEqual(context_store.history(self.user.id)[0], session.id)
+
+    @override_settings(CONVERSATION_CACHE_ALIAS="", CONVERSATION_LOCAL_CACHE_TTL=5)
+    def test_local_cache_sees_other_workers_sessions(self):
+        session = Session.objects.create(user=self.user)
+        self.say(session, "user", "Hi")
+        self.assertEqual(context_store.history(self.user.id)[0], session.id)
+
+        # Started on another worker, whose signals never reach this one
+        with mock.patch.object(context_store, "session_touched"):
+            newer = Session.objects.create(user=self.user)
+        # The active session, then the new window's messages and summary
+        with self.assertNumQueries(3):
+            self.assertEqual(context_store.history(self.user.id), (newer.id, [], ""))
+        with self.assertNumQueries(1):
+            self.assertEqual(context_store.history(self.user.id)[0], newer.id)
+
+        # Windows those writes may have missed expire within seconds
+        _, expires = context_store.backend._entries[f"conversation:session:{newer.id}"]
+        self.assertLessEqual(expires - time.monotonic(), 5)
+
+
+@override_settings(CONVERSATION_WINDOW=2, SESSION_SUMMARY_MIN_MESSAGES=2)
+class SessionSummaryTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user("ada_obi", full_name="Ada Obi")
+        self.session = Session.objects.create(user=user)
+        began = timezone.now()
+        self.messages = []
+        for i in range(9):
+            message = Message.objects.create(
+                session=self.session, user=user, role="user", text=f"m{i}"
+            )
+            Message.objects.filter(id=message.id).update(
+                timestamp=began + timedelta(minutes=i)
+            )
+            self.messages.append(message)
+        self.llm = mock.Mock()
+        self.llm.summarize.side_effect = lambda summary, batch: summary + "".join(
+            msg["content"] for msg in batch
+        )
+
+    def folded(self):
+        return [
+            [msg["content"] for msg in call.args[1]]
+            for call in self.llm.summarize.call_args_list
+        ]
+
+    @mock.patch.object(summaries, "MAX_BATCH", 3)
+    def test_a_long_backlog_is_folded_one_batch_at_a_time(self):
+        with mock.patch.object(summaries, "close_old_connections"), mock.patch.object(
+            registry, "llm", return_value=self.llm
+        ):
+            summaries._run(self.session.id)
+        # Seven messages left the window; the last one waits for company
+        self.assertEqual(self.folded(), [["m0", "m1", "m2"], ["m3", "m4", "m5"]])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, "m0m1m2m3m4m5")
+        self.assertEqual(self.session.summarized_through, self.messages[5].id)
+
+    @mock.patch.object(summaries, "MAX_BATCH_TOKENS", 1)
+    def test_batches_are_capped_in_tokens(self):
+        self.assertTrue(summaries.summarize_session(self.session.id, self.llm))
+        self.assertTrue(summaries.summarize_session(self.session.id, self.llm))
+        # At least one message goes in, however long
+        self.assertEqual(self.folded(), [["m0"], ["m1"]])
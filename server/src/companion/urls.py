@@ -1,7 +1,23 @@
 from django.urls import path
 
+from audio_processing.views import (
+    AdmissionStatsView,
+    ResilienceStatsView,
+    TTSCacheStatsView,
+    UpstreamPoolStatsView,
+    VADStatsView,
+)
+
+from .async_views import AsyncVoiceInputView
 from .auth_views import LoginView, MeView, RegisterView
-from .views import SessionHistoryView, UserProfileView, VoiceInputView
+from .views import (
+    MessageSearchView,
+    SessionHistoryView,
+    SessionMessagesView,
+    UserProfileView,
+    VoiceInputView,
+    WelcomeView,
+)
 
 urlpatterns = [
     # Authentication
@@ -10,6 +26,32 @@ urlpatterns = [
     path("auth/me/", MeView.as_view(), name="me"),
     # Voice & Chat
     path("voice_input/", VoiceInputView.as_view(), name="voice_input"),
+    path(
+        "voice_input/async/",
+        AsyncVoiceInputView.as_view(),
+        name="voice_input_async",
+    ),
+    path("welcome/", WelcomeView.as_view(), name="welcome"),
     path("profile/", UserProfileView.as_view(), name="user_profile"),
     path("sessions/", SessionHistoryView.as_view(), name="session_history"),
+    path(
+        "sessions/<int:session_id>/messages/",
+        SessionMessagesView.as_view(),
+        name="session_messages",
+    ),
+    path("search/", MessageSearchView.as_view(), name="message_search"),
+    # Operations
+    path(
+        "upstream/pools/",
+        UpstreamPoolStatsView.as_view(),
+        name="upstream_pool_stats",
+    ),
+    path("upstream/tts-cache/", TTSCacheStatsView.as_view(), name="tts_cache_stats"),
+    path("upstream/vad/", VADStatsView.as_view(), name="vad_stats"),
+    path("upstream/admission/", AdmissionStatsView.as_view(), name="admission_stats"),
+    path(
+        "upstream/resilience/",
+        ResilienceStatsView.as_view(),
+        name="resilience_stats",
+    ),
 ]
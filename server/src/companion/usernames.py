@@ -0,0 +1,81 @@
+import re
+
+from django.db import IntegrityError, connection, transaction
+
+from .models import User, UsernameSequence
+
+
+def base_username(full_name):
+    return full_name.lower().replace(" ", "_")
+
+
+def _highest_suffix(base):
+    """
+    Highest suffix already used for ``base``: -1 if none, 0 if only the bare
+    base is taken. Scans every match, so it only runs once per base, to seed
+    its sequence from users created before sequences existed.
+    """
+    suffixed = re.compile(rf"{re.escape(base)}_(\d+)")
+    highest = -1
+    for username in User.objects.filter(username__startswith=base).values_list(
+        "username", flat=True
+    ):
+        if username == base:
+            highest = max(highest, 0)
+        elif match := suffixed.fullmatch(username):
+            highest = max(highest, int(match.group(1)))
+    return highest
+
+
+def _next_suffix(base):
+    table = connection.ops.quote_name(UsernameSequence._meta.db_table)
+    with connection.cursor() as cursor:
+        # One primary-key update; the row lock serializes concurrent callers
+        cursor.execute(
+            f"UPDATE {table} SET last_suffix = last_suffix + 1 "
+            f"WHERE base = %s RETURNING last_suffix",
+            [base],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def allocate_username(base):
+    """
+    Reserve the next username for ``base``: base, base_1, base_2, ...
+
+    Each call advances a per-base counter in a single query, so the cost
+    doesn't grow with the number of users sharing the name. Suffixes are
+    never reused, and the caller must still handle IntegrityError on insert
+    for names taken outside this allocator (e.g. through the admin).
+    """
+    suffix = _next_suffix(base)
+    if suffix is None:
+        try:
+            with transaction.atomic():
+                suffix = _highest_suffix(base) + 1
+                UsernameSequence.objects.create(base=base, last_suffix=suffix)
+        except IntegrityError:
+            # Another registration seeded it first
+            suffix = _next_suffix(base)
+    return base if suffix == 0 else f"{base}_{suffix}"
+
+
+def create_user_with_unique_username(full_name, max_attempts=5, **fields):
+    """
+    Create a user with a username derived from ``full_name``
+
+    Inserts optimistically and retries with the next allocated name on a
+    unique-constraint collision, instead of checking for existence first.
+    """
+    base = base_username(full_name)
+    for attempt in range(max_attempts):
+        username = allocate_username(base)
+        try:
+            with transaction.atomic():
+                return User.objects.create_user(
+                    username=username, full_name=full_name, **fields
+                )
+        except IntegrityError:
+            if attempt == max_attempts - 1:
+                raise
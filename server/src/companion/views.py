@@ -1,42 +1,320 @@
-from django.core.files.base import ContentFile
-from django.http import HttpResponse
+import base64
+import json
+import logging
+import math
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from audio_processing.llm_service import LLMService
-from audio_processing.stt_service import STTService
-from audio_processing.tts_service import TTSService
+from audio_processing.admission import Overloaded
+from audio_processing.audio_spool import AudioSpool
+from audio_processing.canned import FALLBACK_TIMEOUT, WELCOME
+from audio_processing.deadline import Deadline, DeadlineExceeded
+from audio_processing.metrics import metrics
+from audio_processing.registry import registry
+from audio_processing.resilience import BreakerOpen
+from audio_processing.sentences import iter_sentences
+from audio_processing.uploads import (
+    AudioUploadLimitHandler,
+    AudioUploadRejected,
+    check_audio_upload,
+)
+from audio_processing.vad import SilentAudio
+
+from .context import context_store
+from .models import Message, Session, User
+from .pagination import MessageCursorPagination, SessionCursorPagination
+from .search import search_messages
+from .serializers import (
+    MessageSerializer,
+    SearchResultSerializer,
+    SessionSerializer,
+    UserSerializer,
+)
+from .summaries import schedule_summary
+
+logger = logging.getLogger(__name__)
+
+_VOICES = {voice for voice, _ in User.VOICE_CHOICES}
+
+
+def _encode_header(value):
+    # HTTP headers can't contain newlines, so text is passed base64 encoded
+    return base64.b64encode(value.encode()).decode()
+
+
+def _retry_after(error):
+    """Retry-After header value for an Overloaded rejection"""
+    return str(math.ceil(error.retry_after))
 
-from .models import Message, Session
-from .serializers import SessionSerializer, UserSerializer
+
+def _metric_labels(voice, audio_file):
+    """Labels of a turn's stage timings; unknown voices share one label"""
+    voice = str(voice).capitalize()
+    return {
+        "voice": voice if voice in _VOICES else "other",
+        "input": "audio" if audio_file else "text",
+    }
+
+
+def _stream_event(event_type, **fields):
+    """Serialize one event of the streaming voice response as an NDJSON line"""
+    return (json.dumps({"type": event_type, **fields}) + "\n").encode()
 
 
 class VoiceInputView(APIView):
     """
     Main endpoint: /api/voice_input
     Receives audio -> STT -> LLM -> TTS -> returns audio
+
+    Send ``stream=true`` (form field or query parameter) to receive the reply
+    as it is generated: an ``application/x-ndjson`` stream of events
+
+        {"type": "transcript", "text": ...}
+        {"type": "text", "text": ...}        one per sentence
+        {"type": "audio", "data": ...}       base64 MP3 chunks for that sentence
+        {"type": "done", "transcript": ..., "response_text": ..., "tts_error": ...}
+
+    Each sentence is synthesized as soon as the LLM finishes it, so the first
+    audio arrives after STT plus the first sentence instead of the full turn.
+
+    The turn runs against a deadline (``X-Request-Timeout`` seconds, or
+    DEADLINE_SLO_SECONDS). As it runs out, TTS is skipped (text-only reply)
+    and then the LLM, whose canned reply is pre-rendered.
     """
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Must be in place before anything (e.g. the CSRF check) parses the body
+        request.upload_handlers.insert(0, AudioUploadLimitHandler(request))
+        return super().initialize_request(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        labels = getattr(self, "metric_labels", None)
+        if labels is not None and isinstance(response, Response):
+            # Render now rather than on the way out, so it can be timed
+            with metrics.span("serialize", **labels):
+                response.render()
+        return response
+
+    def _wants_stream(self, request):
+        value = request.query_params.get("stream") or request.data.get("stream")
+        return str(value).lower() in ("1", "true", "yes")
+
+    def _load_history(self, user):
+        """Return the recent messages and rolling summary of the active session"""
+        session_id, conversation_history, summary = context_store.history(user.id)
+        if session_id:
+            logger.debug("Loaded %d messages for context", len(conversation_history))
+        return conversation_history, summary
+
+    def _save_turn(
+        self,
+        user,
+        transcript,
+        response_text,
+        voice_preference,
+        audio_file,
+        audio_spool=None,
+        labels=None,
+    ):
+        """
+        Persist the user and assistant messages of one turn, timing each write
+
+        Returns:
+            Message: The assistant message, so audio still being streamed can
+            be attached later with ``_save_assistant_audio``
+        """
+        # Get or create an active session for this user
+        labels = labels or {}
+        session_id = context_store.active_session_id(user.id)
+        if not session_id:
+            with metrics.span("db_session", **labels):
+                session_id = Session.objects.create(user=user).id
+            logger.debug("New session %s created for user %s", session_id, user.id)
+        else:
+            logger.debug("Using existing session: %s", session_id)
+
+        # Save user message
+        with metrics.span("db_user_message", **labels):
+            user_message = Message.objects.create(
+                session_id=session_id, user=user, role="user", text=transcript
+            )
+        if audio_file:
+            # Save the same upload STT read: local storage moves Django's
+            # temp file into place, and copies in-memory uploads (or any
+            # upload, for S3) in chunks
+            with metrics.span("db_user_audio", **labels):
+                user_message.audio_file.save(
+                    f"user_{user.id}_{user_message.id}.webm", audio_file
+                )
+            audio_file.close()
+        logger.debug("User message saved: %s", user_message.id)
+
+        # Save assistant message with audio
+        with metrics.span("db_assistant_message", **labels):
+            assistant_message = Message.objects.create(
+                session_id=session_id,
+                user=user,
+                role="assistant",
+                text=response_text,
+                voice_used=voice_preference,
+            )
+        if audio_spool is not None:
+            self._save_assistant_audio(assistant_message, audio_spool, labels)
+        logger.debug("Assistant message saved: %s", assistant_message.id)
+        # Older messages are folded into the session summary off this path
+        schedule_summary(session_id)
+        return assistant_message
+
+    def _save_assistant_audio(self, assistant_message, audio_spool, labels):
+        if not audio_spool.size:
+            return
+        name = f"assistant_{assistant_message.user_id}_{assistant_message.id}.mp3"
+        # Storage reads the spool in chunks; no full copy is made in memory
+        with metrics.span("db_assistant_audio", **labels):
+            assistant_message.audio_file.save(name, audio_spool.as_file(name))
+
+    def _stream_audio(
+        self, first_chunk, audio_stream, audio_spool, assistant_message, labels
+    ):
+        """Pass TTS audio through to the client, storing it once complete"""
+        try:
+            yield first_chunk
+            yield from audio_stream
+            if assistant_message:
+                self._save_assistant_audio(assistant_message, audio_spool, labels)
+        except Exception as e:
+            # Headers are already sent; the client gets truncated audio
+            logger.warning("TTS stream failed: %s", e)
+        finally:
+            audio_spool.close()
+
+    def _stream_turn(
+        self,
+        user,
+        transcript,
+        conversation_history,
+        summary,
+        voice_preference,
+        audio_file,
+        deadline,
+        labels,
+        canned_reply=None,
+    ):
+        """
+        Generate the NDJSON events of a streamed turn (LLM -> TTS per sentence)
+
+        ``canned_reply`` replaces the LLM (and the turn isn't saved) when
+        the deadline left no time to transcribe the question
+        """
+        yield _stream_event("transcript", text=transcript)
+
+        response_parts = []
+        audio_spool = AudioSpool(settings.AUDIO_SPOOL_MAX_MEMORY)
+        tts_error = None
+
+        def deltas():
+            replies = (
+                [canned_reply]
+                if canned_reply is not None
+                else llm_service.stream_response(
+                    transcript, conversation_history, summary, deadline
+                )
+            )
+            for delta in replies:
+                response_parts.append(delta)
+                yield delta
+
+        try:
+            llm_service = registry.llm()
+            tts_service = registry.tts()
+
+            sentences = metrics.first(
+                iter_sentences(deltas()), "llm_first_sentence", **labels
+            )
+            for sentence in sentences:
+                yield _stream_event("text", text=sentence)
+                if tts_error:
+                    continue
+                try:
+                    audio_stream, _ = tts_service.tee(
+                        sentence, voice_preference, audio_spool, deadline
+                    )
+                    for chunk in metrics.first(audio_stream, "tts", **labels):
+                        with metrics.span("serialize", **labels):
+                            event = _stream_event(
+                                "audio", data=base64.b64encode(chunk).decode()
+                            )
+                        yield event
+                except Exception as tts_e:
+                    # Keep streaming text; the client already has any audio sent
+                    tts_error = str(tts_e)
+                    logger.warning("TTS failed: %s", tts_error)
+
+            response_text = "".join(response_parts).strip()
+            logger.debug("LLM response", extra={"reply": response_text})
+
+            if user and canned_reply is None:
+                with deadline.database():
+                    self._save_turn(
+                        user,
+                        transcript,
+                        response_text,
+                        voice_preference,
+                        audio_file,
+                        audio_spool,
+                        labels,
+                    )
+
+            yield _stream_event(
+                "done",
+                transcript=transcript,
+                response_text=response_text,
+                tts_error=tts_error,
+            )
+            logger.debug("Streaming request complete")
+        except Exception as e:
+            # Headers are already sent, so errors have to be reported in-band
+            logger.exception("Error occurred while streaming: %s", e)
+            yield _stream_event("error", error=str(e))
+        finally:
+            audio_spool.close()
+
     def post(self, request):
-        print("\n=== Voice Input Request Started ===")
+        logger.debug("Voice input request started")
+        deadline = Deadline.for_request(request)
         try:
             # Get audio file or text input
             audio_file = request.FILES.get("audio")
             text_input = request.data.get("text")
 
+            try:
+                duration = check_audio_upload(request, audio_file)
+            except AudioUploadRejected as e:
+                logger.info("Upload rejected: %s", e)
+                return Response(
+                    {"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                )
+
             if not audio_file and not text_input:
-                print("❌ Error: No audio or text provided")
                 return Response(
                     {"error": "Please provide either audio file or text input"},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            print(f"✓ Input type: {'Audio' if audio_file else 'Text'}")
             if audio_file:
-                print(f"✓ Audio file: {audio_file.name}, size: {audio_file.size} bytes")
+                logger.debug(
+                    "Audio input: %s, %d bytes, %ss",
+                    audio_file.name,
+                    audio_file.size,
+                    duration if duration is not None else "?",
+                )
             else:
-                print(f"✓ Text input: {text_input[:50]}...")
+                logger.debug("Text input", extra={"transcript": text_input})
 
             user = request.user if request.user.is_authenticated else None
             
@@ -49,123 +327,136 @@ class VoiceInputView(APIView):
                 if voice_preference and voice_preference != user.voice_preference:
                     user.voice_preference = voice_preference
                     user.save()
-                    print(f"✓ Updated user's voice preference to: {voice_preference}")
+                    logger.debug("Updated voice preference to %s", voice_preference)
                 else:
                     voice_preference = user.voice_preference
-                    print(f"✓ Using user's saved voice: {voice_preference}")
+                    logger.debug("Using the user's saved voice: %s", voice_preference)
             else:
                 # Anonymous users
                 voice_preference = voice_preference or "Chinenye"
-                print(f"✓ Using guest voice: {voice_preference}")
+                logger.debug("Using guest voice: %s", voice_preference)
+            labels = self.metric_labels = _metric_labels(voice_preference, audio_file)
 
             # Step 1: Get transcript (either from STT or direct text)
+            timed_out = False
             if audio_file:
-                print("\n--- Step 1: Speech-to-Text (Whisper) ---")
-                stt_service = STTService()
-                transcript = stt_service.transcribe(audio_file)
-                print(f"✓ Transcript: {transcript}")
+                stt_input = audio_file
+                vad = registry.vad()
+                if vad is not None:
+                    try:
+                        with metrics.span("vad", **labels):
+                            stt_input, _ = vad.process(audio_file)
+                    except SilentAudio as e:
+                        # Nothing to transcribe; don't pay for a Whisper call
+                        return Response(
+                            {"error": str(e)},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        )
+                stt_service = registry.stt()
+                try:
+                    with metrics.span("stt", **labels):
+                        transcript = stt_service.transcribe(stt_input, deadline)
+                    logger.debug("Transcribed", extra={"transcript": transcript})
+                except (DeadlineExceeded, BreakerOpen) as e:
+                    # No time left to answer, or Whisper is down; apologise
+                    # with canned audio
+                    logger.warning("%s", e)
+                    timed_out, transcript = True, ""
             else:
-                print("\n--- Step 1: Using direct text input ---")
                 transcript = text_input
-                print(f"✓ Text: {transcript}")
 
-            # Step 2: LLM - Get response with conversation history
-            print("\n--- Step 2: LLM Processing (GPT-4) ---")
-            llm_service = LLMService()
-            
             # Build conversation history for context if user is authenticated
-            conversation_history = []
-            if user:
-                # Get or create session first to access history
-                session = (
-                    Session.objects.filter(user=user).order_by("-updated_at").first()
+            conversation_history, summary = [], ""
+            if user and not timed_out:
+                with deadline.database(), metrics.span("history", **labels):
+                    conversation_history, summary = self._load_history(user)
+
+            if self._wants_stream(request):
+                response = StreamingHttpResponse(
+                    self._stream_turn(
+                        user,
+                        transcript,
+                        conversation_history,
+                        summary,
+                        voice_preference,
+                        audio_file,
+                        deadline,
+                        labels,
+                        FALLBACK_TIMEOUT if timed_out else None,
+                    ),
+                    content_type="application/x-ndjson",
                 )
-                if session:
-                    # Get last 10 messages for context (5 exchanges)
-                    recent_messages = Message.objects.filter(
-                        session=session
-                    ).order_by("-created_at")[:10]
-                    
-                    # Reverse to chronological order and build history
-                    for msg in reversed(recent_messages):
-                        conversation_history.append({
-                            "role": msg.role,
-                            "content": msg.text
-                        })
-                    print(f"✓ Loaded {len(conversation_history)} messages for context")
-            
-            response_text = llm_service.get_response(transcript, conversation_history)
-            print(f"✓ LLM Response: {response_text}")
+                response["X-Transcript"] = _encode_header(transcript)
+                response["X-User-Query"] = _encode_header(transcript)
+                response["X-Encoding"] = "base64"
+                return response
+
+            # Step 2: LLM - Get response with conversation history
+            if timed_out:
+                response_text = FALLBACK_TIMEOUT
+            else:
+                llm_service = registry.llm()
+                with metrics.span("llm", **labels):
+                    response_text = llm_service.get_response(
+                        transcript, conversation_history, summary, deadline
+                    )
+            logger.debug("LLM response", extra={"reply": response_text})
 
             # Step 3: TTS - Convert response to audio
-            print("\n--- Step 3: Text-to-Speech (YarnGPT) ---")
-            audio_data = None
+            audio_stream = None
+            audio_spool = None
+            first_chunk = b""
             tts_error = None
             try:
-                tts_service = TTSService()
-                audio_data = tts_service.synthesize(response_text, voice_preference)
-                print(f"✓ TTS Audio generated: {len(audio_data)} bytes")
+                tts_service = registry.tts()
+                # Pull the first chunk so provider errors surface before any
+                # headers are sent and we can still fall back to JSON
+                with metrics.span("tts", **labels):
+                    audio_stream, audio_spool = tts_service.tee(
+                        response_text, voice_preference, deadline=deadline
+                    )
+                    first_chunk = next(audio_stream, b"")
             except Exception as tts_e:
                 tts_error = str(tts_e)
-                print(f"⚠️ TTS failed: {tts_error}")
-                print("⚠️ Continuing without audio...")
+                logger.warning("TTS failed, continuing without audio: %s", tts_error)
 
             # Step 4: Save messages to database for authenticated users
-            if user:
-                # Get or create an active session for this user
-                session = (
-                    Session.objects.filter(user=user).order_by("-updated_at").first()
-                )
-                if not session:
-                    session = Session.objects.create(user=user)
-                    print(f"✓ New session created for user: {user.username}")
-                else:
-                    print(f"✓ Using existing session: {session.id}")
-
-                # Save user message
-                user_message = Message.objects.create(
-                    session=session, user=user, role="user", text=transcript
-                )
-                if audio_file:
-                    # Save the uploaded audio
-                    user_message.audio_file.save(
-                        f"user_{user.id}_{user_message.id}.webm",
-                        ContentFile(audio_file.read()),
-                    )
-                    audio_file.seek(0)  # Reset file pointer
-                print(f"✓ User message saved: {user_message.id}")
-
-                # Save assistant message with audio
-                assistant_message = Message.objects.create(
-                    session=session,
-                    user=user,
-                    role="assistant",
-                    text=response_text,
-                    voice_used=voice_preference,
-                )
-                if audio_data:
-                    assistant_message.audio_file.save(
-                        f"assistant_{user.id}_{assistant_message.id}.mp3",
-                        ContentFile(audio_data),
+            assistant_message = None
+            if user and not timed_out:
+                with deadline.database():
+                    assistant_message = self._save_turn(
+                        user,
+                        transcript,
+                        response_text,
+                        voice_preference,
+                        audio_file,
+                        labels=labels,
                     )
-                print(f"✓ Assistant message saved: {assistant_message.id}")
 
             # Return response
-            print("\n=== Request Complete ===\n")
-            if audio_data:
-                # Return audio response with headers
-                # Note: HTTP headers can't contain newlines, so we encode them
-                import base64
-                
-                response = HttpResponse(audio_data, content_type="audio/mpeg")
+            logger.debug("Voice input request complete")
+            if first_chunk:
+                # Stream audio as YarnGPT sends it; it is stored once complete
+                response = StreamingHttpResponse(
+                    self._stream_audio(
+                        first_chunk,
+                        audio_stream,
+                        audio_spool,
+                        assistant_message,
+                        labels,
+                    ),
+                    content_type="audio/mpeg",
+                )
                 response["Content-Disposition"] = 'attachment; filename="response.mp3"'
-                # Encode text with newlines as base64 to safely pass in headers
-                response["X-Transcript"] = base64.b64encode(transcript.encode()).decode()
-                response["X-Response-Text"] = base64.b64encode(response_text.encode()).decode()
-                response["X-User-Query"] = base64.b64encode(transcript.encode()).decode()
+                with metrics.span("serialize", **labels):
+                    response["X-Transcript"] = _encode_header(transcript)
+                    response["X-Response-Text"] = _encode_header(response_text)
+                    response["X-User-Query"] = _encode_header(transcript)
                 response["X-Encoding"] = "base64"  # Signal to frontend that values are base64 encoded
                 return response
             else:
+                if audio_spool is not None:
+                    audio_spool.close()
                 # Return JSON if TTS failed
                 response_data = {
                     "user_query": transcript,  # User's original query
@@ -175,19 +466,54 @@ class VoiceInputView(APIView):
                     "tts_error": tts_error,
                     "message": "TTS service unavailable. Text response provided.",
                 }
-                print(f"Response data: {response_data}")
                 return Response(response_data)
 
+        except Overloaded as e:
+            # The providers are at our quota; fail fast rather than queue
+            logger.warning("Rejected: %s", e)
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": _retry_after(e)},
+            )
         except Exception as e:
-            print(f"\n Error occurred: {str(e)}")
-            import traceback
-
-            traceback.print_exc()
+            logger.exception("Error occurred: %s", e)
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
 
+class WelcomeView(APIView):
+    """
+    New-conversation opener: /api/welcome
+    Returns the Stage 0 welcome as audio, pre-rendered per voice
+    """
+
+    permission_classes = []  # Allow unauthenticated access
+
+    def get(self, request):
+        voice = request.query_params.get("voice")
+        if not voice:
+            if request.user.is_authenticated:
+                voice = request.user.voice_preference
+            else:
+                voice = "Chinenye"
+
+        try:
+            # Served from the canned store (or TTS cache) without calling YarnGPT
+            audio_data = registry.tts().synthesize(WELCOME, voice)
+        except Exception as e:
+            return Response(
+                {"response_text": WELCOME, "audio_url": None, "tts_error": str(e)}
+            )
+
+        response = HttpResponse(audio_data, content_type="audio/mpeg")
+        response["Content-Disposition"] = 'attachment; filename="welcome.mp3"'
+        response["X-Response-Text"] = _encode_header(WELCOME)
+        response["X-Encoding"] = "base64"
+        return response
+
+
 class UserProfileView(APIView):
     """Get or update user profile"""
 
@@ -214,7 +540,12 @@ class UserProfileView(APIView):
 
 
 class SessionHistoryView(APIView):
-    """Get user's session history"""
+    """
+    Get user's session history, most recently active first
+
+    Cursor paginated (``?cursor=...&page_size=...``); each session carries
+    its message count, last-message preview and duration.
+    """
 
     def get(self, request):
         if not request.user.is_authenticated:
@@ -222,6 +553,72 @@ class SessionHistoryView(APIView):
                 {"error": "Not authenticated"}, status=status.HTTP_401_UNAUTHORIZED
             )
 
-        sessions = Session.objects.filter(user=request.user)[:10]
-        serializer = SessionSerializer(sessions, many=True)
-        return Response(serializer.data)
+        sessions = Session.objects.filter(user=request.user).with_stats(
+            settings.HISTORY_PREVIEW_CHARS
+        )
+        paginator = SessionCursorPagination()
+        page = paginator.paginate_queryset(sessions, request, view=self)
+        serializer = SessionSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class SessionMessagesView(APIView):
+    """Get one of the user's sessions' messages, newest first, cursor paginated"""
+
+    def get(self, request, session_id):
+        if not request.user.is_authenticated:
+            return Response(
+                {"error": "Not authenticated"}, status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        if not Session.objects.filter(id=session_id, user=request.user).exists():
+            return Response(
+                {"error": "Session not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        messages = Message.objects.filter(session_id=session_id)
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageSerializer(page, many=True, context={"request": request})
+        return paginator.get_paginated_response(serializer.data)
+
+
+class MessageSearchView(APIView):
+    """
+    Full-text search over the user's own messages, best match first
+
+    ``?q=`` takes words, "quoted phrases", ``or`` and ``-excluded`` terms;
+    page with ``limit`` and ``offset``.
+    """
+
+    def get(self, request):
+        if not request.user.is_authenticated:
+            return Response(
+                {"error": "Not authenticated"}, status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response(
+                {"error": "Search query is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            limit = min(
+                int(request.query_params.get("limit", settings.HISTORY_PAGE_SIZE)),
+                settings.HISTORY_MAX_PAGE_SIZE,
+            )
+            offset = int(request.query_params.get("offset", 0))
+        except ValueError:
+            return Response(
+                {"error": "limit and offset must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        messages = search_messages(
+            query, request.user.id, limit=max(limit, 1), offset=max(offset, 0)
+        )
+        serializer = SearchResultSerializer(
+            messages, many=True, context={"request": request}
+        )
+        return Response({"query": query, "results": serializer.data})
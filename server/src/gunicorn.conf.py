@@ -0,0 +1,37 @@
+"""Gunicorn settings, picked up automatically when started from server/src"""
+
+import os
+import shutil
+
+# A turn gives up by its deadline (DEADLINE_MAX_SECONDS at most) and answers
+# with whatever it has; only a worker stuck well past that is killed
+timeout = int(float(os.getenv("DEADLINE_MAX_SECONDS", "90"))) + 30
+graceful_timeout = timeout
+
+
+def on_starting(server):
+    # Workers' metric files from a previous run would be added to this one's
+    metrics_dir = os.getenv(
+        "METRICS_DIR", os.path.join(os.path.dirname(__file__), "cache", "metrics")
+    )
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # Build pooled upstream clients and open keep-alive connections once the
+    # worker has loaded Django, so the first voice turn skips the handshakes
+    from audio_processing.registry import registry
+
+    registry.warm_up()
+
+
+def worker_exit(server, worker):
+    # Keep the counts recorded since the worker's last flush, and write out
+    # the log records still queued
+    import logging
+
+    from audio_processing.metrics import metrics
+
+    metrics.flush()
+    for handler in logging.getLogger().handlers:
+        handler.flush()
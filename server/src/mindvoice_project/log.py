@@ -0,0 +1,178 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import uuid
+import zlib
+from contextvars import ContextVar
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# IDs clients may choose for themselves; anything else is replaced
+_CLIENT_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+# ``extra`` fields holding what a user said or was told, kept out of the
+# logs unless LOG_CONVERSATIONS is set
+CONVERSATION_FIELDS = ("transcript", "reply")
+
+# The request being handled, set by RequestIdMiddleware ("-" outside one)
+request_id = ContextVar("request_id", default="-")
+
+# Attributes every LogRecord has; the rest came in through ``extra``
+_RECORD_FIELDS = {*vars(logging.makeLogRecord({})), "message", "request_id"}
+
+
+def new_request_id(client_id=None):
+    """The client's own X-Request-ID if it is a sane one, else a fresh ID"""
+    if client_id and _CLIENT_ID.fullmatch(client_id):
+        return client_id
+    return uuid.uuid4().hex
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Stamps records with the request ID, samples DEBUG records and redacts
+    conversation text
+
+    DEBUG records are kept for ``debug_sample_rate`` of requests, picked by
+    request ID so a sampled request logs every one of its steps. Values of
+    CONVERSATION_FIELDS are replaced by their length unless
+    ``log_conversations``.
+    """
+
+    def __init__(self, debug_sample_rate=1.0, log_conversations=False, name=""):
+        super().__init__(name)
+        self.debug_sample_rate = float(debug_sample_rate)
+        self.log_conversations = log_conversations
+
+    def sampled(self, rid):
+        if self.debug_sample_rate >= 1:
+            return True
+        return zlib.crc32(rid.encode()) % 10_000 < self.debug_sample_rate * 10_000
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        if record.levelno <= logging.DEBUG and not self.sampled(record.request_id):
+            return False
+        if not self.log_conversations:
+            for field in CONVERSATION_FIELDS:
+                value = getattr(record, field, None)
+                if isinstance(value, str):
+                    setattr(record, field, f"<{len(value)} chars>")
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, request ID, any
+    ``extra`` fields and the traceback
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a thread that formats and writes them to ``stream``,
+    so a slow or blocked stdout (a full pipe, a stalled log shipper) never
+    holds up a request
+
+    The queue holds at most ``queue_size`` records. Past that, records are
+    dropped rather than waited on, and how many were lost is logged once
+    there is room again. The writer thread starts on first use in each
+    process, so forked workers get their own.
+    """
+
+    def __init__(self, stream=None, queue_size=10_000):
+        super().__init__(queue.Queue(queue_size))
+        self.queue_size = queue_size
+        self.target = logging.StreamHandler(stream or sys.stdout)
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the writer thread
+        self.target.setFormatter(fmt)
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # First use, or forked: the parent's writer thread didn't come along
+            self.queue = queue.Queue(self.queue_size)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Only the message is rendered here, since its arguments may change
+        # once the call returns; the rest is left to the writer thread
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self._dropped_notice())
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _dropped_notice(self):
+        return logging.makeLogRecord(
+            {
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"Log queue full, dropped {self.dropped} records",
+                "request_id": "-",
+            }
+        )
+
+    def flush(self):
+        """Wait until the records queued so far are written"""
+        if self._listener is not None and self._pid == os.getpid():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        with self._start_lock:
+            if self._listener is not None and self._pid == os.getpid():
+                try:
+                    self._listener.stop()
+                except queue.Full:
+                    pass  # Writer is stuck; what is still queued is lost
+                self._listener = None
+                self._pid = None
+        self.target.close()
+        super().close()
@@ -0,0 +1,75 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from .log import REQUEST_ID_HEADER, new_request_id, request_id
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise middleware that can also run in an async middleware chain
+
+    The stock middleware is sync-only, which makes Django run every view
+    (including async ones) through a single sync thread under ASGI. Static
+    files are still served from memory-mapped lookups, so nothing here blocks.
+    """
+
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=None):
+        if settings is None:
+            super().__init__(get_response)
+        else:
+            super().__init__(get_response, settings)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+class RequestIdMiddleware:
+    """
+    Gives each request an ID, set on its log records and returned in the
+    X-Request-ID response header
+
+    A client that sends its own X-Request-ID keeps it, so its logs and ours
+    line up. The ID is left set after the view returns: a streamed reply
+    logs under it while its body is still being sent.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _begin(self, request):
+        request.request_id = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+        request_id.set(request.request_id)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self._begin(request)
+        response = self.get_response(request)
+        response[REQUEST_ID_HEADER] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        self._begin(request)
+        response = await self.get_response(request)
+        response[REQUEST_ID_HEADER] = request.request_id
+        return response
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -53,8 +54,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "mindvoice_project.middleware.RequestIdMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "mindvoice_project.middleware.AsyncWhiteNoiseMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -88,7 +90,6 @@ WSGI_APPLICATION = "mindvoice_project.wsgi.application"
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
 if DEBUG:
-    print("debug mode")
     DATABASES = {
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
@@ -96,7 +97,6 @@ if DEBUG:
         }
     }
 else:
-    print("production mode")
     DATABASES = {
         "default": {
             "ENGINE": "django.db.backends.postgresql",
@@ -182,8 +182,14 @@ CORS_EXPOSE_HEADERS = [
     "X-Response-Text",
     "X-User-Query",
     "X-Encoding",
+    "Retry-After",
+    "X-Request-ID",
 ]
 
+# Let the frontend set its own turn deadline (see DEADLINE_SLO_SECONDS), and
+# its own request ID to find its requests in our logs
+CORS_ALLOW_HEADERS = (*default_headers, "x-request-timeout", "x-request-id")
+
 # REST Framework
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
@@ -199,6 +205,242 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Upstream provider connection pools (per worker process)
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+YARNGPT_POOL_SIZE = int(os.getenv("YARNGPT_POOL_SIZE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+
+# Upstream timeouts in seconds: to connect, and for each read of a response
+# (so a stalled stream fails, however long the whole reply runs). Failed
+# calls are retried at most OPENAI_MAX_RETRIES times by the OpenAI client;
+# slow ones are hedged instead (below)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+YARNGPT_TIMEOUT = float(os.getenv("YARNGPT_TIMEOUT", "30"))
+
+# Circuit breakers, per worker and service ("stt", "llm", "tts"): a circuit
+# opens once BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls (and at
+# least BREAKER_MIN_CALLS) failed or took longer than the service's
+# SLOW_CALL_SECONDS. Calls then fail at once for BREAKER_OPEN_SECONDS (TTS
+# falls back to a text-only reply, STT and LLM to 503), after which a single
+# trial call decides whether it closes again
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+SLOW_CALL_SECONDS = {
+    "stt": float(os.getenv("STT_SLOW_CALL_SECONDS", "30")),
+    "llm": float(os.getenv("LLM_SLOW_CALL_SECONDS", "15")),
+    "tts": float(os.getenv("TTS_SLOW_CALL_SECONDS", "10")),
+}
+
+# Hedged requests: a call to one of HEDGE_SERVICES still unanswered after
+# that service's recent HEDGE_QUANTILE latency is sent again, and the first
+# answer wins. At most HEDGE_BUDGET extra calls per call made. STT uploads
+# are never hedged
+HEDGE_SERVICES = [
+    name for name in os.getenv("HEDGE_SERVICES", "llm,tts").split(",") if name
+]
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_THREADS = int(os.getenv("HEDGE_THREADS", "16"))
+
+# Voice turn deadline: DEADLINE_SLO_SECONDS from the start of the request,
+# or what the client asks for in an X-Request-Timeout header (clamped to
+# DEADLINE_MIN_SECONDS..DEADLINE_MAX_SECONDS). Stage timeouts and retries
+# shrink to fit the time left. STT keeps DEADLINE_LLM_SECONDS back for the
+# LLM and DEADLINE_DB_SECONDS for saving the turn. When time runs short, TTS
+# is skipped first (with less than DEADLINE_TTS_SECONDS left), then the LLM
+# is replaced by a canned reply. Gunicorn only kills a worker well after
+# DEADLINE_MAX_SECONDS (see gunicorn.conf.py)
+DEADLINE_SLO_SECONDS = float(os.getenv("DEADLINE_SLO_SECONDS", "30"))
+DEADLINE_MIN_SECONDS = float(os.getenv("DEADLINE_MIN_SECONDS", "5"))
+DEADLINE_MAX_SECONDS = float(os.getenv("DEADLINE_MAX_SECONDS", "90"))
+DEADLINE_LLM_SECONDS = float(os.getenv("DEADLINE_LLM_SECONDS", "4"))
+DEADLINE_TTS_SECONDS = float(os.getenv("DEADLINE_TTS_SECONDS", "2"))
+DEADLINE_DB_SECONDS = float(os.getenv("DEADLINE_DB_SECONDS", "2"))
+
+# Upstream admission control, shared by the workers on a host through lock
+# files in ADMISSION_DIR: per provider, at most "concurrency" calls in flight
+# and "requests_per_minute" started (set both to the account's quota). Up
+# to "queue_size" more calls wait, for at most ADMISSION_MAX_WAIT seconds;
+# past that the voice endpoints answer 503 with Retry-After
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "True") == "True"
+ADMISSION_DIR = os.getenv("ADMISSION_DIR", str(BASE_DIR / "cache" / "admission"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+UPSTREAM_ADMISSION = {
+    "openai": {
+        "concurrency": int(os.getenv("OPENAI_MAX_CONCURRENCY", "32")),
+        "requests_per_minute": int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500")),
+        "queue_size": int(os.getenv("OPENAI_QUEUE_SIZE", "64")),
+    },
+    "yarngpt": {
+        "concurrency": int(os.getenv("YARNGPT_MAX_CONCURRENCY", "16")),
+        "requests_per_minute": int(os.getenv("YARNGPT_REQUESTS_PER_MINUTE", "300")),
+        "queue_size": int(os.getenv("YARNGPT_QUEUE_SIZE", "32")),
+    },
+}
+
+# Per-stage latency, upstream bytes/tokens and the admission and breaker
+# counters, served in the Prometheus text format at /metrics. Each worker
+# writes its totals to METRICS_DIR every METRICS_FLUSH_SECONDS, and a scrape
+# adds up every worker's file. Scrapers send METRICS_TOKEN as a bearer
+# token; staff users can read it without one
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True") == "True"
+METRICS_DIR = os.getenv("METRICS_DIR", str(BASE_DIR / "cache" / "metrics"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "1"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Logging: records are queued and written to stdout by a background thread
+# (so a slow log pipe never holds up a reply), one JSON object per line with
+# the request's ID (LOG_FORMAT=text for a terminal). At LOG_LEVEL=DEBUG, the
+# step-by-step records of only LOG_DEBUG_SAMPLE_RATE of requests are kept.
+# What users say and are told is logged only as its length, unless
+# LOG_CONVERSATIONS is set. Past LOG_QUEUE_SIZE waiting records, new ones
+# are dropped
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text" if DEBUG else "json")
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+LOG_CONVERSATIONS = os.getenv("LOG_CONVERSATIONS", "False") == "True"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "request": {
+            "()": "mindvoice_project.log.RequestContextFilter",
+            "debug_sample_rate": LOG_DEBUG_SAMPLE_RATE,
+            "log_conversations": LOG_CONVERSATIONS,
+        },
+    },
+    "formatters": {
+        "json": {"()": "mindvoice_project.log.JsonFormatter"},
+        "text": {
+            "format": "%(asctime)s %(levelname)s %(name)s [%(request_id)s] "
+            "%(message)s"
+        },
+    },
+    "handlers": {
+        "background": {
+            "()": "mindvoice_project.log.BackgroundHandler",
+            "stream": "ext://sys.stdout",
+            "queue_size": LOG_QUEUE_SIZE,
+            "filters": ["request"],
+            "formatter": LOG_FORMAT,
+        },
+    },
+    "root": {"handlers": ["background"], "level": LOG_LEVEL},
+    "loggers": {
+        # Request errors and the like, through the same handler
+        "django": {"handlers": [], "level": "INFO", "propagate": True},
+        # The HTTP clients' own step-by-step output; httpx also logs every
+        # call at INFO
+        "httpx": {"level": "WARNING"},
+        "httpcore": {"level": "INFO"},
+        "openai": {"level": "INFO"},
+        "urllib3": {"level": "INFO"},
+    },
+}
+
+# TTS audio cache: per-worker memory LRU plus a disk tier shared by workers
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "True") == "True"
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(32 * 1024**2)))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", str(BASE_DIR / "cache" / "tts"))
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(512 * 1024**2)))
+TTS_CACHE_MAX_ENTRY_BYTES = int(os.getenv("TTS_CACHE_MAX_ENTRY_BYTES", str(1024**2)))
+
+# Streamed TTS audio is spooled for storage in memory up to this size, then on disk
+AUDIO_SPOOL_MAX_MEMORY = int(os.getenv("AUDIO_SPOOL_MAX_MEMORY", str(1024**2)))
+
+# Voice uploads: kept in memory up to the spool size, then in a temp file.
+# Recordings over the size or duration cap are rejected before STT
+# (Whisper itself accepts at most 25 MB).
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv("AUDIO_UPLOAD_SPOOL_BYTES", str(1024**2)))
+AUDIO_UPLOAD_MAX_BYTES = int(os.getenv("AUDIO_UPLOAD_MAX_BYTES", str(25 * 1024**2)))
+AUDIO_UPLOAD_MAX_SECONDS = float(os.getenv("AUDIO_UPLOAD_MAX_SECONDS", "300"))
+
+# Optional silence trimming before STT (needs NumPy and ffmpeg): pauses are
+# collapsed to STT_VAD_MAX_PAUSE seconds and speech keeps STT_VAD_PADDING
+# seconds either side; recordings with less than STT_VAD_MIN_TRIM seconds to
+# cut are sent as uploaded
+STT_VAD_ENABLED = os.getenv("STT_VAD_ENABLED", "False") == "True"
+STT_VAD_MAX_PAUSE = float(os.getenv("STT_VAD_MAX_PAUSE", "0.6"))
+STT_VAD_PADDING = float(os.getenv("STT_VAD_PADDING", "0.2"))
+STT_VAD_MIN_TRIM = float(os.getenv("STT_VAD_MIN_TRIM", "0.5"))
+
+# Pre-rendered per-voice audio for fixed utterances (manage.py prerender_audio)
+CANNED_AUDIO_DIR = os.getenv("CANNED_AUDIO_DIR", str(BASE_DIR / "canned_audio"))
+
+# Conversation context cache: each user's active session and the last
+# CONVERSATION_WINDOW messages of it. Per-process by default, which can't
+# see other workers' writes: the active session is then re-read every turn
+# and windows kept for CONVERSATION_LOCAL_CACHE_TTL seconds at most. Name a
+# shared cache in CACHES (e.g. Redis) to skip those queries with several
+# workers
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", "10"))
+CONVERSATION_CACHE_ALIAS = os.getenv("CONVERSATION_CACHE_ALIAS", "")
+CONVERSATION_CACHE_TTL = int(os.getenv("CONVERSATION_CACHE_TTL", "1800"))
+CONVERSATION_LOCAL_CACHE_TTL = int(os.getenv("CONVERSATION_LOCAL_CACHE_TTL", "5"))
+CONVERSATION_CACHE_MAX_ENTRIES = int(
+    os.getenv("CONVERSATION_CACHE_MAX_ENTRIES", "20000")
+)
+
+# Prompt assembly: token budget for conversation history (the system prompt
+# is sent unchanged so provider-side prompt caching can reuse it), and a
+# per-message cap so one long monologue can't crowd out the rest
+LLM_HISTORY_TOKEN_BUDGET = int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", "1500"))
+LLM_MESSAGE_TOKEN_LIMIT = int(os.getenv("LLM_MESSAGE_TOKEN_LIMIT", "400"))
+
+# Rolling session summaries of messages older than the history window,
+# refreshed in the background once enough of them are waiting
+SESSION_SUMMARY_ENABLED = os.getenv("SESSION_SUMMARY_ENABLED", "True") == "True"
+SESSION_SUMMARY_MODEL = os.getenv("SESSION_SUMMARY_MODEL", "gpt-4o-mini")
+SESSION_SUMMARY_MIN_MESSAGES = int(os.getenv("SESSION_SUMMARY_MIN_MESSAGES", "4"))
+
+# Session history API: cursor (keyset) pages, so older pages cost the same
+# as the first however long a user's history is
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+HISTORY_PREVIEW_CHARS = int(os.getenv("HISTORY_PREVIEW_CHARS", "120"))
+
+# Admin changelists show the planner's row estimate instead of an exact
+# COUNT(*) for unfiltered tables larger than this
+ADMIN_EXACT_COUNT_LIMIT = int(os.getenv("ADMIN_EXACT_COUNT_LIMIT", "100000"))
+
 # Media files (for storing audio files)
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
+
+# Message audio is content addressed (deduplicated, sharded by hash) under
+# MEDIA_ROOT, or in an S3-compatible bucket with AUDIO_STORAGE_BACKEND=s3
+# (needs boto3; credentials come from the usual AWS_* variables)
+AUDIO_STORAGE_BACKEND = os.getenv("AUDIO_STORAGE_BACKEND", "local")
+AUDIO_S3_BUCKET = os.getenv("AUDIO_S3_BUCKET", "")
+AUDIO_S3_ENDPOINT_URL = os.getenv("AUDIO_S3_ENDPOINT_URL") or None
+AUDIO_S3_PUBLIC_URL = os.getenv("AUDIO_S3_PUBLIC_URL", "")
+
+# Audio retention (manage.py compact_audio): recordings older than a role's
+# compact_after_days are re-encoded as low-bitrate Opus, and dropped (the text is
+# kept) after its drop_after_days; 0 disables a step. Assistant audio can be
+# synthesized again from its text, so it goes sooner by default
+AUDIO_RETENTION = {
+    "user": {
+        "compact_after_days": int(os.getenv("AUDIO_RETENTION_USER_COMPACT_DAYS", "30")),
+        "drop_after_days": int(os.getenv("AUDIO_RETENTION_USER_DROP_DAYS", "365")),
+    },
+    "assistant": {
+        "compact_after_days": int(
+            os.getenv("AUDIO_RETENTION_ASSISTANT_COMPACT_DAYS", "7")
+        ),
+        "drop_after_days": int(os.getenv("AUDIO_RETENTION_ASSISTANT_DROP_DAYS", "90")),
+    },
+}
+AUDIO_ARCHIVE_BITRATE = os.getenv("AUDIO_ARCHIVE_BITRATE", "12k")
+AUDIO_RETENTION_BATCH_SIZE = int(os.getenv("AUDIO_RETENTION_BATCH_SIZE", "100"))
+# Cap on the job's audio reads and writes, so it can run alongside traffic
+AUDIO_RETENTION_IO_BYTES_PER_SECOND = int(
+    os.getenv("AUDIO_RETENTION_IO_BYTES_PER_SECOND", str(4 * 1024 * 1024))
+)